@@ -0,0 +1,258 @@
+import io
+import os
+import sys
+import json
+import time
+import copy
+import shutil
+import tempfile
+import argparse
+import functools
+import contextlib
+import mediasort as MS
+
+def make_text_frame(frame_id, text, encoding=0):
+	body = bytes([encoding]) + text
+	return frame_id + len(body).to_bytes(4, 'big') + b'\x00\x00' + body
+
+def make_id3v2_tag(frames):
+	data = b''.join(frames) + b'\x00' * 256
+	size = bytes([(len(data) >> 21) & 0x7f, (len(data) >> 14) & 0x7f, (len(data) >> 7) & 0x7f, len(data) & 0x7f])
+	return b'ID3\x03\x00\x00' + size + data
+
+AUDIO_DATA = (b'\xff\xfb\x90\x00' + b'\x00' * 413) * 8
+
+def make_tagged_mp3(filename, artist, album, year, number, title):
+	with open(filename, 'wb') as f:
+		f.write(make_id3v2_tag([
+			make_text_frame(b'TPE1', artist),
+			make_text_frame(b'TALB', album),
+			make_text_frame(b'TYER', year),
+			make_text_frame(b'TRCK', number),
+			make_text_frame(b'TIT2', title),
+			]))
+		f.write(AUDIO_DATA)
+
+def make_inbox(dirname, count):
+	filenames = []
+	for index in range(1, count + 1):
+		filename = os.path.join(dirname, '{0:0>2} - Track {0}.mp3'.format(index))
+		make_tagged_mp3(filename, b'Artist', b'Album', b'2001', '{0}/{1}'.format(index, count).encode(), 'Track {0}'.format(index).encode())
+		filenames.append(filename)
+	return filenames
+
+FILENAME_CORPUS = [
+		'Metallica - 1986 - Master Of Puppets/01 - Battery.mp3',
+		'Iron Maiden [1982] The Number Of The Beast/02.Children Of The Damned.mp3',
+		'Kino - Gruppa Krovi (1988)/03_Zakroj Za Soboj Dver.mp3',
+		'Within Temptation - Discography/2007 - The Heart Of Everything/04 Our Solemn Hour.mp3',
+		'Nightwish - Once - (2004)/05 Nemo.mp3',
+		'[1999] - Blue/06-Cherry Lips.mp3',
+		'2003_Fallen/07 Haunted.mp3',
+		'Amon Amarth - Twilight Of The Thunder God (2008 - Advance)/08 Varyags Of Miklagaard.mp3',
+		'Burzum - Filosofem/09Dunkelheit.mp3',
+		'Unsorted/Some Track.mp3',
+		]
+
+def make_filename_corpus(albums, tracks):
+	filenames = []
+	for album in range(albums):
+		for number in range(1, tracks + 1):
+			dirname, filename = os.path.split(FILENAME_CORPUS[album % len(FILENAME_CORPUS)])
+			filenames.append(os.path.join('/inbox', '{0} {1}'.format(dirname, album), '{0:0>2}{1}'.format(number, filename[2:])))
+	return filenames
+
+# (artist, album, text encoding of the ID3v2 frame, text codec)
+SYNTHETIC_ALBUMS = [
+		('Metallica', 'Master Of Puppets', 0, 'latin-1'),
+		('Кино', 'Группа крови', 0, 'cp1251'),
+		('Ария', 'Герой асфальта', 3, 'utf-8'),
+		('Björk', 'Homogenic', 1, 'utf-16'),
+		('some_artist[Discography]', 'some album (Deluxe Edition) - CD 1', 0, 'latin-1'),
+		]
+SYNTHETIC_GENRES = ['Rock', 'Metal', 'Pop', 'Electronic']
+
+def make_synthetic_inbox(dirname, albums, tracks):
+	# Inbox with albums in assorted tag encodings and messy directory and file names.
+	for index in range(albums):
+		artist, album, encoding, codec = SYNTHETIC_ALBUMS[index % len(SYNTHETIC_ALBUMS)]
+		pattern_dirname, pattern_filename = os.path.split(FILENAME_CORPUS[index % len(FILENAME_CORPUS)])
+		album_dir = os.path.join(dirname, 'downloads', '{0} {1}'.format(pattern_dirname, index))
+		os.makedirs(album_dir)
+		year = str(1980 + index % 40)
+		for number in range(1, tracks + 1):
+			title = 'Track {0}'.format(number)
+			filename = os.path.join(album_dir, '{0:0>2}{1}'.format(number, pattern_filename[2:]))
+			with open(filename, 'wb') as f:
+				f.write(make_id3v2_tag([
+					make_text_frame(b'TPE1', artist.encode(codec), encoding),
+					make_text_frame(b'TALB', '{0} {1}'.format(album, index).encode(codec), encoding),
+					make_text_frame(b'TYER', year.encode()),
+					make_text_frame(b'TRCK', '{0}/{1}'.format(number, tracks).encode()),
+					make_text_frame(b'TIT2', title.encode(codec), encoding),
+					]))
+				f.write(AUDIO_DATA)
+			if number == 1:
+				with open(os.path.join(album_dir, 'cover.jpg'), 'wb') as f:
+					f.write(b'\xff\xd8\xff\xe0')
+
+def make_synthetic_library(root, artists, albums):
+	# Library root with genre subdirs: <genre>/<artist>/<year>-<album>.
+	for index in range(artists):
+		artist_dir = os.path.join(root, SYNTHETIC_GENRES[index % len(SYNTHETIC_GENRES)], 'Artist {0}'.format(index))
+		for album in range(albums):
+			os.makedirs(os.path.join(artist_dir, '{0}-Album {1}'.format(1980 + album, album)))
+	for artist, album, encoding, codec in SYNTHETIC_ALBUMS:
+		os.makedirs(os.path.join(root, SYNTHETIC_GENRES[0], artist), exist_ok=True)
+
+def parse_filenames_uncompiled(filenames):
+	for filepath in filenames:
+		dirname, filename = os.path.split(filepath)
+		MS.parse(list(MS.DIR_PATTERNS), dirname)
+		os.path.abspath(dirname)
+		MS.parse(list(MS.FILE_PATTERNS), os.path.splitext(filename)[0])
+
+def bench(name, func, filenames, repeat, batch=False, results=None):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		if batch:
+			func(filenames)
+		else:
+			for filename in filenames:
+				func(filename)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	if results is not None:
+		results[name] = {'files': len(filenames), 'seconds': best, 'files_per_s': len(filenames) / best}
+	print('{0}: {1} files, {2:.4f}s, {3:.1f} files/s'.format(name, len(filenames), best, len(filenames) / best))
+
+def time_phase(results, name, func, count, repeat, prepare=None):
+	# Keeps the best time of several runs, output of the phase is suppressed.
+	best, result = None, None
+	for _ in range(repeat):
+		data = prepare() if prepare else None
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			result = func(data) if prepare else func()
+			elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	results[name] = {'files': count, 'seconds': best, 'files_per_s': count / best if best else None}
+	print('{0}: {1} files, {2:.4f}s, {3:.1f} files/s'.format(name, count, best, count / best if best else float('inf')))
+	return result
+
+def bench_phases(tmpdir, args):
+	# Runs phases of get_all_data and the import executor separately on a synthetic tree.
+	inbox, root = os.path.join(tmpdir, 'inbox'), os.path.join(tmpdir, 'library')
+	make_synthetic_inbox(inbox, args.albums, args.tracks_per_album)
+	make_synthetic_library(root, args.artists, 3)
+	ms_args = MS.make_arg_parser().parse_args([inbox, '--root_dir', root, '--use_subdirs', '1', '--batch', '--no_cache', '--jobs', str(args.jobs)])
+	MS.default_subdir = SYNTHETIC_GENRES[0]
+	results = {}
+
+	albums = time_phase(results, 'walk', lambda: list(MS.walk_albums(inbox, batch=True, exclude_dirs=[root])), args.albums * args.tracks_per_album, args.repeat)
+	filenames = [filename for album_filenames, _ in albums for filename in album_filenames]
+	count = len(filenames)
+	tags, errors = time_phase(results, 'tag read', lambda: MS.read_all_tags(filenames, MS.get_taginfo_for_file, args.jobs), count, args.repeat)
+	def reencode(tags):
+		for album_filenames, _ in albums:
+			MS.reencode_tags(dict((filename, tags[filename]) for filename in album_filenames), ms_args)
+		return tags
+	MS.encoding_verdicts.clear()
+	tags = time_phase(results, 'reencode', reencode, count, args.repeat, prepare=lambda: (MS.encoding_verdicts.clear(), copy.deepcopy(tags))[1])
+	def repair(tags):
+		for album_filenames, _ in albums:
+			MS.repair_tags(dict((filename, tags[filename]) for filename in album_filenames), ms_args)
+		return tags
+	tags = time_phase(results, 'repair', repair, count, args.repeat, prepare=lambda: copy.deepcopy(tags))
+	def resolve():
+		library = MS.LibraryIndex(root, 3)
+		library.scan()
+		new_filenames = dict((filename, MS.get_new_filename(tags[filename], root, True, library)) for filename in filenames)
+		for new_filename in new_filenames.values():
+			MS.get_exists_path_part(new_filename, library)
+		return new_filenames
+	new_filenames = time_phase(results, 'destination resolve', resolve, count, args.repeat)
+
+	def prepare_import():
+		outdir = tempfile.mkdtemp(dir=tmpdir)
+		tasks = [(filename, os.path.join(outdir, os.path.relpath(new_filenames[filename], root)), tags[filename]) for filename in filenames]
+		for path in set(os.path.dirname(new_filename) for filename, new_filename, taginfo in tasks):
+			os.makedirs(path, exist_ok=True)
+		return tasks
+	def run_executor(tasks):
+		return MS.ImportExecutor(functools.partial(MS.import_file, mode=args.mode), args.jobs).run(tasks)
+	time_phase(results, 'executor ({0})'.format(args.mode), run_executor, count, args.repeat, prepare=prepare_import)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmarks for mediasort")
+	parser.add_argument("--tracks", type=int, default=250, help="Number of tracks to generate")
+	parser.add_argument("--repeat", type=int, default=3, help="Number of repeats (best time is reported)")
+	parser.add_argument("--albums", type=int, default=50, help="Number of albums in the synthetic inbox")
+	parser.add_argument("--tracks_per_album", type=int, default=10, help="Number of tracks per synthetic album")
+	parser.add_argument("--artists", type=int, default=200, help="Number of artists in the synthetic library")
+	parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of parallel jobs for tag read and import")
+	parser.add_argument("--mode", default='copy', choices=MS.IMPORT_MODES, help="Import mode for the executor phase")
+	parser.add_argument("--json", dest="json_file", default=None, help="Write results as JSON to this file ('-' for stdout)")
+	args = parser.parse_args()
+
+	tmpdir = tempfile.mkdtemp()
+	try:
+		phases = bench_phases(tmpdir, args)
+	finally:
+		shutil.rmtree(tmpdir)
+	micro = {}
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filenames = make_inbox(tmpdir, args.tracks)
+		bench('tag read (built-in)', MS.get_taginfo_for_file, filenames, args.repeat, results=micro)
+		if shutil.which('id3v2'):
+			bench('tag read (id3v2 -l)', MS.get_taginfo_with_id3v2_tool, filenames, args.repeat, results=micro)
+		else:
+			print('tag read (id3v2 -l): skipped, id3v2 is not found')
+
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Artist', 'Album', '2001', 1, 'Title'
+		outdir = os.path.join(tmpdir, 'out')
+		os.mkdir(outdir)
+		def copy_with_new_tags(filename):
+			MS.copy_with_new_tags(filename, os.path.join(outdir, os.path.basename(filename)), taginfo)
+		bench('copy and retag (built-in)', copy_with_new_tags, filenames, args.repeat, results=micro)
+		if shutil.which('id3v2'):
+			def copy_and_retag_with_id3v2_tool(filename):
+				new_filename = os.path.join(outdir, os.path.basename(filename))
+				shutil.copyfile(filename, new_filename)
+				MS.retag_with_id3v2_tool(new_filename, taginfo)
+			bench('copy and retag (id3v2)', copy_and_retag_with_id3v2_tool, filenames, args.repeat, results=micro)
+	finally:
+		shutil.rmtree(tmpdir)
+
+	corpus = make_filename_corpus(args.tracks // 10 or 1, 10)
+	bench('filename patterns (uncompiled, per file)', parse_filenames_uncompiled, corpus, args.repeat, batch=True, results=micro)
+	bench('filename patterns (compiled, memoized)', lambda filenames: MS.get_tags_from_filesystem(filenames, MS.FilenamePatterns()), corpus, args.repeat, batch=True, results=micro)
+	def repair_corpus(filenames):
+		tags = {}
+		for filename in filenames:
+			taginfo = MS.TagInfo()
+			taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'some_artist[Discography]', 'some album (Deluxe Edition) - CD 1', '2001', '1', 'some  track_name'
+			tags[filename] = taginfo
+		MS.repair_tags(tags, repair_args)
+	repair_args = MS.make_arg_parser().parse_args(['.', '--root_dir', '.'])
+	bench('repair tags', repair_corpus, corpus, args.repeat, batch=True, results=micro)
+
+	if args.json_file:
+		report = {
+				'params': {'tracks': args.tracks, 'albums': args.albums, 'tracks_per_album': args.tracks_per_album, 'artists': args.artists, 'jobs': args.jobs, 'mode': args.mode, 'repeat': args.repeat},
+				'phases': phases,
+				'micro': micro,
+				}
+		if args.json_file == '-':
+			json.dump(report, sys.stdout, indent=1)
+			print()
+		else:
+			with open(args.json_file, 'w') as f:
+				json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+	main()
@@ -7,8 +7,25 @@ import re
 import chardet
 import itertools
 from functools import reduce
-from collections import defaultdict
+from collections import defaultdict, deque
 import argparse
+import concurrent.futures
+import sqlite3
+import time
+import json
+import errno
+import fcntl
+import threading
+import functools
+import hashlib
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
+import select
+import struct
+import array
+import unicodedata
 
 def get_max_common_beginning(sequences):
 	if not sequences:
@@ -39,23 +56,72 @@ def get_working_dir(args):
 		return args[0]
 	return os.getcwd()
 
-def get_dir_content(dirname):
-	filenames = os.listdir(dirname)
-	mp3_filenames, other_filenames = [], []
-	for filename in filenames:
-		filepath = os.path.join(dirname, filename)
-		root, extension = os.path.splitext(filepath)
-		if extension == '.mp3':
-			mp3_filenames.append(filepath)
-		else:
-			other_filenames.append(filepath)
-	if not mp3_filenames:
-		for filename in filenames:
-			if os.path.isdir(os.path.join(dirname, filename)):
-				mp3, other = get_dir_content(os.path.join(dirname, filename))
-				mp3_filenames += mp3
-				other_filenames += other
-	return mp3_filenames, other_filenames
+class Stats:
+	# Wall and CPU time of run phases and counters of expensive operations
+	# (directory listings, subprocess spawns, copied bytes etc).
+	# CPU time is process-wide, so it includes time of worker threads.
+	def __init__(self):
+		self.phases = {}
+		self.counters = defaultdict(int)
+		self.lock = threading.Lock()
+	def count(self, name, value=1):
+		with self.lock:
+			self.counters[name] += value
+	@contextlib.contextmanager
+	def phase(self, name):
+		wall, cpu = time.perf_counter(), time.process_time()
+		try:
+			yield
+		finally:
+			wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+			with self.lock:
+				phase = self.phases.setdefault(name, {'wall' : 0.0, 'cpu' : 0.0, 'calls' : 0})
+				phase['wall'] += wall
+				phase['cpu'] += cpu
+				phase['calls'] += 1
+	def as_dict(self):
+		with self.lock:
+			return {'phases' : dict((name, dict(phase)) for name, phase in self.phases.items()), 'counters' : dict(self.counters)}
+	def write(self, file, format='text'):
+		data = self.as_dict()
+		if format == 'json':
+			json.dump(data, file, indent=1)
+			file.write('\n')
+			return
+		for name, phase in data['phases'].items():
+			file.write("{0}: {1:.3f}s wall, {2:.3f}s CPU\n".format(name, phase['wall'], phase['cpu']))
+		for name, value in sorted(data['counters'].items()):
+			file.write("{0}: {1}\n".format(name, value))
+
+stats = Stats()
+
+AUDIO_EXTENSIONS = ['mp3', 'flac', 'ogg', 'opus', 'm4a']
+
+def walk_albums(dirname, extensions=('mp3',), batch=False, exclude_dirs=()):
+	# Yields (audio filenames, other filenames) for directories as soon as they are scanned.
+	# In batch mode every directory with audio files is yielded as a separate album,
+	# otherwise subdirectories are scanned only if directory itself has no audio files
+	# (e.g. CD1/, CD2/), and directories without audio files are yielded too.
+	extensions = set('.' + extension.lower().lstrip('.') for extension in extensions)
+	exclude_dirs = set(os.path.realpath(path) for path in exclude_dirs)
+	audio_filenames, other_filenames, subdirs = [], [], []
+	stats.count('scandir')
+	with os.scandir(dirname) as entries:
+		for entry in entries:
+			if entry.is_dir():
+				subdirs.append(entry.path)
+			elif os.path.splitext(entry.name)[1].lower() in extensions:
+				audio_filenames.append(entry.path)
+			else:
+				other_filenames.append(entry.path)
+	if audio_filenames or not batch:
+		yield audio_filenames, other_filenames
+	if audio_filenames and not batch:
+		return
+	for subdir in sorted(subdirs):
+		if exclude_dirs and os.path.realpath(subdir) in exclude_dirs:
+			continue
+		yield from walk_albums(subdir, extensions, batch, exclude_dirs)
 
 def _split_path(path):
 	path, filename = os.path.split(path)
@@ -70,12 +136,202 @@ def _split_path(path):
 			break
 	return dirnames + [filename]
 
-def get_exists_path_part(path):
+# Only English articles by default: "Los Lobos" and "Lobos" could be different artists.
+ARTICLES = ['the', 'a', 'an']
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+def set_articles(articles):
+	global ARTICLE_SUFFIX_PATTERN, ARTICLE_PREFIX_PATTERN
+	articles = '|'.join(re.escape(article.casefold()) for article in articles)
+	ARTICLE_SUFFIX_PATTERN = re.compile(r'^(?P<name>.+), ?(?P<article>{0})$'.format(articles))
+	# Article should be followed by a real space, so "A-ha" is not "ha".
+	ARTICLE_PREFIX_PATTERN = re.compile(r'^(?:{0}) +(?=\S)'.format(articles))
+set_articles(ARTICLES)
+
+def get_artist_key(artist):
+	# "The Beatles", "Beatles, The" and "beatles" have the same key, so have "Motörhead" and "Motorhead".
+	key = ''.join(char for char in unicodedata.normalize('NFKD', artist) if not unicodedata.combining(char)).casefold().strip()
+	match = ARTICLE_SUFFIX_PATTERN.match(key)
+	if match:
+		key = match.group('name')
+	else:
+		key = ARTICLE_PREFIX_PATTERN.sub('', key)
+	return ' '.join(NON_WORD_PATTERN.sub(' ', key.replace('&', ' and ')).split())
+
+def _get_ngrams(key, size=3):
+	key = ' {0} '.format(key)
+	return set(key[index:index + size] for index in range(len(key) - size + 1))
+
+class ArtistIndex:
+	# Artist lookup by normalized key and fuzzy suggestions by common trigrams.
+	# Trigrams shared by too many artists are not used for suggestions,
+	# so lookup cost does not grow with the library size.
+	MAX_POSTINGS = 256
+	def __init__(self):
+		self.values = {} # key: value
+		self.ngrams = defaultdict(set) # trigram: keys
+		self.ngram_counts = {} # key: number of its trigrams
+	def add(self, artist, value):
+		key = get_artist_key(artist) or artist.casefold()
+		if key in self.values:
+			return
+		self.values[key] = value
+		ngrams = _get_ngrams(key)
+		self.ngram_counts[key] = len(ngrams)
+		for ngram in ngrams:
+			self.ngrams[ngram].add(key)
+	def find(self, artist):
+		return self.values.get(get_artist_key(artist) or artist.casefold())
+	def suggest(self, artist, limit=5, min_score=0.4):
+		# Returns [(score, value)] of the most similar artists.
+		key = get_artist_key(artist) or artist.casefold()
+		ngrams = _get_ngrams(key)
+		counts = defaultdict(int)
+		for ngram in ngrams:
+			keys = self.ngrams.get(ngram, ())
+			if len(keys) <= self.MAX_POSTINGS:
+				for candidate in keys:
+					counts[candidate] += 1
+		scores = []
+		for candidate, count in counts.items():
+			score = 2.0 * count / (len(ngrams) + self.ngram_counts[candidate])
+			if score >= min_score:
+				scores.append((score, candidate))
+		scores.sort(key=lambda item: (-item[0], item[1]))
+		return [(score, self.values[candidate]) for score, candidate in scores[:limit]]
+
+class LibraryIndex:
+	def __init__(self, root, depth):
+		self.root = os.path.normpath(root)
+		self.depth = depth
+		self.dirs = {} # path: (mtime_ns, [entry names], [subdir names])
+		self.names = {}
+		self.folded_names = {}
+		self.artists = ArtistIndex()
+	def scan(self, known_dirs=None):
+		if os.path.isdir(self.root):
+			self._scan_dir(self.root, self.depth, known_dirs or {})
+		return self
+	def _scan_dir(self, path, depth, known_dirs):
+		try:
+			mtime_ns = os.stat(path).st_mtime_ns
+		except FileNotFoundError:
+			return
+		if path in known_dirs and known_dirs[path][0] == mtime_ns:
+			names, subdirs = known_dirs[path][1], known_dirs[path][2]
+		else:
+			names, subdirs = [], []
+			stats.count('scandir')
+			with os.scandir(path) as entries:
+				for entry in entries:
+					names.append(entry.name)
+					if entry.is_dir():
+						subdirs.append(entry.name)
+		self._add_dir(path, mtime_ns, names, subdirs)
+		if depth > 1:
+			for subdir in subdirs:
+				self._scan_dir(os.path.join(path, subdir), depth - 1, known_dirs)
+	def refresh(self, path):
+		# Re-lists changed directories from root to path (e.g. created by import) without a full rescan.
+		parts = _split_path(os.path.relpath(os.path.normpath(path), self.root))
+		current = self.root
+		for part in [''] + (parts if parts != ['.'] else [])[:self.depth - 1]:
+			current = os.path.normpath(os.path.join(current, part))
+			self._scan_dir(current, 1, self.dirs)
+	def _add_dir(self, path, mtime_ns, names, subdirs):
+		self.dirs[path] = (mtime_ns, names, subdirs)
+		self.names[path] = set(names)
+		folded_names = {}
+		for name in names:
+			folded_names.setdefault(name.casefold(), name)
+		self.folded_names[path] = folded_names
+		if self.depth > 2 and os.path.dirname(path) == self.root:
+			genre = os.path.basename(path)
+			for artist in subdirs:
+				self.artists.add(artist, (genre, artist))
+	def listdir(self, path):
+		path = os.path.normpath(path)
+		if path not in self.dirs:
+			return None
+		return self.dirs[path][1]
+	def subdirs(self, path):
+		path = os.path.normpath(path)
+		if path not in self.dirs:
+			return None
+		return self.dirs[path][2]
+	def find(self, path, name):
+		# Returns actual name of the entry matched case-insensitively,
+		# '' if there is no such entry or None if path is not indexed.
+		path = os.path.normpath(path)
+		if path not in self.dirs:
+			return None
+		if name in self.names[path]:
+			return name
+		return self.folded_names[path].get(name.casefold(), '')
+	def find_artist(self, artist):
+		return self.artists.find(artist)
+	def suggest_artists(self, artist):
+		return self.artists.suggest(artist)
+
+class AudioHashIndex:
+	# Audio payload hashes of all library files. Only new and changed
+	# (by size and mtime) files are hashed, others are taken from the cache.
+	def __init__(self, root, extensions=('mp3',), exclude_dirs=()):
+		self.root = os.path.normpath(root)
+		self.extensions = set('.' + extension.lower().lstrip('.') for extension in extensions)
+		self.exclude_dirs = set(os.path.realpath(path) for path in exclude_dirs)
+		self.files = {} # path: (size, mtime_ns, hash)
+		self.paths = defaultdict(list) # hash: [paths]
+	def update(self, known_files=None, jobs=1):
+		changed = []
+		if os.path.isdir(self.root):
+			self._scan_dir(self.root, known_files or {}, changed)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+			futures = [(path, size, mtime_ns, executor.submit(get_audio_hash, path)) for path, size, mtime_ns in changed]
+			for path, size, mtime_ns, future in futures:
+				try:
+					self.files[path] = (size, mtime_ns, future.result())
+				except OSError:
+					continue
+		for path, (size, mtime_ns, digest) in sorted(self.files.items()):
+			self.paths[digest].append(path)
+		return self
+	def _scan_dir(self, path, known_files, changed):
+		stats.count('scandir')
+		with os.scandir(path) as entries:
+			for entry in entries:
+				if entry.is_dir():
+					if not self.exclude_dirs or os.path.realpath(entry.path) not in self.exclude_dirs:
+						self._scan_dir(entry.path, known_files, changed)
+				elif os.path.splitext(entry.name)[1].lower() in self.extensions:
+					try:
+						st = entry.stat()
+					except FileNotFoundError:
+						continue
+					known = known_files.get(entry.path)
+					if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+						self.files[entry.path] = known
+					else:
+						changed.append((entry.path, st.st_size, st.st_mtime_ns))
+	def find(self, digest):
+		return self.paths.get(digest, [])
+
+def is_in_directory(path, dirname):
+	dirname = os.path.realpath(dirname)
+	return os.path.commonpath([dirname, os.path.realpath(path)]) == dirname
+
+def get_exists_path_part(path, library=None):
 	existing_path = ''
 	remains = _split_path(path)
 	while remains:
-		if not os.path.exists(os.path.join(existing_path, remains[0])):
+		entry = library.find(existing_path, remains[0]) if library and existing_path else None
+		if entry is not None:
+			if not entry:
+				break
+			remains[0] = entry
+		elif not os.path.exists(os.path.join(existing_path, remains[0])):
 			ok = False
+			stats.count('listdir')
 			for entry in os.listdir(existing_path):
 				if entry.upper() == remains[0].upper():
 					remains[0] = entry
@@ -88,22 +344,19 @@ def get_exists_path_part(path):
 	remains = reduce(os.path.join, remains) if remains else ''
 	return existing_path, remains
 
-def parse(expression_list, string):
-	for expression in expression_list:
-		m = re.match(expression, string)
-		if m:
-			return m.groupdict()
-	return None
-
 # ------
 
 class TagInfo:
+	__slots__ = ['artist', 'album', 'year', 'number', 'title', 'fs_index']
 	def __init__(self):
 		self.artist = ''
 		self.album = ''
 		self.year = 0
 		self.number = 0
 		self.title = ''
+		self.fs_index = None
+
+TAG_FIELDS = ['artist', 'album', 'year', 'number', 'title']
 
 def _get_tag_content(data, regexp):
 	match = re.search(regexp, data, re.MULTILINE)
@@ -111,7 +364,8 @@ def _get_tag_content(data, regexp):
 		return match.group(1)
 	return ''
 
-def get_taginfo_for_file(filename):
+def get_taginfo_with_id3v2_tool(filename):
+	stats.count('subprocess')
 	id3v2_process = subprocess.Popen(['id3v2', '-l', filename], stdout=subprocess.PIPE)
 	id3v2_process.wait()
 	output = id3v2_process.stdout.read()
@@ -127,27 +381,824 @@ def get_taginfo_for_file(filename):
 		taginfo.year = taginfo.year.decode('utf-8')
 	return taginfo
 
-def get_artist_subdir(root_path, artist_dir):
+ID3V2_TAG_FIELDS = {
+		b'TPE1' : 'artist', b'TALB' : 'album', b'TYER' : 'year', b'TDRC' : 'year', b'TRCK' : 'number', b'TIT2' : 'title',
+		b'TP1' : 'artist', b'TAL' : 'album', b'TYE' : 'year', b'TRK' : 'number', b'TT2' : 'title',
+		}
+
+def _syncsafe_int(data):
+	return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def read_id3v2_tag(f):
+	# Returns (version, [(frame_id, frame_flags, frame_body)...], full tag size in bytes).
+	header = f.read(10)
+	if len(header) < 10 or header[:3] != b'ID3' or header[3] not in (2, 3, 4) or any(b & 0x80 for b in header[6:10]):
+		return None, [], 0
+	version, flags = header[3], header[5]
+	data_size = _syncsafe_int(header[6:10])
+	tag_size = 10 + data_size + (10 if version == 4 and flags & 0x10 else 0)
+	data = f.read(data_size)
+	if version < 4 and flags & 0x80:
+		data = data.replace(b'\xff\x00', b'\xff')
+
+	pos = 0
+	if version == 3 and flags & 0x40:
+		pos = 4 + int.from_bytes(data[:4], 'big')
+	elif version == 4 and flags & 0x40:
+		pos = _syncsafe_int(data[:4])
+
+	frames = []
+	frame_header_size = 6 if version == 2 else 10
+	while pos + frame_header_size <= len(data):
+		if data[pos] == 0:
+			break # Padding.
+		if version == 2:
+			frame_id, frame_flags = data[pos:pos+3], 0
+			frame_size = int.from_bytes(data[pos+3:pos+6], 'big')
+		else:
+			frame_id = data[pos:pos+4]
+			if version == 4:
+				frame_size = _syncsafe_int(data[pos+4:pos+8])
+			else:
+				frame_size = int.from_bytes(data[pos+4:pos+8], 'big')
+			frame_flags = int.from_bytes(data[pos+8:pos+10], 'big')
+		pos += frame_header_size
+		frames.append((frame_id, frame_flags, data[pos:pos+frame_size]))
+		pos += frame_size
+	return version, frames, tag_size
+
+def _get_id3v2_frame_body(version, frame_flags, body):
+	if version == 3:
+		if frame_flags & 0x00c0: # Compressed or encrypted.
+			return None
+		if frame_flags & 0x0020: # Grouping identity.
+			body = body[1:]
+	elif version == 4:
+		if frame_flags & 0x000c: # Compressed or encrypted.
+			return None
+		if frame_flags & 0x0040: # Grouping identity.
+			body = body[1:]
+		if frame_flags & 0x0001: # Data length indicator.
+			body = body[4:]
+		if frame_flags & 0x0002: # Unsynchronisation.
+			body = body.replace(b'\xff\x00', b'\xff')
+	return body
+
+def decode_id3v2_text(body):
+	# ISO-8859-1 text is returned as raw bytes, because it is frequently
+	# some other 8-bit codepage in disguise (see reencode_tags).
+	if not body:
+		return b''
+	encoding, data = body[0], body[1:]
+	if encoding == 1:
+		text = data[:len(data) - len(data) % 2].decode('utf-16', 'replace')
+	elif encoding == 2:
+		text = data[:len(data) - len(data) % 2].decode('utf-16-be', 'replace')
+	elif encoding == 3:
+		text = data.decode('utf-8', 'replace')
+	else:
+		return data.split(b'\x00')[0]
+	return text.split('\x00')[0]
+
+def read_id3v1_tag(f):
+	try:
+		f.seek(-128, os.SEEK_END)
+	except OSError:
+		return None
+	data = f.read(128)
+	if len(data) < 128 or data[:3] != b'TAG':
+		return None
+	taginfo = TagInfo()
+	taginfo.title  = data[3:33].split(b'\x00')[0].rstrip()
+	taginfo.artist = data[33:63].split(b'\x00')[0].rstrip()
+	taginfo.album  = data[63:93].split(b'\x00')[0].rstrip()
+	taginfo.year   = data[93:97].split(b'\x00')[0].decode('latin-1').strip()
+	if data[125] == 0 and data[126] != 0:
+		taginfo.number = data[126]
+	return taginfo
+
+def get_taginfo_for_file(filename):
+	taginfo = TagInfo()
+	with open(filename, 'rb') as f:
+		version, frames, tag_size = read_id3v2_tag(f)
+		found = set()
+		for frame_id, frame_flags, body in frames:
+			field = ID3V2_TAG_FIELDS.get(frame_id)
+			if not field or field in found:
+				continue
+			body = _get_id3v2_frame_body(version, frame_flags, body)
+			if body is None:
+				continue
+			value = decode_id3v2_text(body)
+			if not value:
+				continue
+			found.add(field)
+			setattr(taginfo, field, value)
+		if len(found) < len(TAG_FIELDS):
+			v1_taginfo = read_id3v1_tag(f)
+			if v1_taginfo:
+				for field in TAG_FIELDS:
+					if field not in found and getattr(v1_taginfo, field):
+						setattr(taginfo, field, getattr(v1_taginfo, field))
+	if isinstance(taginfo.year, bytes):
+		taginfo.year = taginfo.year.decode('latin-1')
+	if not taginfo.year:
+		taginfo.year = ''
+	if isinstance(taginfo.number, (bytes, str)):
+		taginfo.number = taginfo.number.split(b'/' if isinstance(taginfo.number, bytes) else '/')[0]
+	return taginfo
+
+ID3V2_PADDING = 2048
+
+# Frame ids of artist, album, title, year and number for every ID3v2 version.
+ID3V2_FRAME_IDS = {
+		2 : [b'TP1', b'TAL', b'TT2', b'TYE', b'TRK'],
+		3 : [b'TPE1', b'TALB', b'TIT2', b'TYER', b'TRCK'],
+		4 : [b'TPE1', b'TALB', b'TIT2', b'TDRC', b'TRCK'],
+		}
+
+def _syncsafe_bytes(value):
+	return bytes([(value >> 21) & 0x7f, (value >> 14) & 0x7f, (value >> 7) & 0x7f, value & 0x7f])
+
+def _make_id3v2_frame(frame_id, frame_flags, body, version=3):
+	if version == 2:
+		return frame_id + len(body).to_bytes(3, 'big') + body
+	size = _syncsafe_bytes(len(body)) if version == 4 else len(body).to_bytes(4, 'big')
+	return frame_id + size + frame_flags.to_bytes(2, 'big') + body
+
+def _make_id3v2_text_frame(frame_id, text, version=3):
+	# Non-ASCII text is never written as ISO-8859-1: it would be taken for
+	# an unknown codepage when read back (see decode_id3v2_text).
+	if text.isascii():
+		body = b'\x00' + text.encode('ascii')
+	else:
+		body = b'\x01' + text.encode('utf-16')
+	return _make_id3v2_frame(frame_id, 0, body, version)
+
+def get_id3v2_frame_values(taginfo, version=3):
+	values = [taginfo.artist, taginfo.album, taginfo.title, taginfo.year, '{0:0>2}'.format(taginfo.number) if taginfo.number else '']
+	return [(frame_id, str(value)) for frame_id, value in zip(ID3V2_FRAME_IDS[version], values) if value]
+
+def _is_discarded_on_tag_change(version, frame_flags):
+	return (version == 3 and frame_flags & 0x8000) or (version == 4 and frame_flags & 0x4000)
+
+def make_id3v2_tag(taginfo, padding=ID3V2_PADDING, version=3, frames=()):
+	# Frames of existing tag (see read_id3v2_tag) are kept in the same version of tag,
+	# except those that are replaced by taginfo values.
+	new_frames = [_make_id3v2_text_frame(frame_id, value, version) for frame_id, value in get_id3v2_frame_values(taginfo, version)]
+	new_frames += [_make_id3v2_frame(frame_id, frame_flags, body, version) for frame_id, frame_flags, body in frames if frame_id not in ID3V2_TAG_FIELDS and not _is_discarded_on_tag_change(version, frame_flags)]
+	data = b''.join(new_frames) + b'\x00' * padding
+	return b'ID3' + bytes([version, 0, 0]) + _syncsafe_bytes(len(data)) + data
+
+def get_audio_payload_range(f):
+	# Returns (start, end) offsets of audio data without leading ID3v2 and trailing ID3v1 tags.
+	f.seek(0, os.SEEK_END)
+	end = f.tell()
+	start = 0
+	while start < end:
+		f.seek(start)
+		version, frames, tag_size = read_id3v2_tag(f)
+		if not tag_size:
+			break
+		start += tag_size
+	if end - start >= 128:
+		f.seek(end - 128)
+		if f.read(3) == b'TAG':
+			end -= 128
+	return start, end
+
+COPY_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSOCK)
+
+def copy_file_range(src_fd, dst_fd, offset, count):
+	# Copies count bytes starting at src offset to the current position of dst,
+	# using in-kernel copying when possible.
+	copied = 0
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while copied < count:
+				sent = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied)
+				if not sent:
+					break
+				copied += sent
+		except OSError as e:
+			if e.errno not in COPY_UNSUPPORTED_ERRORS:
+				raise
+	if copied < count and hasattr(os, 'sendfile'):
+		try:
+			while copied < count:
+				sent = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+				if not sent:
+					break
+				copied += sent
+		except OSError as e:
+			if e.errno not in COPY_UNSUPPORTED_ERRORS:
+				raise
+	if copied < count:
+		os.lseek(src_fd, offset + copied, os.SEEK_SET)
+		while copied < count:
+			data = os.read(src_fd, min(1024 * 1024, count - copied))
+			if not data:
+				break
+			while data:
+				written = os.write(dst_fd, data)
+				data = data[written:]
+				copied += written
+	stats.count('bytes_copied', copied)
+	return copied
+
+def copy_with_new_tags(filename, new_filename, taginfo, padding=ID3V2_PADDING, keep_frames=False):
+	# With keep_frames other frames of ID3v2 tag and ID3v1 tag are kept, otherwise they are dropped.
+	with open(filename, 'rb') as src:
+		version, frames, tag_size = read_id3v2_tag(src) if keep_frames else (None, [], 0)
+		start, end = get_audio_payload_range(src)
+		src.seek(end)
+		trailer = src.read() if keep_frames else b''
+		with open(new_filename, 'wb') as dst:
+			dst.write(make_id3v2_tag(taginfo, padding, version or 3, frames))
+			dst.flush()
+			copied = copy_file_range(src.fileno(), dst.fileno(), start, end - start)
+			dst.seek(0, os.SEEK_END)
+			dst.write(trailer)
+	if copied < end - start:
+		raise IOError("{0}: copied only {1} of {2} bytes".format(filename, copied, end - start))
+	return copied
+
+def has_same_tags(filename, taginfo):
+	with open(filename, 'rb') as f:
+		version, frames, tag_size = read_id3v2_tag(f)
+		start, end = get_audio_payload_range(f)
+		if start != tag_size or end != f.seek(0, os.SEEK_END):
+			return False
+	current_values = []
+	for frame_id, frame_flags, body in frames:
+		body = _get_id3v2_frame_body(version, frame_flags, body)
+		if body is None or not frame_id.startswith(b'T'):
+			return False
+		value = decode_id3v2_text(body)
+		current_values.append((frame_id, value.decode('latin-1') if isinstance(value, bytes) else value))
+	return sorted(current_values) == sorted(get_id3v2_frame_values(taginfo))
+
+def get_id3v2_tag_values(filename):
+	# Returns {field: text} of frames written by mediasort, ISO-8859-1 text is decoded as is.
+	# Values are keyed by field, since the same field has different frame ids in different versions.
+	# Returns None if some of these frames cannot be read.
+	with open(filename, 'rb') as f:
+		version, frames, tag_size = read_id3v2_tag(f)
+	values = {}
+	for frame_id, frame_flags, body in frames:
+		field = ID3V2_TAG_FIELDS.get(frame_id)
+		if not field or field in values:
+			continue
+		body = _get_id3v2_frame_body(version, frame_flags, body)
+		if body is None:
+			return None
+		value = decode_id3v2_text(body)
+		if value:
+			values[field] = value.decode('latin-1') if isinstance(value, bytes) else value
+	return values
+
+def get_tag_values(taginfo):
+	return dict((ID3V2_TAG_FIELDS[frame_id], value) for frame_id, value in get_id3v2_frame_values(taginfo))
+
+def has_same_tag_values(filename, taginfo):
+	# Unlike has_same_tags, only values of frames written by mediasort are compared,
+	# other frames and ID3v1 tag do not make the file to be rewritten.
+	return get_id3v2_tag_values(filename) == get_tag_values(taginfo)
+
+def update_tags_in_place(filename, taginfo, keep_frames=False):
+	# Overwrites existing ID3v2 tag if the new one fits into its space (with padding),
+	# so the file is not rewritten. Returns False if it does not fit.
+	with open(filename, 'r+b') as f:
+		version, frames, tag_size = read_id3v2_tag(f)
+		start, end = get_audio_payload_range(f)
+		if not keep_frames:
+			version, frames = 3, []
+		new_tag = make_id3v2_tag(taginfo, 0, version or 3, frames)
+		if not tag_size or start != tag_size or len(new_tag) > tag_size:
+			return False
+		f.seek(0)
+		f.write(make_id3v2_tag(taginfo, tag_size - len(new_tag), version, frames))
+		if not keep_frames and end != f.seek(0, os.SEEK_END):
+			f.truncate(end)
+	return True
+
+def retag_in_place(filename, taginfo, keep_frames=False):
+	if update_tags_in_place(filename, taginfo, keep_frames):
+		return
+	temp_filename = filename + '.mediasort-tmp'
+	try:
+		copy_with_new_tags(filename, temp_filename, taginfo, keep_frames=keep_frames)
+		shutil.copymode(filename, temp_filename)
+		os.replace(temp_filename, filename)
+	finally:
+		if os.path.exists(temp_filename):
+			os.remove(temp_filename)
+
+FICLONE = 0x40049409
+
+def reflink_file(filename, new_filename):
+	with open(filename, 'rb') as src:
+		with open(new_filename, 'wb') as dst:
+			fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+HARDLINK_UNSUPPORTED_ERRORS = (errno.EPERM, errno.EMLINK, errno.EXDEV, errno.EOPNOTSUPP)
+
+def hardlink_file(filename, new_filename):
+	# Replaces new_filename by a hardlink atomically, returns False if it is not possible there.
+	temp_filename = new_filename + '.mediasort-tmp'
+	try:
+		os.link(filename, temp_filename)
+		os.replace(temp_filename, new_filename)
+		return True
+	except OSError as e:
+		if os.path.lexists(temp_filename):
+			os.remove(temp_filename)
+		if e.errno not in HARDLINK_UNSUPPORTED_ERRORS:
+			raise
+		return False
+
+def tags_fit_in_place(filename, taginfo):
+	with open(filename, 'rb') as f:
+		version, frames, tag_size = read_id3v2_tag(f)
+		start, end = get_audio_payload_range(f)
+	return tag_size and start == tag_size and len(make_id3v2_tag(taginfo, padding=0)) <= tag_size
+
+IMPORT_MODES = ['copy', 'move', 'hardlink', 'reflink']
+
+# ID3 tags are written only to MP3 files, other formats are placed as is.
+RETAGGED_EXTENSIONS = ['.mp3']
+
+def is_retagged(filename):
+	return os.path.splitext(filename)[1].lower() in RETAGGED_EXTENSIONS
+
+def place_file(filename, new_filename, mode='copy'):
+	# Places file to the new location without changing its content.
+	same_device = mode != 'copy' and os.stat(filename).st_dev == os.stat(os.path.dirname(new_filename) or '.').st_dev
+	if mode == 'move' and same_device:
+		os.rename(filename, new_filename)
+		return 'move'
+	if mode == 'hardlink' and same_device and hardlink_file(filename, new_filename):
+		return 'hardlink'
+	if mode in ('hardlink', 'reflink') and same_device:
+		try:
+			reflink_file(filename, new_filename)
+			return 'reflink'
+		except OSError as e:
+			if e.errno not in COPY_UNSUPPORTED_ERRORS + (errno.ENOTTY,):
+				raise
+	shutil.copyfile(filename, new_filename)
+	stats.count('bytes_copied', os.path.getsize(new_filename))
+	if mode == 'move':
+		os.remove(filename)
+	return 'copy'
+
+def import_file(filename, new_filename, taginfo, mode='copy'):
+	# Places file to the new location with new tags using the cheapest operation
+	# that is possible for the given mode. Shared inodes (hardlinks) are never retagged,
+	# reflinked copies are separate inodes and are safe to be changed in place.
+	# Returns the name of actually performed operation.
+	if not is_retagged(filename):
+		return place_file(filename, new_filename, mode)
+	same_device = mode != 'copy' and os.stat(filename).st_dev == os.stat(os.path.dirname(new_filename) or '.').st_dev
+	if mode == 'move':
+		if same_device:
+			os.rename(filename, new_filename)
+			retag_in_place(new_filename, taginfo)
+			return 'move'
+		copy_with_new_tags(filename, new_filename, taginfo)
+		os.remove(filename)
+		return 'copy'
+	if mode == 'hardlink' and same_device and has_same_tags(filename, taginfo) and hardlink_file(filename, new_filename):
+		return 'hardlink'
+	if mode in ('hardlink', 'reflink') and same_device and tags_fit_in_place(filename, taginfo):
+		try:
+			reflink_file(filename, new_filename)
+			if update_tags_in_place(new_filename, taginfo):
+				return 'reflink'
+		except OSError as e:
+			if e.errno not in COPY_UNSUPPORTED_ERRORS + (errno.ENOTTY,):
+				raise
+	copy_with_new_tags(filename, new_filename, taginfo)
+	return 'copy'
+
+def retag_with_id3v2_tool(filename, taginfo, keep_frames=False):
+	if not keep_frames:
+		stats.count('subprocess')
+		subprocess.check_call(["id3v2", "-D", filename])
+	stats.count('subprocess')
+	args = ["id3v2"]
+	args += ["-2"]
+	args += ["-a", taginfo.artist]
+	args += ["-A", taginfo.album]
+	args += ["-t", taginfo.title]
+	args += ["-y", taginfo.year]
+	args += ["-T", '{0:0>2}'.format(taginfo.number)]
+	args += [filename]
+	subprocess.check_call(args)
+
+def import_file_with_id3v2_tool(filename, new_filename, taginfo, mode='copy'):
+	if not is_retagged(filename):
+		return place_file(filename, new_filename, mode)
+	if mode == 'move':
+		shutil.move(filename, new_filename)
+	else:
+		shutil.copyfile(filename, new_filename)
+		stats.count('bytes_copied', os.path.getsize(new_filename))
+	#print("Copied file: {0} -> {1}".format(filename, new_filename))
+	retag_with_id3v2_tool(new_filename, taginfo)
+	return mode if mode == 'move' else 'copy'
+
+ROTATIONAL_DEVICE_JOBS = 1
+
+def is_rotational_device(st_dev):
+	sys_path = '/sys/dev/block/{0}:{1}'.format(os.major(st_dev), os.minor(st_dev))
+	# Partitions have no queue settings, they are in the parent device dir.
+	for queue_dir in [os.path.join(sys_path, 'queue'), os.path.join(sys_path, '..', 'queue')]:
+		try:
+			with open(os.path.join(queue_dir, 'rotational')) as f:
+				return f.read().strip() == '1'
+		except OSError:
+			continue
+	return False
+
+class ImportExecutor:
+	# Runs imports of several files simultaneously, limiting number of
+	# simultaneous imports per device, so spinning disks are not thrashed.
+	def __init__(self, import_func, jobs=1, show_progress=False, on_done=None):
+		self.import_func = import_func
+		self.jobs = max(1, jobs)
+		self.show_progress = show_progress
+		self.on_done = on_done
+		self.device_locks = {}
+	def get_device_lock(self, path):
+		st_dev = os.stat(path).st_dev
+		if st_dev not in self.device_locks:
+			jobs = ROTATIONAL_DEVICE_JOBS if is_rotational_device(st_dev) else self.jobs
+			self.device_locks[st_dev] = threading.BoundedSemaphore(jobs)
+		return st_dev, self.device_locks[st_dev]
+	def _import(self, filename, new_filename, taginfo, locks):
+		for lock in locks:
+			lock.acquire()
+		try:
+			return self.import_func(filename, new_filename, taginfo)
+		finally:
+			for lock in reversed(locks):
+				lock.release()
+	def _print_progress(self, done, total, total_bytes, start, final=False):
+		elapsed = max(time.monotonic() - start, 1e-6)
+		line = "Imported {0}/{1} files, {2:.1f} MB in {3:.1f}s ({4:.1f} files/s, {5:.1f} MB/s)".format(done, total, total_bytes / 1024 / 1024, elapsed, done / elapsed, total_bytes / 1024 / 1024 / elapsed)
+		if final:
+			print(line)
+		elif self.show_progress:
+			print(line, end='\r', flush=True)
+	def run(self, tasks):
+		# Tasks are (filename, new_filename, taginfo). Returns list of (filename, exception) for failed ones.
+		errors = []
+		start = time.monotonic()
+		done, total_bytes = 0, 0
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+		try:
+			futures = {}
+			for filename, new_filename, taginfo in tasks:
+				try:
+					size = os.path.getsize(filename)
+					locks = dict([self.get_device_lock(filename), self.get_device_lock(os.path.dirname(new_filename) or '.')])
+				except OSError as e: # File vanished or is not readable.
+					errors.append((filename, e))
+					continue
+				locks = [locks[st_dev] for st_dev in sorted(locks)] # Ordered to prevent deadlocks.
+				future = executor.submit(self._import, filename, new_filename, taginfo, locks)
+				futures[future] = (filename, new_filename, size)
+			for future in concurrent.futures.as_completed(futures):
+				filename, new_filename, size = futures[future]
+				try:
+					future.result()
+					total_bytes += size
+					if self.on_done:
+						self.on_done(filename, new_filename)
+				except Exception as e:
+					errors.append((filename, e))
+				done += 1
+				self._print_progress(done, len(futures), total_bytes, start)
+		finally:
+			# On Ctrl-C or other fatal errors only already running imports are finished.
+			executor.shutdown(wait=True, cancel_futures=True)
+		self._print_progress(done, len(futures), total_bytes, start, final=True)
+		return errors
+
+def get_tag_hash(filename):
+	with open(filename, 'rb') as f:
+		version, frames, tag_size = read_id3v2_tag(f)
+	digest = hashlib.sha1()
+	for frame_id, frame_flags, body in frames:
+		digest.update(frame_id + len(body).to_bytes(4, 'big') + body)
+	return digest.hexdigest()
+
+def get_audio_hash(filename):
+	# Hash of audio payload only, so retagged copies of the same file have the same hash.
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		start, end = get_audio_payload_range(f)
+		f.seek(start)
+		remains = end - start
+		while remains > 0:
+			data = f.read(min(1024 * 1024, remains))
+			if not data:
+				break
+			digest.update(data)
+			remains -= len(data)
+	stats.count('audio_hashed')
+	return digest.hexdigest()
+
+def get_journal_dir():
+	data_dir = os.environ.get('XDG_DATA_HOME')
+	if not data_dir:
+		data_dir = os.path.join(os.path.expanduser("~"), ".local", "share")
+	return os.path.join(data_dir, "mediasort", "journals")
+
+def get_new_journal_filename():
+	# Several imports could be done in one second by watch mode.
+	filename = os.path.join(get_journal_dir(), time.strftime('%Y%m%d-%H%M%S') + '-{0}'.format(os.getpid()))
+	new_filename, index = filename + '.journal', 1
+	while os.path.exists(new_filename):
+		index += 1
+		new_filename = '{0}-{1}.journal'.format(filename, index)
+	return new_filename
+
+class ImportJournal:
+	# Journal is a JSON-lines file:
+	#   {"type": "plan", "mode": ...} - header;
+	#   {"type": "file", "index": ..., "source": ..., "destination": ..., "tags": {...}} - planned imports;
+	#   {"type": "done", "index": ..., "size": ..., "tag_hash": ...} - completed imports.
+	# Completion records are synced to disk in batches.
+	SYNC_EVERY = 64
+	SYNC_INTERVAL = 1.0
+	def __init__(self, filename, entries):
+		self.filename = filename
+		self.indices = dict((entry['source'], entry['index']) for entry in entries)
+		self.f = open(filename, 'a')
+		self.pending = 0
+		self.last_sync = time.monotonic()
+	@classmethod
+	def create(cls, filename, tasks, mode):
+		os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+		entries = []
+		for index, (source, destination, taginfo) in enumerate(tasks):
+			entries.append({'type' : 'file', 'index' : index, 'source' : os.path.abspath(source), 'destination' : os.path.abspath(destination), 'tags' : dict((field, getattr(taginfo, field)) for field in TAG_FIELDS)})
+		with open(filename, 'w') as f:
+			f.write(json.dumps({'type' : 'plan', 'mode' : mode, 'created' : time.time()}) + '\n')
+			for entry in entries:
+				f.write(json.dumps(entry) + '\n')
+			f.flush()
+			os.fsync(f.fileno())
+		return cls(filename, entries)
+	@staticmethod
+	def load(filename):
+		# Returns (header, plan entries, [(source, destination, taginfo, done record or None)...]).
+		header, entries, done = None, [], {}
+		with open(filename, 'r') as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue # Last record could be incomplete after crash.
+				if record['type'] == 'plan':
+					header = record
+				elif record['type'] == 'file':
+					entries.append(record)
+				elif record['type'] == 'done':
+					done[record['index']] = record
+		tasks = []
+		for entry in entries:
+			taginfo = TagInfo()
+			for field in TAG_FIELDS:
+				setattr(taginfo, field, entry['tags'][field])
+			tasks.append((entry['source'], entry['destination'], taginfo, done.get(entry['index'])))
+		return header, entries, tasks
+	def record_done(self, source, destination):
+		record = {'type' : 'done', 'index' : self.indices[os.path.abspath(source)], 'size' : os.path.getsize(destination), 'tag_hash' : get_tag_hash(destination)}
+		self.f.write(json.dumps(record) + '\n')
+		self.pending += 1
+		if self.pending >= self.SYNC_EVERY or time.monotonic() - self.last_sync >= self.SYNC_INTERVAL:
+			self.sync()
+	def sync(self):
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.pending = 0
+		self.last_sync = time.monotonic()
+	def close(self):
+		self.sync()
+		self.f.close()
+
+def is_import_done(source, destination, taginfo, done_record, mode='move'):
+	if not os.path.exists(destination):
+		return False
+	if done_record:
+		return os.path.getsize(destination) == done_record['size'] and get_tag_hash(destination) == done_record['tag_hash']
+	# Completion record could be lost before sync, while source was already moved.
+	# Other modes keep sources, so destination without record could be incomplete.
+	return mode == 'move' and not os.path.exists(source) and (not is_retagged(destination) or has_same_tags(destination, taginfo))
+
+def run_import(tasks, args, journal=None):
+	for path in sorted(set(os.path.dirname(new_filename) for filename, new_filename, taginfo in tasks)):
+		if not os.path.exists(path):
+			os.makedirs(path)
+			print("Path created: {0}".format(path))
+	import_func = import_file_with_id3v2_tool if args.USE_ID3V2_TOOL else import_file
+	executor = ImportExecutor(functools.partial(import_func, mode=args.MODE), args.JOBS, show_progress=sys.stdout.isatty(), on_done=journal.record_done if journal else None)
+	try:
+		with stats.phase('import'):
+			errors = executor.run(tasks)
+	finally:
+		if journal:
+			journal.close()
+	if errors:
+		print("Failed to import:")
+		for filename, e in errors:
+			print('\t{0}: {1}'.format(filename, e))
+		if journal:
+			print("Run with --resume {0} to retry.".format(journal.filename))
+	return errors
+
+def resume_import(args):
+	header, entries, tasks = ImportJournal.load(args.RESUME)
+	args.MODE = header['mode']
+	unfinished, errors = [], []
+	for source, destination, taginfo, done_record in tasks:
+		if is_import_done(source, destination, taginfo, done_record, args.MODE):
+			continue
+		if not os.path.exists(source) and os.path.exists(destination):
+			if args.MODE != 'move':
+				errors.append((source, IOError(errno.ENOENT, "Source is missing, destination could be incomplete", destination)))
+				continue
+			# Crashed between moving file and writing its tags.
+			try:
+				retag_in_place(destination, taginfo)
+			except Exception as e:
+				errors.append((source, e))
+			continue
+		unfinished.append((source, destination, taginfo))
+	print("Resuming import: {0} of {1} files are already done.".format(len(tasks) - len(unfinished) - len(errors), len(tasks)))
+	if errors:
+		print("Failed to resume:")
+		for filename, e in errors:
+			print('\t{0}: {1}'.format(filename, e))
+	if unfinished:
+		errors += run_import(unfinished, args, ImportJournal(args.RESUME, entries))
+	if not errors:
+		os.remove(args.RESUME)
+	return errors
+
+def get_cache_dir():
+	cache_dir = os.environ.get('XDG_CACHE_HOME')
+	if not cache_dir:
+		cache_dir = os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(cache_dir, "mediasort")
+
+class TagCache:
+	MAX_AGE = 180 * 24 * 60 * 60
+	MAX_SIZE = 64 * 1024 * 1024
+	def __init__(self, filename, rebuild=False):
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		self.db = sqlite3.connect(filename)
+		self.db.execute('CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, reader TEXT, artist, album, year, number, title, used REAL, entry_size INTEGER)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS library_dirs (root TEXT, path TEXT, mtime_ns INTEGER, names TEXT, subdirs TEXT, PRIMARY KEY (root, path))')
+		self.db.execute('CREATE TABLE IF NOT EXISTS audio_hashes (root TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, hash TEXT, PRIMARY KEY (root, path))')
+		# Albums imported from the watched inbox are not a cache: they are kept on rebuild.
+		self.db.execute('CREATE TABLE IF NOT EXISTS imported_albums (path TEXT PRIMARY KEY, mtime_ns INTEGER)')
+		if rebuild:
+			self.db.execute('DELETE FROM tags')
+			self.db.execute('DELETE FROM library_dirs')
+			self.db.execute('DELETE FROM audio_hashes')
+		self.now = time.time()
+	def _get_key(self, filename):
+		st = os.stat(filename)
+		return (os.path.abspath(filename), st.st_size, st.st_mtime_ns, st.st_ino)
+	def get(self, filename, reader):
+		path, size, mtime_ns, inode = self._get_key(filename)
+		row = self.db.execute('SELECT artist, album, year, number, title FROM tags WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ? AND reader = ?', (path, size, mtime_ns, inode, reader)).fetchone()
+		if row is None:
+			return None
+		self.db.execute('UPDATE tags SET used = ? WHERE path = ?', (self.now, path))
+		taginfo = TagInfo()
+		for field, value in zip(TAG_FIELDS, row):
+			setattr(taginfo, field, value)
+		return taginfo
+	def put(self, filename, reader, taginfo):
+		key = self._get_key(filename)
+		values = [getattr(taginfo, field) for field in TAG_FIELDS]
+		entry_size = 64 + len(key[0]) + sum(len(value) if isinstance(value, (bytes, str)) else 8 for value in values)
+		self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', key + (reader,) + tuple(values) + (self.now, entry_size))
+	def get_library_dirs(self, root):
+		rows = self.db.execute('SELECT path, mtime_ns, names, subdirs FROM library_dirs WHERE root = ?', (os.path.abspath(root),))
+		return dict((os.path.normpath(os.path.join(root, path)), (mtime_ns, json.loads(names), json.loads(subdirs))) for path, mtime_ns, names, subdirs in rows)
+	def put_library_dirs(self, root, dirs):
+		self.db.execute('DELETE FROM library_dirs WHERE root = ?', (os.path.abspath(root),))
+		self.db.executemany('INSERT INTO library_dirs VALUES (?, ?, ?, ?, ?)', ((os.path.abspath(root), os.path.relpath(path, root), mtime_ns, json.dumps(names), json.dumps(subdirs)) for path, (mtime_ns, names, subdirs) in dirs.items()))
+	def get_audio_hashes(self, root):
+		rows = self.db.execute('SELECT path, size, mtime_ns, hash FROM audio_hashes WHERE root = ?', (os.path.abspath(root),))
+		return dict((os.path.normpath(os.path.join(root, path)), (size, mtime_ns, digest)) for path, size, mtime_ns, digest in rows)
+	def put_audio_hashes(self, root, files):
+		self.db.execute('DELETE FROM audio_hashes WHERE root = ?', (os.path.abspath(root),))
+		self.db.executemany('INSERT INTO audio_hashes VALUES (?, ?, ?, ?, ?)', ((os.path.abspath(root), os.path.relpath(path, root), size, mtime_ns, digest) for path, (size, mtime_ns, digest) in files.items()))
+	def get_imported_albums(self):
+		return dict(self.db.execute('SELECT path, mtime_ns FROM imported_albums'))
+	def put_imported_album(self, path, mtime_ns):
+		self.db.execute('INSERT OR REPLACE INTO imported_albums VALUES (?, ?)', (os.path.abspath(path), mtime_ns))
+	def evict(self, max_age=MAX_AGE, max_size=MAX_SIZE):
+		self.db.execute('DELETE FROM tags WHERE used < ?', (self.now - max_age,))
+		# Entries of one run share the same time of use, so they are ordered by rowid too:
+		# only entries beyond the size limit are deleted, not the whole last run.
+		total_size = 0
+		for index, (entry_size,) in enumerate(self.db.execute('SELECT entry_size FROM tags ORDER BY used DESC, rowid DESC').fetchall()):
+			total_size += entry_size
+			if total_size > max_size:
+				self.db.execute('DELETE FROM tags WHERE rowid IN (SELECT rowid FROM tags ORDER BY used DESC, rowid DESC LIMIT -1 OFFSET ?)', (index,))
+				break
+	def close(self):
+		self.evict()
+		self.db.commit()
+		self.db.close()
+
+def _submit_tag_reads(executor, filenames, read_taginfo, cache, errors):
+	# Returns [(filename, cached taginfo or None, future or None)].
+	reader = read_taginfo.__name__
+	results = []
+	for filename in filenames:
+		try:
+			taginfo = cache.get(filename, reader) if cache else None
+		except OSError as e: # File vanished or is not readable.
+			errors.append((filename, e))
+			continue
+		future = executor.submit(read_taginfo, filename) if taginfo is None else None
+		stats.count('tags_read' if future else 'tag_cache_hits')
+		results.append((filename, taginfo, future))
+	return results
+
+def _collect_tag_reads(results, read_taginfo, cache, tags, errors):
+	reader = read_taginfo.__name__
+	for filename, taginfo, future in results:
+		if future is None:
+			tags[filename] = taginfo
+			continue
+		try:
+			tags[filename] = future.result()
+		except Exception as e:
+			errors.append((filename, e))
+			continue
+		if cache:
+			try:
+				cache.put(filename, reader, tags[filename])
+			except OSError:
+				pass # File vanished after reading, tags are not cached then.
+
+def read_all_tags(filenames, read_taginfo, jobs=1, cache=None):
+	# Filenames may be a generator: files are submitted for reading as soon as they are found.
+	tags, errors = {}, []
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+		results = _submit_tag_reads(executor, filenames, read_taginfo, cache, errors)
+		_collect_tag_reads(results, read_taginfo, cache, tags, errors)
+	return tags, errors
+
+def get_artist_subdir(root_path, artist_dir, library=None):
+	if library:
+		return library.find_artist(artist_dir) or ('', artist_dir)
+	stats.count('listdir')
 	for entry in os.listdir(root_path):
 		full_entry_path = os.path.join(root_path, entry)
 		if not os.path.isdir(full_entry_path):
 			continue
+		stats.count('listdir')
 		for artist in os.listdir(full_entry_path):
-			if artist.lower() == artist_dir.lower():
+			if get_artist_key(artist) == get_artist_key(artist_dir):
 				return entry, artist
 	return '', artist_dir
 
 default_subdir = None
-def get_new_filename(taginfo, root_path, use_subdirs):
+def get_new_filename(taginfo, root_path, use_subdirs, library=None, extension='.mp3', ask=True):
 	global default_subdir
 	artist_dir = taginfo.artist
 	album_dir  = '{0}-{1}'.format(taginfo.year, taginfo.album)
-	filename   = '{0:0>2}-{1}.mp3'.format(taginfo.number, taginfo.title).replace('/', '-')
+	filename   = '{0:0>2}-{1}{2}'.format(taginfo.number, taginfo.title, extension).replace('/', '-')
 	if use_subdirs:
-		artist_subdir, artist_dir = get_artist_subdir(root_path, artist_dir)
+		artist_subdir, artist_dir = get_artist_subdir(root_path, artist_dir, library)
+		if not artist_subdir and library and not default_subdir and ask:
+			suggestions = library.suggest_artists(taginfo.artist)
+			if suggestions:
+				print("Cannot find {0} in the library, similar artists:".format(taginfo.artist))
+				for index, (score, (subdir, artist)) in enumerate(suggestions):
+					print('{0}: {1} ({2:.0%})'.format(index, os.path.join(subdir, artist), score))
+				answer = input('Which artist (empty for none of them)?')
+				if answer.isdigit() and int(answer) in range(len(suggestions)):
+					artist_subdir, artist_dir = suggestions[int(answer)][1]
+					# Remembered for the rest of tracks of this artist.
+					library.artists.add(taginfo.artist, (artist_subdir, artist_dir))
 		if not artist_subdir:
 			if not default_subdir:
-				subdirs = os.listdir(root_path)
+				subdirs = library.listdir(root_path) if library else None
+				if subdirs is None:
+					stats.count('listdir')
+					subdirs = os.listdir(root_path)
 				print("Cannot determine subdir for {0}.".format(taginfo.artist))
 				for index, subdir in enumerate(subdirs):
 					print('{0}: {1}'.format(index, subdir))
@@ -165,7 +1216,81 @@ def get_new_filename(taginfo, root_path, use_subdirs):
 		return os.path.join(root_path, artist_dir, album_dir, filename)
 
 
-def get_tags_from_filesystem(filepaths):
+DIR_PATTERNS = [
+		r'(?P<artist>.+) ?- ?(?P<year>[0-9]+) ?- ?(?P<album>.+)',
+		r'(?P<artist>.+) ?\[(?P<year>[0-9]+)\] ?(?P<album>.+)',
+		r'(?P<artist>.+) ?- ?(?P<album>.+) - \(?(?P<year>[0-9]{4})\)?',
+		r'(?P<artist>.+) ?- ?(?P<album>.+) \(?(?P<year>[0-9]{4})\)?',
+		r'(?P<artist>.+) ?- ?(?P<album>.+) \((?P<year>[0-9]{4})( - Advance)?\)',
+		r'\[?(?P<year>[0-9]+)\]? ?- ?(?P<album>.+)',
+		r'(?P<year>[0-9]+)_(?P<album>.+)',
+		r'(?P<year>[0-9]+). *(?P<album>.+)',
+		r'(?P<artist>.+) ?- ?(?P<album>.+)',
+		r'(?P<album>.+)'
+		]
+
+FILE_PATTERNS = [
+		r'(?P<number>[0-9]+) ?- ?(?P<title>.+)',
+		r'(?P<number>[0-9]+)\.(?P<title>.+)',
+		r'(?P<number>[0-9]+)_(?P<title>.+)',
+		r'(?P<number>[0-9]+) (?P<title>.+)',
+		r'(?P<number>[0-9]+)(?P<title>.+)',
+		r'(?P<title>.+)'
+		]
+
+class FilenamePatterns:
+	# Patterns are compiled once, dirname parsing results are memoized,
+	# since all tracks of an album share the same dirname.
+	def __init__(self, dir_patterns=DIR_PATTERNS, file_patterns=FILE_PATTERNS):
+		self.dir_patterns = [self._compile(pattern, ['artist', 'year', 'album']) for pattern in dir_patterns]
+		self.file_patterns = [self._compile(pattern, ['number', 'title']) for pattern in file_patterns]
+		self.dirs = {}
+	def _compile(self, pattern, fields):
+		regex = re.compile(pattern)
+		unknown_fields = set(regex.groupindex) - set(fields)
+		if unknown_fields:
+			raise ValueError("Unknown fields in pattern {0}: {1}".format(repr(pattern), ', '.join(sorted(unknown_fields))))
+		return regex
+	def _parse(self, regexes, string):
+		for regex in regexes:
+			m = regex.match(string)
+			if m:
+				return m.groupdict()
+		return None
+	def parse_dir(self, dirname):
+		# Returns (parts, uplevel dir name to use as artist).
+		# Only the album directory name is parsed (its parent for CD1/-like subdirectories),
+		# not the whole path: batch and watched trees could be anywhere.
+		if dirname not in self.dirs:
+			album_dir = os.path.abspath(dirname)
+			if CD_DIR_PATTERN.match(os.path.basename(album_dir)):
+				album_dir = os.path.dirname(album_dir)
+			album_dir, album_name = os.path.split(album_dir)
+			dir_parts = self._parse(self.dir_patterns, album_name)
+			if dir_parts is None:
+				print("Unknown dirname pattern: " + dirname)
+			else:
+				dir_parts = dict((key, value) for key, value in dir_parts.items() if value is not None)
+			uplevel_dir = os.path.basename(album_dir)
+			uplevel_dir = uplevel_dir.replace(' - Discography', '')
+			self.dirs[dirname] = (dir_parts, uplevel_dir)
+		return self.dirs[dirname]
+	def parse_file(self, filename):
+		file_parts = self._parse(self.file_patterns, filename)
+		if file_parts is None:
+			print("Unknown filename pattern: " + filename)
+			return None
+		return dict((key, value) for key, value in file_parts.items() if value is not None)
+
+filename_patterns = None
+def get_filename_patterns():
+	global filename_patterns
+	if filename_patterns is None:
+		filename_patterns = FilenamePatterns()
+	return filename_patterns
+
+def get_tags_from_filesystem(filepaths, patterns=None):
+	patterns = patterns or get_filename_patterns()
 	fs_tags = {}
 	for index, filepath in enumerate(filepaths, 1):
 		taginfo = TagInfo()
@@ -173,45 +1298,19 @@ def get_tags_from_filesystem(filepaths):
 		dirname, filename = os.path.split(filepath)
 		filename, ext = os.path.splitext(filename)
 
-		DIR_PATTERNS = [
-				r'(?P<artist>.+) ?- ?(?P<year>[0-9]+) ?- ?(?P<album>.+)',
-				r'(?P<artist>.+) ?\[(?P<year>[0-9]+)\] ?(?P<album>.+)',
-				r'(?P<artist>.+) ?- ?(?P<album>.+) - \(?(?P<year>[0-9]{4})\)?',
-				r'(?P<artist>.+) ?- ?(?P<album>.+) \(?(?P<year>[0-9]{4})\)?',
-				r'(?P<artist>.+) ?- ?(?P<album>.+) \((?P<year>[0-9]{4})( - Advance)?\)',
-				r'\[?(?P<year>[0-9]+)\]? ?- ?(?P<album>.+)',
-				r'(?P<year>[0-9]+)_(?P<album>.+)',
-				r'(?P<year>[0-9]+). *(?P<album>.+)',
-				r'(?P<artist>.+) ?- ?(?P<album>.+)',
-				r'(?P<album>.+)'
-				]
-		dir_parts = parse(DIR_PATTERNS, dirname)
+		dir_parts, uplevel_dir = patterns.parse_dir(dirname)
 		if dir_parts:
 			if 'year' in dir_parts: taginfo.year = dir_parts['year']
 			if 'album' in dir_parts: taginfo.album = dir_parts['album']
 			if 'artist' in dir_parts: taginfo.artist = dir_parts['artist']
-		else:
-			print("Unknown dirname pattern: " + dirname)
 
 		if not taginfo.artist:
-			uplevel_dir = os.path.basename(os.path.normpath(os.path.abspath(dirname).replace(dirname, '')))
-			uplevel_dir = uplevel_dir.replace(' - Discography', '')
 			taginfo.artist = uplevel_dir
 
-		FILE_PATTERNS = [
-				r'(?P<number>[0-9]+) ?- ?(?P<title>.+)',
-				r'(?P<number>[0-9]+)\.(?P<title>.+)',
-				r'(?P<number>[0-9]+)_(?P<title>.+)',
-				r'(?P<number>[0-9]+) (?P<title>.+)',
-				r'(?P<number>[0-9]+)(?P<title>.+)',
-				r'(?P<title>.+)'
-				]
-		file_parts = parse(FILE_PATTERNS, filename)
+		file_parts = patterns.parse_file(filename)
 		if file_parts:
 			if 'number' in file_parts: taginfo.number = file_parts['number']
 			if 'title' in file_parts: taginfo.title = file_parts['title']
-		else:
-			print("Unknown filename pattern: " + filename)
 
 		if not taginfo.number:
 			taginfo.number = index
@@ -219,8 +1318,118 @@ def get_tags_from_filesystem(filepaths):
 		fs_tags[filepath] = taginfo
 	return fs_tags
 
+NORMALIZATION_RULES = {
+		'album' : [
+			['strip', '(Deluxe Edition)'],
+			['strip', '(320k)'],
+			['strip', '(limited edition)'],
+			['strip', '[DemonUploader]'],
+			['strip', ' (Remastered)'],
+			['separator'],
+			],
+		'artist' : [
+			['strip', '[Discography]'],
+			['strip', ' - дискография'],
+			['strip', '-Collection.2000-2008.MP3.320kbps'],
+			['replace', 'The.', 'The '],
+			['separator'],
+			],
+		'title' : [
+			['separator'],
+			['replace', '_', ' '],
+			],
+		}
+
+class TagNormalizer:
+	# Rules for each field are applied in order:
+	#   ['strip', 'text'] - removes text;
+	#   ['replace', 'old', 'new'] - replaces text;
+	#   ['sub', 'regexp', 'replacement'] - replaces regexp matches;
+	#   ['separator'] - replaces separator (see --separator) with space.
+	# Consecutive strip rules are merged into a single regexp pass.
+	def __init__(self, rules=NORMALIZATION_RULES):
+		self.rules = rules
+		self.pipelines = {}
+	def get_pipeline(self, field, separator):
+		if (field, separator) not in self.pipelines:
+			self.pipelines[(field, separator)] = self._compile(self.rules.get(field, []), separator)
+		return self.pipelines[(field, separator)]
+	def _compile(self, rules, separator):
+		steps = []
+		stripped = []
+		for rule in rules + [['end']]:
+			if rule[0] == 'strip':
+				stripped.append(re.escape(rule[1]))
+				continue
+			if stripped:
+				steps.append(functools.partial(re.compile('|'.join(stripped)).sub, ''))
+				stripped = []
+			if rule[0] == 'replace':
+				steps.append(lambda value, old=rule[1], new=rule[2]: value.replace(old, new))
+			elif rule[0] == 'sub':
+				steps.append(functools.partial(re.compile(rule[1]).sub, rule[2]))
+			elif rule[0] == 'separator':
+				steps.append(lambda value: value.replace(separator, ' '))
+			elif rule[0] != 'end':
+				raise ValueError("Unknown normalization rule: {0}".format(rule))
+		return steps
+	def normalize(self, field, value, separator=' '):
+		for step in self.get_pipeline(field, separator):
+			value = step(value)
+		return value
+
+CD_DIR_PATTERN = re.compile(r'CD ?[0-9]', re.IGNORECASE)
+ARTIST_TITLE_PATTERN = re.compile(r'(.*[^ ]) ?- ?(.*)')
+YEAR_PATTERN = re.compile(r'([0-9]{4}).*')
+WORD_OR_SPACES_PATTERN = re.compile(r"[\w']+| +")
+
+def _capitalize_word(match):
+	word = match.group()
+	return ' ' if word[0] == ' ' else word.capitalize()
+
+def capitalize_words(value):
+	# Strips value, collapses spaces and capitalizes every word in one pass.
+	return WORD_OR_SPACES_PATTERN.sub(_capitalize_word, value.strip())
+
+tag_normalizer = None
+def get_tag_normalizer():
+	global tag_normalizer
+	if tag_normalizer is None:
+		tag_normalizer = TagNormalizer()
+	return tag_normalizer
+
+def get_config_dir():
+	config_dir = os.environ.get('XDG_CONFIG_HOME')
+	if not config_dir:
+		config_dir = os.path.join(os.path.expanduser("~"), ".config")
+	return os.path.join(config_dir, "mediasort")
+
+def load_config(filename):
+	# Config is a JSON object. Recognized keys:
+	#   "dir_patterns", "file_patterns": lists of regexps with named groups,
+	#   tried before built-in ones;
+	#   "normalization_rules": {field: [rules...]}, replaces built-in rules
+	#   for specified fields, see TagNormalizer;
+	#   "articles": list of articles ignored in artist names, replaces built-in ones.
+	if not filename or not os.path.isfile(filename):
+		return {}
+	with open(filename, 'r') as f:
+		return json.load(f)
+
+def set_config(config):
+	global filename_patterns, tag_normalizer
+	filename_patterns = FilenamePatterns(
+			config.get('dir_patterns', []) + DIR_PATTERNS,
+			config.get('file_patterns', []) + FILE_PATTERNS,
+			)
+	rules = dict(NORMALIZATION_RULES)
+	rules.update(config.get('normalization_rules', {}))
+	tag_normalizer = TagNormalizer(rules)
+	set_articles(config.get('articles', ARTICLES))
+
 def repair_tags(tags, args):
 	fs_tags = get_tags_from_filesystem(sorted(tags.keys()))
+	normalizer = get_tag_normalizer()
 
 	for filename in tags:
 		taginfo = tags[filename]
@@ -240,17 +1449,11 @@ def repair_tags(tags, args):
 		#print(taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title)
 
 		album_parts = _split_path(taginfo.album)
-		if re.match(r'CD ?[0-9]', album_parts[-1], re.IGNORECASE):
+		if CD_DIR_PATTERN.match(album_parts[-1]):
 			taginfo.album = reduce(os.path.join, album_parts[:-1])
-		taginfo.album = taginfo.album.replace('(Deluxe Edition)', '')
-		taginfo.album = taginfo.album.replace('(320k)', '')
-		taginfo.album = taginfo.album.replace('(limited edition)', '')
-		taginfo.album = taginfo.album.replace('[DemonUploader]', '')
-		taginfo.album = taginfo.album.replace(' (Remastered)', '')
-		taginfo.artist = taginfo.artist.replace('[Discography]', '')
-		taginfo.artist = taginfo.artist.replace(' - дискография', '')
-		taginfo.artist = taginfo.artist.replace('-Collection.2000-2008.MP3.320kbps', '')
-		taginfo.artist = taginfo.artist.replace('The.', 'The ')
+		taginfo.album = normalizer.normalize('album', taginfo.album, args.SEPARATOR)
+		taginfo.artist = normalizer.normalize('artist', taginfo.artist, args.SEPARATOR)
+		taginfo.title = normalizer.normalize('title', taginfo.title, args.SEPARATOR)
 
 		try:
 			taginfo.number = int(taginfo.number)
@@ -258,13 +1461,10 @@ def repair_tags(tags, args):
 			print("Track number is not a number: {0}".format(taginfo.number))
 			taginfo.number = fs_taginfo.number
 
-		taginfo.title = taginfo.title.replace(args.SEPARATOR, ' ')
-		taginfo.title = taginfo.title.replace('_', ' ')
 		if taginfo.title.startswith(str(taginfo.number)):
 			if taginfo.title[len(str(taginfo.number))] in '-. _':
 				taginfo.title = taginfo.title[len(str(taginfo.number)):].lstrip()
 
-		taginfo.album = taginfo.album.replace(args.SEPARATOR, ' ')
 		if 'CD 1' in taginfo.album:
 			taginfo.album = taginfo.album.replace(' - CD 1', '')
 			taginfo.number += 100
@@ -272,33 +1472,20 @@ def repair_tags(tags, args):
 			taginfo.album = taginfo.album.replace(' - CD 2', '')
 			taginfo.number += 200
 
-		taginfo.artist = taginfo.artist.replace(args.SEPARATOR, ' ')
-		taginfo.artist = taginfo.artist.replace(args.SEPARATOR, ' ')
+		taginfo.artist = capitalize_words(taginfo.artist)
+		taginfo.album = capitalize_words(taginfo.album)
+		taginfo.title = capitalize_words(taginfo.title)
 
-		taginfo.title  = taginfo.title.strip()
-		taginfo.artist = taginfo.artist.strip()
-		taginfo.album  = taginfo.album.strip()
-		taginfo.number = taginfo.number
-		taginfo.year   = taginfo.year.strip()
-
-		taginfo.artist = re.sub(' +', ' ', taginfo.artist)
-		taginfo.album = re.sub(' +', ' ', taginfo.album)
-		taginfo.title = re.sub(' +', ' ', taginfo.title)
-
-		m = re.match(r'(.*[^ ]) ?- ?(.*)', taginfo.title)
+		m = ARTIST_TITLE_PATTERN.match(taginfo.title)
 		if m:
 			if m.group(1).lower() == taginfo.artist.lower():
 				taginfo.title = m.group(2)
 
-		m = re.match(r'([0-9]{4}).*', taginfo.year)
+		m = YEAR_PATTERN.match(taginfo.year.strip())
 		if m:
 			taginfo.year = m.group(1)
 		else:
 			taginfo.year = None
-		
-		taginfo.album = ''.join([word.capitalize() for word in re.split(r"([\w']+)", taginfo.album)])
-		taginfo.title = ''.join([word.capitalize() for word in re.split(r"([\w']+)", taginfo.title)])
-		taginfo.artist = ''.join([word.capitalize() for word in re.split(r"([\w']+)", taginfo.artist)])
 
 	most_frequent_year = get_most_frequent_value([tags[filename].year for filename in tags])
 	for filename in tags:
@@ -310,61 +1497,336 @@ def repair_tags(tags, args):
 
 	return tags
 
-def guess_encoding(tags):
-	encodings = []
+def detect_encoding(values):
+	# All raw values of an album are fed to one detector:
+	# single short strings are too small for reliable detection.
+	if not values:
+		return None
+	if all(value.isascii() for value in values):
+		return 'ascii'
+	try:
+		for value in values:
+			value.decode('utf-8')
+		return 'utf-8'
+	except UnicodeDecodeError:
+		pass
+	stats.count('chardet')
+	detector = chardet.UniversalDetector()
+	for value in values:
+		detector.feed(value + b'\n')
+		if detector.done:
+			break
+	detector.close()
+	return detector.result['encoding']
+
+encoding_verdicts = {}
+def guess_encodings(tags):
+	# Returns {filename: encoding}, encoding is detected once per source directory.
+	dir_values = defaultdict(list)
 	for filename in tags:
 		taginfo = tags[filename]
-		if type(taginfo.artist) is bytes:
-			encodings.append(chardet.detect(taginfo.artist)['encoding'])
-		if type(taginfo.album) is bytes:
-			encodings.append(chardet.detect(taginfo.album)['encoding'])
-		if type(taginfo.title) is bytes:
-			encodings.append(chardet.detect(taginfo.title)['encoding'])
-
-	non_ascii_encodings = filter(lambda x: x != "ascii", encodings)
-	if non_ascii_encodings:
-		encodings = non_ascii_encodings
-	return get_most_frequent_value(encodings)
+		values = dir_values[os.path.dirname(filename)]
+		values.extend(value for value in (taginfo.artist, taginfo.album, taginfo.title) if isinstance(value, bytes))
+	dir_encodings = {}
+	for dirname, values in dir_values.items():
+		key = (dirname, hash(tuple(values)))
+		if key not in encoding_verdicts:
+			encoding_verdicts[key] = detect_encoding(values)
+		dir_encodings[dirname] = encoding_verdicts[key]
+	return dict((filename, dir_encodings[os.path.dirname(filename)]) for filename in tags)
 
 def reencode_tags(tags, args):
-	encoding = None
 	if args.ENCODING:
-		encoding = args.ENCODING
-		print("Using encoding: {0}".format(encoding))
+		print("Using encoding: {0}".format(args.ENCODING))
+		encodings = dict((filename, args.ENCODING) for filename in tags)
 	else:
-		encoding = guess_encoding(tags)
-		if encoding:
+		encodings = guess_encodings(tags)
+		for encoding in sorted(set(encoding for encoding in encodings.values() if encoding)):
 			print("Encoding detected: {0}".format(encoding))
-	if not encoding:
-		encoding = 'ascii'
-	
+
 	for filename in tags:
 		taginfo = tags[filename]
+		encoding = encodings[filename] or 'ascii'
 		taginfo.artist = taginfo.artist.decode(encoding) if isinstance(taginfo.artist, bytes) else taginfo.artist
 		taginfo.album  = taginfo.album.decode(encoding) if isinstance(taginfo.album, bytes) else taginfo.album
 		taginfo.title  = taginfo.title.decode(encoding) if isinstance(taginfo.title, bytes) else taginfo.title
 	
 	return tags
 
-def get_all_data(wd, args):
-	mp3_filenames, other_filenames = get_dir_content(wd)
-	mp3_filenames = sorted(mp3_filenames)
-	tags = dict([(filename, get_taginfo_for_file(filename)) for filename in mp3_filenames])
-	tags = reencode_tags(tags, args)
-	tags = repair_tags(tags, args)
-	new_filenames = dict([(filename, get_new_filename(tags[filename], args.NEW_ROOT_DIR, args.USE_SUBDIRS)) for filename in mp3_filenames])
+class ImportPlan:
+	# Columnar list of (filename, new_filename, taginfo): every directory is stored once,
+	# files keep only indices of their source and destination directories and their names.
+	def __init__(self):
+		self.dirs = []
+		self.dir_indices = {}
+		self.src_dirs = array.array('I')
+		self.src_names = []
+		self.dst_dirs = array.array('I')
+		self.dst_names = []
+		self.tags = []
+	def _get_dir_index(self, path):
+		index = self.dir_indices.get(path)
+		if index is None:
+			index = self.dir_indices[path] = len(self.dirs)
+			self.dirs.append(sys.intern(path))
+		return index
+	def add(self, filename, new_filename, taginfo):
+		dirname, name = os.path.split(filename)
+		self.src_dirs.append(self._get_dir_index(dirname))
+		self.src_names.append(name)
+		dirname, name = os.path.split(new_filename)
+		self.dst_dirs.append(self._get_dir_index(dirname))
+		self.dst_names.append(name)
+		# Album-wide values are repeated for every track.
+		for field in ('artist', 'album', 'year'):
+			if isinstance(getattr(taginfo, field), str):
+				setattr(taginfo, field, sys.intern(getattr(taginfo, field)))
+		self.tags.append(taginfo)
+	def __len__(self):
+		return len(self.tags)
+	def __iter__(self):
+		for index in range(len(self.tags)):
+			yield self.get_source(index), self.get_destination(index), self.tags[index]
+	def get_source(self, index):
+		return os.path.join(self.dirs[self.src_dirs[index]], self.src_names[index])
+	def get_destination(self, index):
+		return os.path.join(self.dirs[self.dst_dirs[index]], self.dst_names[index])
+	def sources(self):
+		return (self.get_source(index) for index in range(len(self.tags)))
+	def source_dirs(self):
+		return [self.dirs[index] for index in sorted(set(self.src_dirs))]
+	def destination_dirs(self):
+		return [self.dirs[index] for index in sorted(set(self.dst_dirs))]
+	def without(self, filenames):
+		plan = ImportPlan()
+		for filename, new_filename, taginfo in self:
+			if filename not in filenames:
+				plan.add(filename, new_filename, taginfo)
+		return plan
+
+def scan_library(args, cache=None):
+	with stats.phase('library scan'):
+		library = LibraryIndex(args.NEW_ROOT_DIR, 3 if args.USE_SUBDIRS else 2)
+		library.scan(cache.get_library_dirs(library.root) if cache else None)
+		if cache:
+			cache.put_library_dirs(library.root, library.dirs)
+	return library
+
+def read_albums(wd, args, batch, exclude_dirs=(), cache=None):
+	# Yields (sorted audio filenames, other filenames, their tags, read errors) of albums.
+	# Tags of the next few albums are read while the current one is processed,
+	# so only these albums are kept in memory.
+	read_taginfo = get_taginfo_with_id3v2_tool if args.USE_ID3V2_TOOL else get_taginfo_for_file
+	walker = walk_albums(wd, args.FORMATS.split(','), batch, exclude_dirs)
+	if not batch:
+		with stats.phase('walk'):
+			albums = list(walker)
+		walker = iter([([filename for album_mp3_filenames, _ in albums for filename in album_mp3_filenames], [filename for _, album_other_filenames in albums for filename in album_other_filenames])])
+	lookahead = max(2, args.JOBS)
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.JOBS)) as executor:
+		queue = deque()
+		while True:
+			while len(queue) < lookahead:
+				with stats.phase('walk'):
+					album = next(walker, None)
+				if album is None:
+					break
+				album_mp3_filenames, album_other_filenames = album
+				if not album_mp3_filenames:
+					continue
+				errors = []
+				results = _submit_tag_reads(executor, album_mp3_filenames, read_taginfo, cache, errors)
+				queue.append((sorted(album_mp3_filenames), album_other_filenames, results, errors))
+			if not queue:
+				break
+			album_mp3_filenames, album_other_filenames, results, errors = queue.popleft()
+			tags = {}
+			with stats.phase('tag read'):
+				_collect_tag_reads(results, read_taginfo, cache, tags, errors)
+			yield album_mp3_filenames, album_other_filenames, tags, errors
+
+def print_read_errors(errors):
+	if errors:
+		print("Cannot read tags:")
+		for filename, e in errors:
+			print('\t{0}: {1}'.format(filename, e))
+		print()
+
+def decode_latin1_tags(album_filenames, tags):
+	# Returns copies of tags of album files with ISO-8859-1 values decoded as is (see reencode_tags).
+	latin1_tags = {}
+	for filename in album_filenames:
+		if filename not in tags:
+			continue
+		taginfo = TagInfo()
+		for field in TagInfo.__slots__:
+			value = getattr(tags[filename], field)
+			setattr(taginfo, field, value.decode('latin-1') if field in ('artist', 'album', 'title') and isinstance(value, bytes) else value)
+		latin1_tags[filename] = taginfo
+	return latin1_tags
+
+def repair_album(album_filenames, tags, args):
+	# Takes tags of album files out of tags, returns them reencoded and repaired.
+	album_tags = dict((filename, tags.pop(filename)) for filename in album_filenames if filename in tags)
+	with stats.phase('reencode'):
+		album_tags = reencode_tags(album_tags, args)
+	with stats.phase('repair'):
+		album_tags = repair_tags(album_tags, args)
+	return album_tags
 
+def get_all_data(wd, args, library=None, ask=True):
+	# Library index could be passed already scanned (see watch_inbox).
+	# Albums are planned as soon as their tags are read, tags of planned files are not kept by path.
+	cache = None if args.NO_CACHE else TagCache(os.path.join(get_cache_dir(), 'cache.sqlite'), rebuild=args.REBUILD_CACHE)
+	plan = ImportPlan()
+	other_filenames, errors, outside_filenames = [], [], []
 	max_paths = set()
 	paths_to_make = set()
-	for filename in mp3_filenames:
-		existing_path, path_to_make = get_exists_path_part(new_filenames[filename])
-		max_paths.add(existing_path)
-		path_to_make, tail = os.path.split(path_to_make)
-		if path_to_make:
-			paths_to_make.add(path_to_make)
-	return mp3_filenames, other_filenames, tags, new_filenames, max_paths, paths_to_make
-
-def print_all_data(mp3_filenames, other_filenames, tags, new_filenames, max_paths, paths_to_make):
+	try:
+		if library is None:
+			library = scan_library(args, cache)
+		for album_mp3_filenames, album_other_filenames, tags, album_errors in read_albums(wd, args, args.BATCH, [args.NEW_ROOT_DIR], cache):
+			other_filenames.extend(album_other_filenames)
+			errors.extend(album_errors)
+			album_tags = repair_album(album_mp3_filenames, tags, args)
+			with stats.phase('destination resolve'):
+				for filename in album_mp3_filenames:
+					if filename not in album_tags:
+						continue
+					new_filename = get_new_filename(album_tags[filename], args.NEW_ROOT_DIR, args.USE_SUBDIRS, library, os.path.splitext(filename)[1].lower(), ask)
+					if not is_in_directory(new_filename, args.NEW_ROOT_DIR):
+						outside_filenames.append((filename, new_filename))
+						continue
+					existing_path, path_to_make = get_exists_path_part(new_filename, library)
+					max_paths.add(existing_path)
+					path_to_make, tail = os.path.split(path_to_make)
+					if path_to_make:
+						paths_to_make.add(path_to_make)
+					plan.add(filename, new_filename, album_tags[filename])
+	finally:
+		if cache:
+			cache.close()
+	print_read_errors(errors)
+	if outside_filenames:
+		print("Destinations are outside of the library:")
+		for filename, new_filename in outside_filenames:
+			print('\t{0} -> {1}'.format(filename, new_filename))
+		print()
+	other_filenames += [filename for filename, e in errors] + [filename for filename, new_filename in outside_filenames]
+	return plan, other_filenames, max_paths, paths_to_make
+
+def retag_library(root, args):
+	# Applies repair rules to files of the library. Only files whose tags differ are written,
+	# in place when new tags fit into the existing tag space.
+	cache = None if args.NO_CACHE else TagCache(os.path.join(get_cache_dir(), 'cache.sqlite'), rebuild=args.REBUILD_CACHE)
+	tasks, errors = [], []
+	unchanged = 0
+	try:
+		for album_filenames, _, tags, album_errors in read_albums(root, args, True, cache=cache):
+			errors.extend(album_errors)
+			# Encoding guessed for ISO-8859-1 frames of short albums could be wrong (e.g. for files
+			# tagged by mediasort itself), so files that already have tags which the rules
+			# give for ISO-8859-1 text are not changed.
+			latin1_tags = None
+			if not args.ENCODING and any(isinstance(value, bytes) for taginfo in tags.values() for value in (taginfo.artist, taginfo.album, taginfo.title)):
+				latin1_tags = repair_album(album_filenames, decode_latin1_tags(album_filenames, tags), args)
+			album_tags = repair_album(album_filenames, tags, args)
+			with stats.phase('compare'):
+				for filename in album_filenames:
+					if filename not in album_tags or not is_retagged(filename):
+						continue
+					current_values = get_id3v2_tag_values(filename)
+					if current_values == get_tag_values(album_tags[filename]) or (latin1_tags and current_values == get_tag_values(latin1_tags[filename])):
+						unchanged += 1
+					else:
+						tasks.append((filename, filename, album_tags[filename]))
+	finally:
+		if cache:
+			cache.close()
+	print_read_errors(errors)
+	stats.count('files_unchanged', unchanged)
+	print("{0} of {1} files have different tags.".format(len(tasks), len(tasks) + unchanged))
+	if not tasks:
+		return []
+	print("Tags will be set:")
+	for filename, new_filename, tag in tasks:
+		print('\t{0}: Artist: <{1}> | Album: <{2}> | Year: <{3}> | No: <{4}> | Title: <{5}> |'.format(filename, tag.artist, tag.album, tag.year, tag.number, tag.title))
+	print()
+	with stats.phase('prompt'):
+		if input("Proceed (y/n)?") != 'y':
+			return []
+	# Unlike imports, other frames (cover art, comments, ReplayGain...) of library files are kept.
+	retag_func = functools.partial(retag_with_id3v2_tool if args.USE_ID3V2_TOOL else retag_in_place, keep_frames=True)
+	executor = ImportExecutor(lambda filename, new_filename, taginfo: retag_func(filename, taginfo), args.JOBS, show_progress=sys.stdout.isatty())
+	with stats.phase('retag'):
+		errors = executor.run(tasks)
+	if errors:
+		print("Failed to retag:")
+		for filename, e in errors:
+			print('\t{0}: {1}'.format(filename, e))
+	return errors
+
+DUPLICATE_ACTIONS = ['skip', 'replace', 'keep']
+
+def find_duplicates(filenames, args, exclude_dirs=()):
+	# Returns {filename: [library files with the same audio]}.
+	# Inbox could be inside of the library, so it is passed in exclude_dirs.
+	cache = None if args.NO_CACHE else TagCache(os.path.join(get_cache_dir(), 'cache.sqlite'))
+	try:
+		with stats.phase('duplicate index'):
+			index = AudioHashIndex(args.NEW_ROOT_DIR, args.FORMATS.split(','), exclude_dirs)
+			index.update(cache.get_audio_hashes(index.root) if cache else None, args.JOBS)
+			if cache:
+				cache.put_audio_hashes(index.root, index.files)
+	finally:
+		if cache:
+			cache.close()
+	duplicates, errors = {}, []
+	with stats.phase('duplicate check'):
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.JOBS)) as executor:
+			for filename, future in [(filename, executor.submit(get_audio_hash, filename)) for filename in filenames]:
+				try:
+					digest = future.result()
+				except OSError as e: # File vanished or is not readable, its import will fail too.
+					errors.append((filename, e))
+					continue
+				# File could be already imported by hardlink or be in the library itself.
+				paths = [path for path in index.find(digest) if is_other_file(path, filename)]
+				if paths:
+					duplicates[filename] = paths
+	if errors:
+		print("Cannot check for duplicates:")
+		for filename, e in errors:
+			print('\t{0}: {1}'.format(filename, e))
+		print()
+	return duplicates
+
+def is_other_file(path, filename):
+	# Library file that vanished meanwhile is not a duplicate anymore.
+	try:
+		return not os.path.samefile(path, filename)
+	except OSError:
+		return os.path.exists(path)
+
+def remove_duplicates(duplicates, plan):
+	new_filenames = dict((filename, new_filename) for filename, new_filename, taginfo in plan if filename in duplicates)
+	for filename in sorted(duplicates):
+		for duplicate in duplicates[filename]:
+			if not os.path.exists(duplicate) or (os.path.exists(filename) and os.path.samefile(duplicate, filename)):
+				continue
+			if not os.path.samefile(duplicate, new_filenames[filename]):
+				os.remove(duplicate)
+				print("Duplicate removed: {0}".format(duplicate))
+
+def get_used_paths(plan, max_paths, paths_to_make):
+	# Leaves only paths that are needed for destinations of the plan (e.g. after skipping duplicates).
+	destinations = set(path.upper() for path in plan.destination_dirs())
+	destinations.update(plan.get_destination(index).upper() for index in range(len(plan)))
+	max_paths = set(path for path in max_paths if any(destination == path.upper() or destination.startswith(os.path.join(path.upper(), '')) for destination in destinations))
+	paths_to_make = set(path for path in paths_to_make if any(destination == path.upper() or destination.endswith(os.sep + path.upper()) for destination in destinations))
+	return max_paths, paths_to_make
+
+def print_all_data(plan, other_filenames, max_paths, paths_to_make):
 	if other_filenames:
 		print("These won't be stored:")
 		for filename in other_filenames:
@@ -372,18 +1834,23 @@ def print_all_data(mp3_filenames, other_filenames, tags, new_filenames, max_path
 		print()
 
 	print("Tags will be set:")
-	for filename in mp3_filenames:
-		tag = tags[filename]
+	for tag in plan.tags:
 		print('\tArtist: <{0}> | Album: <{1}> | Year: <{2}> | No: <{3}> | Title: <{4}> |'.format(tag.artist, tag.album, tag.year, tag.number, tag.title))
 	print()
 
-	common_src_path = get_max_common_beginning([_split_path(path) for path in mp3_filenames])
-	common_dst_path = get_max_common_beginning([_split_path(new_filenames[path]) for path in mp3_filenames])
+	# Common paths are computed over distinct directories only, relative dir of every directory once.
+	common_src_path = get_max_common_beginning([_split_path(path) for path in plan.source_dirs()])
+	common_dst_path = get_max_common_beginning([_split_path(path) for path in plan.destination_dirs()])
+	relative_dirs = {}
+	def get_relative_dir(index, common_path):
+		if (index, len(common_path)) not in relative_dirs:
+			relative_dirs[(index, len(common_path))] = list(get_remains(_split_path(plan.dirs[index]), common_path))
+		return relative_dirs[(index, len(common_path))]
 	print("Files will be placed to:")
 	print("\t{0} -> {1}".format(reduce(os.path.join, common_src_path), reduce(os.path.join, common_dst_path)))
-	for filename in mp3_filenames:
-		src = reduce(os.path.join, get_remains(_split_path(filename), common_src_path))
-		dst = reduce(os.path.join, get_remains(_split_path(new_filenames[filename]), common_dst_path))
+	for index in range(len(plan)):
+		src = reduce(os.path.join, get_relative_dir(plan.src_dirs[index], common_src_path) + [plan.src_names[index]])
+		dst = reduce(os.path.join, get_relative_dir(plan.dst_dirs[index], common_dst_path) + [plan.dst_names[index]])
 		print("\t\t{0} -> {1}".format(src, dst))
 	print
 
@@ -399,51 +1866,298 @@ def print_all_data(mp3_filenames, other_filenames, tags, new_filenames, max_path
 			print('\t' + path)
 		print
 	
-def main():
+def make_arg_parser():
 	parser = argparse.ArgumentParser(description="Collects music to the music library")
-	parser.add_argument("wd", default=os.getcwd(), help="Working directory (default to current)")
+	parser.add_argument("wd", nargs='?', default=os.getcwd(), help="Working directory (default to current)")
 	parser.add_argument("--force_fs_tags", dest="FORCE_FS_TAGS", action='store_true', default=False, help="Force filling MP3 tags from filenames instead of current ID3v2 tags")
 	parser.add_argument("--force_artist", dest="ARTIST", default="", required=False, help="Override tagged artist name with this value")
 	parser.add_argument("--force_year", dest="YEAR", default="", required=False, help="Override tagged year with this value")
 	parser.add_argument("--force_album", dest="ALBUM", default="", required=False, help="Override tagged album title with this value")
 	parser.add_argument("--force_encoding", dest="ENCODING", default="", required=False, help="Use this encoding on all tracks' tags")
-	parser.add_argument("--root_dir", dest="NEW_ROOT_DIR", default=".", required=True, help="Library root directory")
+	parser.add_argument("--root_dir", dest="NEW_ROOT_DIR", default=None, required=False, help="Library root directory (required unless --resume is given)")
 	parser.add_argument("--use_subdirs", dest="USE_SUBDIRS", default=False, required=False, help="Is library directory contains all artist dirs in some subdirs (like by genre etc)?")
+	parser.add_argument("--default_subdir", dest="DEFAULT_SUBDIR", default=None, required=False, help="Library subdir for new artists when --use_subdirs is set, instead of asking")
 	parser.add_argument("--separator", dest="SEPARATOR", default=" ", required=False, help="Separator to use instead of space")
+	parser.add_argument("--config", dest="CONFIG", default=os.path.join(get_config_dir(), 'config.json'), required=False, help="JSON config file with additional dirname/filename patterns (default: $XDG_CONFIG_HOME/mediasort/config.json)")
+	parser.add_argument("--batch", dest="BATCH", action='store_true', default=False, help="Working directory is a tree of several albums: every directory with MP3 files is processed as a separate album")
+	parser.add_argument("--formats", dest="FORMATS", default="mp3", required=False, help="Comma-separated list of audio file extensions to store, case-insensitive (known: {0}; default: mp3). Tags are rewritten only for MP3 files".format(','.join(AUDIO_EXTENSIONS)))
+	parser.add_argument("--mode", dest="MODE", choices=IMPORT_MODES, default='copy', required=False, help="How to place files to the library: copy, move, hardlink (when tags are already correct) or reflink (copy-on-write clone), falls back to copying when not possible (default: copy)")
+	parser.add_argument("--jobs", dest="JOBS", type=int, default=os.cpu_count() or 1, required=False, help="Number of files to process simultaneously (default to number of CPUs), spinning disks are always accessed by one job at a time")
+	parser.add_argument("--on_duplicate", "--on-duplicate", dest="ON_DUPLICATE", default=None, choices=DUPLICATE_ACTIONS, required=False, help="Check incoming files against audio (without tags) of library files and skip them, replace library copies or keep both")
+	parser.add_argument("--journal", dest="JOURNAL", default=None, required=False, help="Import journal file (default: new file in $XDG_DATA_HOME/mediasort/journals)")
+	parser.add_argument("--resume", dest="RESUME", default=None, required=False, help="Resume interrupted import from specified journal, skipping already imported files")
+	parser.add_argument("--no_cache", "--no-cache", dest="NO_CACHE", action='store_true', default=False, help="Do not use cached tags, read every file anew")
+	parser.add_argument("--rebuild_cache", "--rebuild-cache", dest="REBUILD_CACHE", action='store_true', default=False, help="Drop all cached tags and fill the cache anew")
+	parser.add_argument("--retag_in_place", "--retag-in-place", dest="RETAG_ROOT", default=None, required=False, help="Apply tag repair rules to files of this library in place, only files with different tags are written")
+	parser.add_argument("--watch", dest="WATCH", default=None, required=False, help="Watch this inbox and import new albums without asking (implies --batch)")
+	parser.add_argument("--quiet_time", "--quiet-time", dest="QUIET_TIME", type=float, default=30, required=False, help="Seconds without changes after which an album in the watched inbox is imported (default: 30)")
+	parser.add_argument("--stats", dest="STATS", default=None, choices=['text', 'json'], required=False, help="Print time spent in every phase and counters of expensive operations to stderr")
+	parser.add_argument("--profile", dest="PROFILE", default=None, required=False, help="Dump cProfile statistics of the main thread to this file (see pstats)")
+	parser.add_argument("--use_id3v2_tool", dest="USE_ID3V2_TOOL", action='store_true', default=False, help="Read and write tags with external id3v2 tool instead of built-in ID3 support")
+	return parser
+
+def main():
+	parser = make_arg_parser()
 	args = parser.parse_args()
+	if not args.RESUME and not args.RETAG_ROOT and not args.NEW_ROOT_DIR:
+		parser.error("the following arguments are required: --root_dir")
+	if args.WATCH and args.USE_SUBDIRS and not args.DEFAULT_SUBDIR:
+		parser.error("--watch with --use_subdirs requires --default_subdir")
+	if args.WATCH and args.JOURNAL:
+		parser.error("--journal cannot be used with --watch")
+	profiler = cProfile.Profile() if args.PROFILE else None
+	if profiler:
+		profiler.enable()
+	try:
+		with stats.phase('total'):
+			sort_media(args)
+	finally:
+		if profiler:
+			profiler.disable()
+			profiler.dump_stats(args.PROFILE)
+			print("Profile: {0}".format(args.PROFILE))
+		if args.STATS:
+			stats.write(sys.stderr, args.STATS)
 
-	wd = args.wd
+def sort_media(args):
+	global default_subdir
+	set_config(load_config(args.CONFIG))
+	if args.DEFAULT_SUBDIR:
+		default_subdir = args.DEFAULT_SUBDIR
 
-	mp3_filenames, other_filenames, tags, new_filenames, max_paths, paths_to_make = get_all_data(wd, args)
-	if not mp3_filenames:
-		print("There is no MP3 files in here!")
+	if args.RESUME:
+		if resume_import(args):
+			sys.exit(1)
+		return
+
+	if args.RETAG_ROOT:
+		if retag_library(args.RETAG_ROOT, args):
+			sys.exit(1)
+		return
+	if args.WATCH:
+		watch_inbox(args.WATCH, args)
 		return
-	print_all_data(mp3_filenames, other_filenames, tags, new_filenames, max_paths, paths_to_make)
-
-	yes = input("Proceed (y/n)?")
-	if yes == 'y':
-		for filename in mp3_filenames:
-			new_filename = new_filenames[filename]
-			path, name = os.path.split(new_filename)
-			if not os.path.exists(path):
-				os.makedirs(path)
-				print("Path created: {0}".format(path))
-			shutil.copyfile(filename, new_filename)
-			#print("Copied file: {0} -> {1}".format(filename, new_filename))
-			
-			taginfo = tags[filename]
-			subprocess.check_call(["id3v2", "-D", new_filename])
-			args = ["id3v2"]
-			args += ["-2"]
-			args += ["-a", taginfo.artist]
-			args += ["-A", taginfo.album]
-			args += ["-t", taginfo.title]
-			args += ["-y", taginfo.year]
-			args += ["-T", '{0:0>2}'.format(taginfo.number)]
-			args += [new_filename]
-			subprocess.check_call(args)
-			#print("Successfully reset tags for {0}.".format(new_filename))
+	errors = import_directory(args.wd, args)
+	if errors:
+		sys.exit(1)
+
+def import_directory(wd, args, library=None, ask=True):
+	# Plans and performs import of one directory, returns list of failed imports.
+	plan, other_filenames, max_paths, paths_to_make = get_all_data(wd, args, library, ask)
+	if not plan:
+		print("There is no MP3 files in here!")
+		return []
+	duplicates = find_duplicates(list(plan.sources()), args, [wd]) if args.ON_DUPLICATE else {}
+	if duplicates:
+		print("These are already in the library ({0}):".format(args.ON_DUPLICATE))
+		for filename in sorted(duplicates):
+			print('\t{0} = {1}'.format(filename, ', '.join(duplicates[filename])))
+		print()
+		if args.ON_DUPLICATE == 'skip':
+			plan = plan.without(duplicates)
+			if not plan:
+				print("There is nothing new to store!")
+				return []
+			max_paths, paths_to_make = get_used_paths(plan, max_paths, paths_to_make)
+	print_all_data(plan, other_filenames, max_paths, paths_to_make)
+
+	if ask:
+		with stats.phase('prompt'):
+			if input("Proceed (y/n)?") != 'y':
+				return []
+	journal = ImportJournal.create(args.JOURNAL or get_new_journal_filename(), plan, args.MODE)
+	print("Journal: {0}".format(journal.filename))
+	errors = run_import(plan, args, journal)
+	if not errors:
+		os.remove(journal.filename)
+	if args.ON_DUPLICATE == 'replace':
+		failed = set(filename for filename, e in errors)
+		remove_duplicates(dict((filename, paths) for filename, paths in duplicates.items() if filename not in failed), plan)
+	if library:
+		for path in plan.destination_dirs():
+			library.refresh(path)
+	return errors
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+class InotifyWatcher:
+	# Reports paths changed in the directory tree, new subdirectories are watched as they appear.
+	# Deletions are not watched: files moved away by import should not wake up the album again.
+	MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+	def __init__(self, root, exclude_dirs=()):
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+		self.root = root
+		self.exclude_dirs = set(os.path.realpath(path) for path in exclude_dirs)
+		self.paths = {} # watch descriptor: path
+		self.last_read = time.time()
+		self._add_watches(root)
+	def _add_watches(self, path):
+		# Returns list of newly watched directories.
+		if os.path.realpath(path) in self.exclude_dirs:
+			return []
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+		if wd < 0:
+			if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+				return []
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+		self.paths[wd] = path
+		added = [path]
+		try:
+			with os.scandir(path) as entries:
+				subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+		except FileNotFoundError:
+			return added
+		for subdir in subdirs:
+			added += self._add_watches(subdir)
+		return added
+	def read(self, timeout=None):
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		changed = set()
+		if not ready:
+			return changed
+		try:
+			data = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return changed
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+			name = data[offset + 16:offset + 16 + length].rstrip(b'\x00')
+			offset += 16 + length
+			if mask & IN_Q_OVERFLOW:
+				# Events are lost, directories changed since the last read are reported instead.
+				changed.update(path for path in self._add_watches(self.root) if os.stat(path).st_mtime >= self.last_read - 1)
+				continue
+			if mask & IN_IGNORED:
+				self.paths.pop(wd, None)
+				continue
+			if wd not in self.paths:
+				continue
+			path = os.path.join(self.paths[wd], os.fsdecode(name)) if name else self.paths[wd]
+			if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				# Directory could be filled before its watch was added.
+				changed.update(self._add_watches(path))
+			changed.add(path)
+		self.last_read = time.time()
+		return changed
+	def close(self):
+		os.close(self.fd)
+
+class PollingWatcher:
+	# Fallback for systems without inotify: rescans the whole tree every interval.
+	def __init__(self, root, exclude_dirs=(), interval=5):
+		self.root = root
+		self.exclude_dirs = set(os.path.realpath(path) for path in exclude_dirs)
+		self.interval = interval
+		self.signatures = self._scan()
+	def _scan(self):
+		signatures = {}
+		for dirpath, dirnames, filenames in os.walk(self.root):
+			dirnames[:] = [dirname for dirname in dirnames if os.path.realpath(os.path.join(dirpath, dirname)) not in self.exclude_dirs]
+			signature = []
+			for filename in filenames:
+				try:
+					st = os.stat(os.path.join(dirpath, filename))
+				except FileNotFoundError:
+					continue
+				signature.append((filename, st.st_size, st.st_mtime_ns))
+			signatures[dirpath] = sorted(signature)
+		return signatures
+	def read(self, timeout=None):
+		time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+		signatures = self._scan()
+		changed = set(path for path, signature in signatures.items() if self.signatures.get(path) != signature and set(signature) - set(self.signatures.get(path, [])))
+		self.signatures = signatures
+		return changed
+	def close(self):
+		pass
+
+def get_inbox_album_dir(inbox, path):
+	# Albums are top-level directories of the inbox, their whole trees should be quiet before import.
+	parts = _split_path(os.path.relpath(path, inbox))
+	if not parts or parts[0] in (os.curdir, os.pardir):
+		return None
+	return os.path.join(inbox, parts[0])
+
+def get_tree_mtime(path):
+	mtime_ns = 0
+	for dirpath, dirnames, filenames in os.walk(path):
+		for name in [dirpath] + [os.path.join(dirpath, filename) for filename in filenames]:
+			try:
+				mtime_ns = max(mtime_ns, os.stat(name).st_mtime_ns)
+			except OSError:
+				continue
+	return mtime_ns
 
+def watch_inbox(inbox, args):
+	# Imports albums appearing in the inbox after they have been quiet for args.QUIET_TIME seconds.
+	# Library index is scanned once and then refreshed only by imports.
+	# Imported albums are remembered with their tree mtime (unless --no_cache is given),
+	# so albums left in the inbox by copy mode are not imported again after restart.
+	cache = None if args.NO_CACHE else TagCache(os.path.join(get_cache_dir(), 'cache.sqlite'), rebuild=args.REBUILD_CACHE)
+	try:
+		library = scan_library(args, cache)
+		imported = cache.get_imported_albums() if cache else {}
+	finally:
+		if cache:
+			cache.close()
+	args.BATCH = True
+	try:
+		watcher = InotifyWatcher(inbox, exclude_dirs=[args.NEW_ROOT_DIR])
+	except (OSError, AttributeError) as e:
+		print("Cannot use inotify ({0}), polling inbox instead.".format(e))
+		watcher = PollingWatcher(inbox, exclude_dirs=[args.NEW_ROOT_DIR], interval=min(5, args.QUIET_TIME))
+	print("Watching: {0}".format(inbox))
+	pending = {} # album dir: time of last change
+	failed = {} # album dir: its tree mtime when import failed
+	# Albums that are already in the inbox are imported right away, unless they were imported before.
+	root_dir = os.path.realpath(args.NEW_ROOT_DIR)
+	with os.scandir(inbox) as entries:
+		for entry in entries:
+			if entry.is_dir() and os.path.realpath(entry.path) != root_dir:
+				if imported.get(os.path.abspath(entry.path)) != get_tree_mtime(entry.path):
+					pending[entry.path] = time.monotonic() - args.QUIET_TIME
+	try:
+		while True:
+			timeout = max(0, min(pending.values()) + args.QUIET_TIME - time.monotonic()) if pending else None
+			for path in watcher.read(timeout):
+				album_dir = get_inbox_album_dir(inbox, path)
+				if album_dir:
+					pending[album_dir] = time.monotonic()
+			now = time.monotonic()
+			for album_dir in sorted(album_dir for album_dir, changed in pending.items() if now - changed >= args.QUIET_TIME):
+				del pending[album_dir]
+				if not os.path.isdir(album_dir):
+					continue
+				if album_dir in failed and failed[album_dir] == get_tree_mtime(album_dir):
+					continue # Not changed since failed import.
+				print("Importing: {0}".format(album_dir))
+				try:
+					if not import_directory(album_dir, args, library, ask=False) and not args.NO_CACHE:
+						cache = TagCache(os.path.join(get_cache_dir(), 'cache.sqlite'))
+						try:
+							cache.put_imported_album(album_dir, get_tree_mtime(album_dir))
+						finally:
+							cache.close()
+					failed.pop(album_dir, None)
+				except Exception as e:
+					print("Failed to import {0}: {1}: {2}".format(album_dir, type(e).__name__, e))
+					failed[album_dir] = get_tree_mtime(album_dir)
+				finally:
+					# Memoized values are per album, they should not pile up in the long-running process.
+					get_filename_patterns().dirs.clear()
+					encoding_verdicts.clear()
+	finally:
+		watcher.close()
 
 if __name__ == "__main__":
 	main()
@@ -13,6 +13,9 @@
 #    OnSongChange = "/path/to/moc_submit_lastfm --artist %a --title %t --length %d --album %r --filename %f"
 # Artist, title, length, and filename arguments are mandatory
 #
+# OnSongChange only passes the track to a resident daemon via Unix socket and exits,
+# the daemon is started on the first song change. New song cancels waiting for the previous one.
+#
 # Original author: Luke Plant  < http://lukeplant.me.uk/ >
 # Heavily modified by umi0451 <umi0451.github.io>
 # License: WTFPLv2
@@ -23,7 +26,16 @@ import time
 import sys
 import os
 import re
-import chardet
+import json
+import socket
+import select
+import fcntl
+import struct
+import threading
+import functools
+import contextlib
+import weakref
+from collections import defaultdict
 
 def log(*args):
 	data_dir = os.environ.get('XDG_LOG_HOME')
@@ -176,7 +188,119 @@ def convert_length(length):
 
 # Side-effect functions
 
-def still_playing(info):
+# MOC server protocol (see protocol.h of MOC): commands, events and
+# integers are native ints, strings are int length followed by bytes.
+MOC_CMD_GET_SNAME = 0x0f
+MOC_CMD_GET_STATE = 0x13
+MOC_CMD_DISCONNECT = 0x15
+MOC_EV_STATE = 0x01
+MOC_EV_EXIT = 0x0a
+MOC_EV_DATA = 0x06
+MOC_EV_STATUS_MSG = 0x0f
+MOC_STATE_PLAY = 0x01
+MOC_STATE_STOP = 0x02
+MOC_STATE_PAUSE = 0x03
+# Asynchronous events without data which could come before the reply.
+MOC_EVENTS_WITHOUT_DATA = set(range(0x01, 0x0f)) | set([0x10, 0x12, 0x13, 0x14])
+
+class MocClient:
+	def __init__(self, socket_path, timeout=2):
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.settimeout(timeout)
+		try:
+			self.socket.connect(socket_path)
+		except:
+			self.socket.close()
+			raise
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
+	def _send_int(self, value):
+		self.socket.sendall(struct.pack('=i', value))
+	def _recv(self, size):
+		data = b''
+		while len(data) < size:
+			chunk = self.socket.recv(size - len(data))
+			if not chunk:
+				raise ConnectionError("MOC server closed connection")
+			data += chunk
+		return data
+	def _recv_int(self):
+		return struct.unpack('=i', self._recv(4))[0]
+	def _recv_str(self):
+		return self._recv(self._recv_int()).decode('utf-8', 'surrogateescape')
+	def _recv_event(self):
+		event = self._recv_int()
+		if event == MOC_EV_STATUS_MSG:
+			self._recv_str()
+		elif event != MOC_EV_DATA and event not in MOC_EVENTS_WITHOUT_DATA:
+			raise ValueError("Unexpected MOC event: 0x{0:02x}".format(event))
+		return event
+	def _wait_for_data(self):
+		while self._recv_event() != MOC_EV_DATA:
+			pass
+	def wait_for_event(self, timeout, cancelled=None):
+		# Returns next event sent by server or None if there was none for timeout seconds
+		# or if cancelled (see CancelEvent) is set meanwhile.
+		waited = [self.socket] + ([cancelled] if cancelled is not None else [])
+		if self.socket not in select.select(waited, [], [], timeout)[0]:
+			return None
+		return self._recv_event()
+	def get_state(self):
+		self._send_int(MOC_CMD_GET_STATE)
+		self._wait_for_data()
+		return self._recv_int()
+	def get_filename(self):
+		self._send_int(MOC_CMD_GET_SNAME)
+		self._wait_for_data()
+		return self._recv_str()
+	def close(self):
+		try:
+			self._send_int(MOC_CMD_DISCONNECT)
+		except OSError:
+			pass
+		self.socket.close()
+
+def get_moc_socket_path():
+	return os.path.join(get_moc_data_dir(), "socket2")
+
+def connect_to_moc():
+	# Returns None if MOC server is not available.
+	socket_path = get_moc_socket_path()
+	if not os.path.exists(socket_path):
+		return None
+	try:
+		return MocClient(socket_path)
+	except OSError as e:
+		log('Cannot connect to MOC server at {0}: {1}'.format(socket_path, e))
+		return None
+
+def is_playing_on_moc(moc, info):
+	if moc.get_state() == MOC_STATE_STOP:
+		return False
+	filename = moc.get_filename()
+	if filename == info.filename:
+		return True
+	log('Now playing "{0}" instead of "{1}"'.format(filename, info.filename))
+	return False
+
+def still_playing(info, moc=None):
+	if moc:
+		try:
+			return is_playing_on_moc(moc, info)
+		except (OSError, ValueError) as e:
+			log('Cannot query MOC server: {0}'.format(e))
+	socket_path = get_moc_socket_path()
+	if os.path.exists(socket_path):
+		try:
+			with MocClient(socket_path) as moc:
+				return is_playing_on_moc(moc, info)
+		except (OSError, ValueError) as e:
+			log('Cannot query MOC server at {0}: {1}'.format(socket_path, e))
+	return still_playing_with_mocp(info)
+
+def still_playing_with_mocp(info):
 	MAX_TRIES = 5
 	lines = None
 	for tries in range(MAX_TRIES):
@@ -202,55 +326,345 @@ def still_playing(info):
 			return False
 	return True
 
-def submit_to_lastfm(info):
+def get_lastfmsubmit():
 	lastfmsubmit = [
 			"/usr/local/lib/lastfmsubmitd/lastfmsubmit",
 			"/usr/lib/lastfmsubmitd/lastfmsubmit",
 			]
 	lastfmsubmit = [filename for filename in lastfmsubmit if os.path.exists(filename)]
+	return lastfmsubmit[0] if lastfmsubmit else None
+
+def submit_batch_to_lastfm(records):
+	# lastfmsubmit accepts several tracks, every one with all of its options.
+	lastfmsubmit = get_lastfmsubmit()
 	if not lastfmsubmit:
-		log("{0}: failed to find any lastfmsubmitd runner, exiting".format(info.filename))
-		return
-	lastfmsubmit = lastfmsubmit[0]
-	args = [lastfmsubmit, "--artist", info.artist, "--title", info.title, "--length", str(info.length)]
+		raise OSError("failed to find any lastfmsubmitd runner")
+	args = [lastfmsubmit]
+	for record in records:
+		args.extend(["--artist", record['artist'], "--title", record['title'], "--length", str(record['length'])])
+		args.extend(["--album", record['album'] or ''])
+		args.extend(["--time", time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record['start']))])
+	subprocess.check_call(args)
+
+def get_spool_path():
+	return os.path.join(get_moc_data_dir(), "scrobble_spool")
+
+class ScrobbleSpool:
+	# Append-only JSON-lines file of tracks to submit:
+	#   {"type": "track", "artist": ..., "filename": ..., "start": ...} - played tracks;
+	#   {"type": "submitted", "key": [filename, start]} - submitted ones;
+	#   {"type": "failed", "key": [filename, start]} - rejected by lastfmsubmit.
+	# Every record is synced to disk, file is truncated when everything is submitted.
+	# Tracks rejected MAX_ATTEMPTS times are moved to the .rejected file.
+	MAX_ATTEMPTS = 3
+	def __init__(self, filename):
+		self.filename = filename
+		self.rejected_filename = filename + ".rejected"
+	def _append(self, records):
+		os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+		with open(self.filename, "a") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			for record in records:
+				f.write(json.dumps(record) + "\n")
+			f.flush()
+			os.fsync(f.fileno())
+	def _get_pending(self, f):
+		tracks, submitted, attempts = {}, set(), defaultdict(int)
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue # Record was not finished.
+			if record.get('type') == 'track':
+				tracks.setdefault((record['filename'], record['start']), record)
+			elif record.get('type') == 'submitted':
+				submitted.add(tuple(record['key']))
+			elif record.get('type') == 'failed':
+				attempts[tuple(record['key'])] += 1
+		pending = []
+		for key, record in tracks.items():
+			if key not in submitted and attempts[key] < self.MAX_ATTEMPTS:
+				record['attempts'] = attempts[key]
+				pending.append(record)
+		return pending
+	def append(self, info, start):
+		self._append([{'type' : 'track', 'artist' : info.artist, 'title' : info.title, 'album' : info.album, 'length' : info.length, 'filename' : info.filename, 'start' : int(start)}])
+	def pending(self):
+		try:
+			with open(self.filename, "r") as f:
+				fcntl.flock(f, fcntl.LOCK_SH)
+				return self._get_pending(f)
+		except FileNotFoundError:
+			return []
+	def mark_submitted(self, records):
+		self._append([{'type' : 'submitted', 'key' : [record['filename'], record['start']]} for record in records])
+	def mark_failed(self, records):
+		# Returns records that are still to be retried.
+		rejected = [record for record in records if record.get('attempts', 0) + 1 >= self.MAX_ATTEMPTS]
+		if rejected:
+			with open(self.rejected_filename, "a") as f:
+				for record in rejected:
+					f.write(json.dumps(dict((key, value) for key, value in record.items() if key != 'attempts')) + "\n")
+				f.flush()
+				os.fsync(f.fileno())
+		self._append([{'type' : 'failed', 'key' : [record['filename'], record['start']]} for record in records])
+		return [record for record in records if record not in rejected]
+	@contextlib.contextmanager
+	def flush_lock(self):
+		# Only one process submits tracks at a time, so they are not submitted twice.
+		os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+		with open(self.filename + ".lock", "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			yield
+	def compact(self):
+		try:
+			with open(self.filename, "r+") as f:
+				fcntl.flock(f, fcntl.LOCK_EX)
+				if not self._get_pending(f):
+					f.truncate(0)
+		except FileNotFoundError:
+			pass
+
+def _try_submit(spool, batch, submit):
+	try:
+		submit(batch)
+	except subprocess.CalledProcessError:
+		return False
+	spool.mark_submitted(batch)
+	return True
+
+def _find_rejected(spool, batch, submit, accepted):
+	# Bisects rejected batch, returns (rejected tracks, whether some tracks are accepted).
+	# Until some tracks are accepted, only the first of entirely rejected halves is bisected:
+	# lastfmsubmit probably rejects anything then (e.g. it is misconfigured).
+	if len(batch) == 1:
+		return batch, accepted
+	middle = len(batch) // 2
+	halves = [half for half in (batch[:middle], batch[middle:]) if not _try_submit(spool, half, submit)]
+	accepted = accepted or len(halves) < 2
+	rejected = []
+	for index, half in enumerate(halves):
+		if index and not accepted:
+			rejected += half
+			continue
+		half_rejected, accepted = _find_rejected(spool, half, submit, accepted)
+		rejected += half_rejected
+	return rejected, accepted
+
+def _submit_batch(spool, batch, submit):
+	# Returns tracks rejected by lastfmsubmit, they are found by bisecting the batch.
+	if _try_submit(spool, batch, submit):
+		return []
+	rejected, accepted = _find_rejected(spool, batch, submit, False)
+	return rejected
+
+def flush_spool(spool, submit=submit_batch_to_lastfm, batch_size=50):
+	# Returns False if some tracks are failed to be submitted and are left in the spool.
+	# Other errors than rejection by lastfmsubmit (e.g. it is not found) stop submitting,
+	# as well as rejection of every track of a batch, since it is not about tracks then.
+	with spool.flush_lock():
+		records = spool.pending()
+		retried = []
+		for index in range(0, len(records), batch_size):
+			batch = records[index:index + batch_size]
+			try:
+				rejected = _submit_batch(spool, batch, submit)
+			except Exception as e:
+				log("Failed to submit {0} tracks: {1}".format(len(records) - index, e))
+				return False
+			if rejected and len(rejected) == len(batch) > 1:
+				log("All {0} tracks are rejected by lastfmsubmit".format(len(batch)))
+				return False
+			for record in rejected:
+				log("{0}: rejected by lastfmsubmit (attempt {1} of {2})".format(record['filename'], record['attempts'] + 1, spool.MAX_ATTEMPTS))
+			retried += spool.mark_failed(rejected) if rejected else []
+		spool.compact()
+	return not retried
+
+class SpoolFlusher:
+	# Submits spooled tracks when woken up, retries with exponential backoff on failures.
+	MIN_BACKOFF = 30
+	MAX_BACKOFF = 60 * 60
+	def __init__(self, spool, submit=submit_batch_to_lastfm):
+		self.spool = spool
+		self.submit = submit
+		self.wakeup = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+	def start(self):
+		self.wakeup.set() # Tracks left from previous runs.
+		self.thread.start()
+	def wake(self):
+		self.wakeup.set()
+	def run(self):
+		backoff = None
+		while True:
+			self.wakeup.wait(backoff)
+			self.wakeup.clear()
+			if flush_spool(self.spool, self.submit):
+				backoff = None
+			else:
+				backoff = min(max(2 * (backoff or 0), self.MIN_BACKOFF), self.MAX_BACKOFF)
+
+def submit_to_lastfm(info, start=None, flusher=None):
+	# Tracks are spooled on disk first, so nothing is lost if lastfmsubmit fails.
 	if not info.artist or not info.title:
 		log("{0}: no artist or title present".format(info.filename))
 		return
-	if info.album is not None:
-		args.extend(["--album", info.album])
-	try:
-		subprocess.check_call(args)
-	except Exception as e:
-		log("{0}: ".format(info.filename), e)
+	spool = flusher.spool if flusher else ScrobbleSpool(get_spool_path())
+	spool.append(info, start or time.time())
+	if flusher:
+		flusher.wake()
+	else:
+		flush_spool(spool)
 
-def wait_until_song_is_half_played(info):
+PROBE_INTERVAL = 60
+CANCEL_CHECK_INTERVAL = 5
+
+class CancelEvent(threading.Event):
+	# Event that could be waited for by select() together with MOC socket.
+	def __init__(self):
+		super().__init__()
+		self.read_fd, self.write_fd = os.pipe()
+		weakref.finalize(self, os.close, self.read_fd)
+		weakref.finalize(self, os.close, self.write_fd)
+	def set(self):
+		if not self.is_set():
+			super().set()
+			os.write(self.write_fd, b'\x00')
+	def fileno(self):
+		return self.read_fd
+
+def wait_for_moc_state_change(moc, cancelled, timeout):
+	# Returns True on state change (stop, pause, next song, server exit), False on timeout or cancel.
+	# Plain threading.Event cannot be selected, so it is checked every CANCEL_CHECK_INTERVAL seconds.
+	deadline = time.monotonic() + timeout
+	while not cancelled.is_set():
+		remaining = deadline - time.monotonic()
+		if remaining <= 0:
+			return False
+		if isinstance(cancelled, CancelEvent):
+			event = moc.wait_for_event(remaining, cancelled)
+		else:
+			event = moc.wait_for_event(min(remaining, CANCEL_CHECK_INTERVAL))
+		if event in (MOC_EV_STATE, MOC_EV_EXIT):
+			return True
+	return False
+
+def wait_until_song_is_half_played(info, cancelled=None, probe_interval=None):
+	# Sleeps on monotonic clock until half of the song, checking that it is still playing
+	# every probe_interval seconds and on every MOC state change if MOC socket is available.
 	if info.length < 1:
 		return False
 	if info.length < 15:
 		return True
-	wait = info.length/2
-	start = datetime.datetime.now()
-	while True:
-		time.sleep(5)
-		if not still_playing(info):
-			log('Started at {0}, now is {1} and not playing anymore.'.format(start, datetime.datetime.now()))
+	cancelled = cancelled or CancelEvent()
+	probe_interval = probe_interval or PROBE_INTERVAL
+	start = time.monotonic()
+	deadline = start + info.length / 2
+	moc = connect_to_moc()
+	try:
+		while True:
+			timeout = min(probe_interval, deadline - time.monotonic())
+			if timeout > 0 and moc:
+				try:
+					wait_for_moc_state_change(moc, cancelled, timeout)
+				except (OSError, ValueError) as e:
+					log('Lost connection to MOC server: {0}'.format(e))
+					moc.close()
+					moc = None
+					continue
+			elif timeout > 0:
+				cancelled.wait(timeout)
+			if cancelled.is_set():
+				log('Another song is started after {0:.0f}s of "{1}".'.format(time.monotonic() - start, info.filename))
+				return False
+			if not still_playing(info, moc):
+				log('Not playing anymore after {0:.0f}s of "{1}".'.format(time.monotonic() - start, info.filename))
+				return False
+			if time.monotonic() >= deadline:
+				return True
+	finally:
+		if moc:
+			moc.close()
+
+class PlaylistIndex:
+	# Map of playlist entries to their positions, so song change does not rescan whole playlist.
+	# It is kept in memory of the daemon and persisted for the next runs.
+	# Map is valid while playlist size and mtime are the same.
+	# If playlist only had entries appended (bytes before the old end are the same), only new lines are parsed.
+	# Every line except comments is an entry, including empty ones, like MOC itself counts them.
+	TAIL_SIZE = 256
+	def __init__(self, playlist, cache_file):
+		self.playlist = playlist
+		self.cache_file = cache_file
+		self.cache = None
+		self.lock = threading.Lock()
+	def _load(self):
+		try:
+			with open(self.cache_file, "r") as f:
+				cache = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if cache.get('playlist') != self.playlist:
+			return None
+		return cache
+	def _save(self, cache):
+		tmp_file = self.cache_file + '.tmp'
+		with open(tmp_file, "w") as f:
+			json.dump(cache, f)
+		os.replace(tmp_file, self.cache_file)
+	def _is_appended(self, f, cache, size):
+		tail = bytes.fromhex(cache['tail'])
+		if size <= cache['offset'] or not tail.endswith(b'\n'):
 			return False
-		if (datetime.datetime.now() - start).seconds > wait:
-			return True
+		f.seek(cache['offset'] - len(tail))
+		return f.read(len(tail)) == tail
+	def _parse(self, f, cache):
+		f.seek(cache['offset'])
+		count = cache['count']
+		for line in f:
+			if line.startswith(b'#'):
+				continue
+			line = line.rstrip(b'\r\n')
+			if line:
+				cache['entries'].setdefault(os.fsdecode(line), count)
+			count += 1
+		cache['count'] = count
+		cache['offset'] = f.tell()
+		f.seek(max(0, cache['offset'] - self.TAIL_SIZE))
+		cache['tail'] = f.read(self.TAIL_SIZE).hex()
+	def _is_valid(self, cache, stat):
+		return cache and cache['size'] == stat.st_size and cache['mtime'] == stat.st_mtime_ns
+	def find(self, filename):
+		# Returns position of exactly this filename in playlist or -1.
+		with self.lock:
+			stat = os.stat(self.playlist)
+			if self.cache is None:
+				self.cache = self._load()
+			if not self._is_valid(self.cache, stat):
+				with open(self.playlist, "rb") as f:
+					stat = os.fstat(f.fileno())
+					if not self.cache or not self._is_appended(f, self.cache, stat.st_size):
+						self.cache = {'playlist' : self.playlist, 'offset' : 0, 'count' : 0, 'entries' : {}}
+					self._parse(f, self.cache)
+					self.cache['size'], self.cache['mtime'] = stat.st_size, stat.st_mtime_ns
+				try:
+					self._save(self.cache)
+				except OSError as e:
+					log("Failed to save playlist index: {0}".format(e))
+			return self.cache['entries'].get(filename, -1)
 
-def run_submitter():
-	parser = optparse.OptionParser()
-	parser.add_option("-a", "--artist", dest="artist")
-	parser.add_option("-t", "--title", dest="title")
-	parser.add_option("-A", "--album", dest="album")
-	parser.add_option("-l", "--length", dest="length")
-	parser.add_option("-f", "--filename", dest="filename")
-	options, args = parser.parse_args()
-	mandatory = ["filename"]
-	if any(not options.__dict__.get(k) for k in mandatory):
-		log("{0}: All of {1} must be specified".format(options.filename, ', '.join(mandatory)))
-		exit(1)
+playlist_indices = {}
+def get_playlist_index(playlist, cache_file):
+	# Indices live as long as the process, so the daemon does not load them from disk for every song.
+	if (playlist, cache_file) not in playlist_indices:
+		playlist_indices[(playlist, cache_file)] = PlaylistIndex(playlist, cache_file)
+	return playlist_indices[(playlist, cache_file)]
+
+TRACK_OPTIONS = ["artist", "title", "album", "length", "filename", "probe_interval"]
 
+def handle_track(options, cancelled=None, flusher=None):
+	start = time.time()
 	moc_config_dir = get_moc_config_dir()
 	moc_data_dir = get_moc_data_dir()
 	if moc_config_dir:
@@ -258,15 +672,9 @@ def run_submitter():
 		playlist = os.path.join(moc_config_dir, "playlist.m3u")
 		if not os.path.isfile(playlist) and moc_data_dir:
 			playlist = os.path.join(moc_data_dir, "playlist.m3u")
-		if os.path.isfile(playlist):
-			with open(playlist, "r") as f:
-				for line in f:
-					if line.startswith('#'):
-						continue
-					index += 1
-					if options.filename in line:
-						break
 		os.makedirs(moc_data_dir, exist_ok=True)
+		if os.path.isfile(playlist):
+			index = get_playlist_index(playlist, os.path.join(moc_data_dir, "playlist_index.json")).find(options.filename)
 		with open(os.path.join(moc_data_dir, "last_track"), "w") as f:
 			f.write(options.filename + "\n")
 			f.write(str(index) + "\n")
@@ -276,8 +684,125 @@ def run_submitter():
 	filename_info = extract_tags_from_filename(original_info.filename)
 	original_info = substitute_insufficient_info(original_info, filename_info)
 	decoded_info = decode_info(original_info)
-	if wait_until_song_is_half_played(original_info):
-		submit_to_lastfm(decoded_info)
+	if wait_until_song_is_half_played(original_info, cancelled, options.probe_interval):
+		submit_to_lastfm(decoded_info, start, flusher)
+		return True
+	return False
+
+def get_daemon_socket_path():
+	return os.path.join(get_moc_data_dir(), "moc_submit_lastfm.socket")
+
+class ScrobbleDaemon:
+	# Owns playback state: every song change cancels waiting for the previous song.
+	# Exits after being idle for IDLE_TIMEOUT seconds, next song change starts it again.
+	IDLE_TIMEOUT = 60 * 60
+	def __init__(self, socket_path, handle_track=handle_track, flusher=None):
+		self.socket_path = socket_path
+		self.flusher = flusher
+		self.handle_track = handle_track
+		self.cancelled = None
+		self.worker = None
+	def run(self):
+		os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+		with open(self.socket_path + ".lock", "w") as lock:
+			try:
+				fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				return False # Another daemon is running.
+			if self.flusher:
+				self.flusher.start()
+			if os.path.exists(self.socket_path):
+				os.remove(self.socket_path)
+			server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				server.bind(self.socket_path)
+				server.listen(16)
+				server.settimeout(self.IDLE_TIMEOUT)
+				self.serve(server)
+			finally:
+				server.close()
+				os.remove(self.socket_path)
+		return True
+	def serve(self, server):
+		while True:
+			try:
+				connection, address = server.accept()
+			except socket.timeout:
+				if self.worker and self.worker.is_alive():
+					continue
+				return
+			with connection:
+				connection.settimeout(5)
+				data = b''
+				try:
+					while True:
+						chunk = connection.recv(4096)
+						if not chunk:
+							break
+						data += chunk
+					message = json.loads(data.decode('utf-8'))
+				except Exception as e:
+					log("Invalid message: {0}: {1}".format(data, e))
+					continue
+			if message.get("command") == "stop":
+				if self.cancelled:
+					self.cancelled.set()
+				return
+			self.on_song_change(optparse.Values(dict((option, message.get(option)) for option in TRACK_OPTIONS)))
+	def on_song_change(self, options):
+		if self.cancelled:
+			self.cancelled.set()
+		self.cancelled = CancelEvent()
+		self.worker = threading.Thread(target=self._handle_track, args=(options, self.cancelled), daemon=True)
+		self.worker.start()
+	def _handle_track(self, options, cancelled):
+		try:
+			self.handle_track(options, cancelled)
+		except Exception as e:
+			log(options.filename, e)
+
+def send_to_daemon(message, socket_path, start_daemon=True):
+	# Returns False if daemon is not running and cannot be started.
+	data = json.dumps(message).encode('utf-8')
+	for attempt in range(20):
+		try:
+			with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+				client.connect(socket_path)
+				client.sendall(data)
+			return True
+		except (FileNotFoundError, ConnectionRefusedError):
+			if not start_daemon:
+				return False
+			if attempt == 0:
+				subprocess.Popen([sys.executable, os.path.abspath(__file__), "--daemon"], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+			time.sleep(0.1)
+	return False
+
+def run_submitter():
+	parser = optparse.OptionParser()
+	parser.add_option("-a", "--artist", dest="artist")
+	parser.add_option("-t", "--title", dest="title")
+	parser.add_option("-A", "--album", dest="album")
+	parser.add_option("-l", "--length", dest="length")
+	parser.add_option("-f", "--filename", dest="filename")
+	parser.add_option("--probe_interval", "--probe-interval", dest="probe_interval", type="float", help="Check that song is still playing every N seconds (default {0})".format(PROBE_INTERVAL))
+	parser.add_option("--daemon", dest="daemon", action="store_true", default=False, help="Run resident daemon that waits for songs and submits them")
+	parser.add_option("--no-daemon", dest="no_daemon", action="store_true", default=False, help="Wait for the song and submit it in this process")
+	options, args = parser.parse_args()
+	if options.daemon:
+		flusher = SpoolFlusher(ScrobbleSpool(get_spool_path()))
+		ScrobbleDaemon(get_daemon_socket_path(), functools.partial(handle_track, flusher=flusher), flusher).run()
+		return
+	mandatory = ["filename"]
+	if any(not options.__dict__.get(k) for k in mandatory):
+		log("{0}: All of {1} must be specified".format(options.filename, ', '.join(mandatory)))
+		exit(1)
+
+	if not options.no_daemon:
+		if send_to_daemon(dict((option, getattr(options, option)) for option in TRACK_OPTIONS), get_daemon_socket_path()):
+			exit(0)
+		log("{0}: cannot connect to daemon, waiting in this process".format(options.filename))
+	if handle_track(options):
 		exit(0)
 	else:
 		exit(1)
@@ -1,5 +1,39 @@
+import os
+import time
+import socket
+import struct
+import subprocess
+import json
+import errno
+import threading
+import tempfile
 import unittest
+from unittest import mock
 import moc_submit_lastfm as MOC
+import mediasort as MS
+
+def make_id3v2_frame(frame_id, text, encoding=0, version=3):
+	if encoding == 0:
+		body = b'\x00' + (text if isinstance(text, bytes) else text.encode('latin-1'))
+	elif encoding == 1:
+		body = b'\x01' + text.encode('utf-16')
+	else:
+		body = b'\x03' + text.encode('utf-8')
+	if version == 4:
+		size = bytes([(len(body) >> 21) & 0x7f, (len(body) >> 14) & 0x7f, (len(body) >> 7) & 0x7f, len(body) & 0x7f])
+	else:
+		size = len(body).to_bytes(4, 'big')
+	return frame_id + size + b'\x00\x00' + body
+
+def make_id3v2_tag(frames, version=3, padding=16):
+	data = b''.join(frames) + b'\x00' * padding
+	size = bytes([(len(data) >> 21) & 0x7f, (len(data) >> 14) & 0x7f, (len(data) >> 7) & 0x7f, len(data) & 0x7f])
+	return b'ID3' + bytes([version, 0, 0]) + size + data
+
+def make_id3v1_tag(title=b'', artist=b'', album=b'', year=b'', number=0):
+	return b'TAG' + title.ljust(30, b'\x00') + artist.ljust(30, b'\x00') + album.ljust(30, b'\x00') + year.ljust(4, b'\x00') + b'\x00' * 28 + bytes([0, number, 255])
+
+AUDIO_FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413
 
 class TestExtractInfo(unittest.TestCase):
 	def check_info(self, artist, album, title, info):
@@ -81,5 +115,1312 @@ class TestInfo(unittest.TestCase):
 	def test_should_recognize_only_minutes_length(self):
 		self.assertEqual(MOC.convert_length("10"), 10)
 
+class TestScrobbleDaemon(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.socket_path = os.path.join(self.tmpdir.name, 'daemon.socket')
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def send(self, message):
+		deadline = time.monotonic() + 5
+		while not MOC.send_to_daemon(message, self.socket_path, start_daemon=False):
+			self.assertLess(time.monotonic(), deadline)
+			time.sleep(0.01)
+
+	def test_should_cancel_previous_song_wait(self):
+		results = []
+		started = threading.Semaphore(0)
+		def handle_track(options, cancelled):
+			started.release()
+			results.append((options.filename, cancelled.wait(5)))
+		daemon = MOC.ScrobbleDaemon(self.socket_path, handle_track)
+		thread = threading.Thread(target=daemon.run)
+		thread.start()
+		self.send({'filename' : 'first.mp3', 'length' : '3:00'})
+		started.acquire(timeout=5)
+		self.send({'filename' : 'second.mp3', 'length' : '3:00'})
+		started.acquire(timeout=5)
+		daemon.worker.join(0.1)
+		self.assertEqual(results, [('first.mp3', True)])
+		self.send({'command' : 'stop'})
+		thread.join(5)
+		daemon.worker.join(5)
+		self.assertEqual(results, [('first.mp3', True), ('second.mp3', True)])
+		self.assertFalse(os.path.exists(self.socket_path))
+
+	def test_should_stop_waiting_when_cancelled(self):
+		cancelled = threading.Event()
+		cancelled.set()
+		with mock.patch.object(MOC, 'still_playing') as still_playing, mock.patch.object(MOC, 'log'):
+			self.assertFalse(MOC.wait_until_song_is_half_played(MOC.TrackInfo(filename='a.mp3', length=180), cancelled))
+		self.assertFalse(still_playing.called)
+
+class TestScrobbleSpool(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.spool = MOC.ScrobbleSpool(os.path.join(self.tmpdir.name, 'moc', 'scrobble_spool'))
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def append(self, number, start=1000):
+		info = MOC.TrackInfo(artist='Artist', title='Title {0}'.format(number), album=None, length=180, filename='{0}.mp3'.format(number))
+		self.spool.append(info, start)
+
+	def test_should_deduplicate_tracks_by_filename_and_start(self):
+		self.append(1)
+		self.append(1)
+		self.append(1, start=2000)
+		self.append(2)
+		self.assertEqual([(r['filename'], r['start']) for r in self.spool.pending()], [('1.mp3', 1000), ('1.mp3', 2000), ('2.mp3', 1000)])
+	def test_should_ignore_unfinished_record(self):
+		self.append(1)
+		with open(self.spool.filename, 'a') as f:
+			f.write('{"type": "tra')
+		self.assertEqual(len(self.spool.pending()), 1)
+	def test_should_submit_in_batches_and_keep_failed_ones(self):
+		for number in range(5):
+			self.append(number)
+		batches = []
+		def submit(batch):
+			if len(batches) == 1:
+				batches.append(None)
+				raise OSError('offline')
+			batches.append([r['filename'] for r in batch])
+		with mock.patch.object(MOC, 'log'):
+			self.assertFalse(MOC.flush_spool(self.spool, submit, batch_size=2))
+		self.assertEqual([r['filename'] for r in self.spool.pending()], ['2.mp3', '3.mp3', '4.mp3'])
+		self.assertTrue(MOC.flush_spool(self.spool, submit, batch_size=2))
+		self.assertEqual(batches, [['0.mp3', '1.mp3'], None, ['2.mp3', '3.mp3'], ['4.mp3']])
+		self.assertEqual(self.spool.pending(), [])
+		self.assertEqual(os.path.getsize(self.spool.filename), 0)
+	def test_should_drop_rejected_track_after_few_attempts(self):
+		for number in range(4):
+			self.append(number)
+		submitted = []
+		def submit(batch):
+			if any(record['filename'] == '2.mp3' for record in batch):
+				raise subprocess.CalledProcessError(1, 'lastfmsubmit')
+			submitted.extend(record['filename'] for record in batch)
+		with mock.patch.object(MOC, 'log'):
+			for attempt in range(MOC.ScrobbleSpool.MAX_ATTEMPTS - 1):
+				self.assertFalse(MOC.flush_spool(self.spool, submit))
+				self.assertEqual([record['filename'] for record in self.spool.pending()], ['2.mp3'])
+			self.assertTrue(MOC.flush_spool(self.spool, submit))
+		self.assertEqual(sorted(submitted), ['0.mp3', '1.mp3', '3.mp3'])
+		self.assertEqual(self.spool.pending(), [])
+		with open(self.spool.rejected_filename) as f:
+			self.assertEqual([json.loads(line)['filename'] for line in f], ['2.mp3'])
+	def test_should_not_blame_tracks_when_whole_batch_is_rejected(self):
+		self.append(1)
+		self.append(2)
+		def submit(batch):
+			raise subprocess.CalledProcessError(1, 'lastfmsubmit')
+		with mock.patch.object(MOC, 'log'):
+			for attempt in range(MOC.ScrobbleSpool.MAX_ATTEMPTS + 1):
+				self.assertFalse(MOC.flush_spool(self.spool, submit))
+		self.assertEqual([record['attempts'] for record in self.spool.pending()], [0, 0])
+	def test_should_not_bisect_batch_rejected_entirely(self):
+		for number in range(50):
+			self.append(number)
+		calls = []
+		def submit(batch):
+			calls.append(len(batch))
+			raise subprocess.CalledProcessError(1, 'lastfmsubmit')
+		with mock.patch.object(MOC, 'log'):
+			self.assertFalse(MOC.flush_spool(self.spool, submit))
+		self.assertLessEqual(len(calls), 13)
+		self.assertEqual(len(self.spool.pending()), 50)
+	def test_should_find_rejected_tracks_in_both_halves(self):
+		for number in range(8):
+			self.append(number)
+		submitted = []
+		def submit(batch):
+			if any(record['filename'] in ('1.mp3', '6.mp3') for record in batch):
+				raise subprocess.CalledProcessError(1, 'lastfmsubmit')
+			submitted.extend(record['filename'] for record in batch)
+		with mock.patch.object(MOC, 'log'):
+			self.assertFalse(MOC.flush_spool(self.spool, submit))
+		self.assertEqual(sorted(submitted), ['0.mp3', '2.mp3', '3.mp3', '4.mp3', '5.mp3', '7.mp3'])
+		self.assertEqual([(record['filename'], record['attempts']) for record in self.spool.pending()], [('1.mp3', 1), ('6.mp3', 1)])
+	def test_should_not_submit_concurrently(self):
+		self.append(1)
+		submitted, started = [], threading.Event()
+		def submit(batch):
+			started.set()
+			time.sleep(0.1)
+			submitted.extend(record['filename'] for record in batch)
+		thread = threading.Thread(target=MOC.flush_spool, args=(self.spool, submit))
+		thread.start()
+		started.wait(5)
+		self.assertTrue(MOC.flush_spool(MOC.ScrobbleSpool(self.spool.filename), submit))
+		thread.join(5)
+		self.assertEqual(submitted, ['1.mp3'])
+	def test_should_pass_all_tracks_to_single_lastfmsubmit(self):
+		self.append(1, start=0)
+		self.append(2, start=60)
+		with mock.patch.object(MOC, 'get_lastfmsubmit', return_value='lastfmsubmit'), mock.patch('subprocess.check_call') as check_call:
+			MOC.submit_batch_to_lastfm(self.spool.pending())
+		check_call.assert_called_once_with(['lastfmsubmit',
+			'--artist', 'Artist', '--title', 'Title 1', '--length', '180', '--album', '', '--time', '1970-01-01 00:00:00',
+			'--artist', 'Artist', '--title', 'Title 2', '--length', '180', '--album', '', '--time', '1970-01-01 00:01:00',
+			])
+
+class TestPlaylistIndex(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.playlist = os.path.join(self.tmpdir.name, 'playlist.m3u')
+		self.index = MOC.PlaylistIndex(self.playlist, os.path.join(self.tmpdir.name, 'playlist_index.json'))
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def write(self, filenames, mode='w'):
+		with open(self.playlist, mode) as f:
+			for filename in filenames:
+				f.write('#EXTINF:180,Artist - Title\n{0}\n'.format(filename))
+
+	def test_should_match_exact_path(self):
+		self.write(['/music/song.mp3.bak', '/music/song.mp3', '/music/other.mp3'])
+		self.assertEqual(self.index.find('/music/song.mp3'), 1)
+		self.assertEqual(self.index.find('/music/other.mp3'), 2)
+		self.assertEqual(self.index.find('/music/song'), -1)
+	def test_should_parse_only_appended_entries(self):
+		self.write(['/music/{0}.mp3'.format(number) for number in range(3)])
+		self.assertEqual(self.index.find('/music/0.mp3'), 0)
+		self.index.cache['entries']['/music/cached.mp3'] = 100
+		self.write(['/music/3.mp3'], mode='a')
+		self.assertEqual(self.index.find('/music/3.mp3'), 3)
+		self.assertEqual(self.index.find('/music/cached.mp3'), 100)
+	def test_should_keep_index_in_memory_and_load_it_once(self):
+		self.write(['/music/0.mp3', '/music/1.mp3'])
+		self.assertEqual(self.index.find('/music/1.mp3'), 1)
+		index = MOC.PlaylistIndex(self.playlist, self.index.cache_file)
+		with mock.patch.object(index, '_parse') as parse_mock, mock.patch('json.load', wraps=json.load) as load_mock:
+			self.assertEqual(index.find('/music/1.mp3'), 1)
+			self.assertEqual(index.find('/music/0.mp3'), 0)
+		self.assertFalse(parse_mock.called)
+		self.assertEqual(load_mock.call_count, 1)
+	def test_should_count_empty_lines_as_entries(self):
+		with open(self.playlist, 'w') as f:
+			f.write('#EXTM3U\n/music/0.mp3\n\n/music/2.mp3\n')
+		self.assertEqual(self.index.find('/music/2.mp3'), 2)
+		self.assertEqual(self.index.find(''), -1)
+	def test_should_rebuild_rewritten_playlist(self):
+		self.write(['/music/0.mp3', '/music/1.mp3'])
+		self.assertEqual(self.index.find('/music/1.mp3'), 1)
+		self.write(['/music/1.mp3', '/music/0.mp3', '/music/2.mp3'])
+		self.assertEqual(self.index.find('/music/1.mp3'), 0)
+		self.assertEqual(self.index.find('/music/2.mp3'), 2)
+
+class FakeClock:
+	def __init__(self):
+		self.now = 1000.0
+	def monotonic(self):
+		return self.now
+	def wait(self, timeout):
+		self.now += timeout
+		return False
+	def is_set(self):
+		return False
+
+class TestPlaybackScheduler(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		for patcher in [
+				mock.patch.object(MOC.time, 'monotonic', self.clock.monotonic),
+				mock.patch.object(MOC, 'connect_to_moc', return_value=None),
+				mock.patch.object(MOC, 'log'),
+				]:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+	def probe(self, info, moc=None):
+		self.probes.append(self.clock.now - 1000)
+		return self.probes[-1] < self.stop_at
+	def wait(self, length, probe_interval, stop_at=float('inf')):
+		self.probes, self.stop_at = [], stop_at
+		with mock.patch.object(MOC, 'still_playing', self.probe):
+			return MOC.wait_until_song_is_half_played(MOC.TrackInfo(filename='a.mp3', length=length), self.clock, probe_interval)
+
+	def test_should_probe_sparsely_until_half_of_song(self):
+		self.assertTrue(self.wait(length=25 * 60 * 60 * 2 + 1, probe_interval=12 * 60 * 60))
+		self.assertEqual(self.probes, [12 * 60 * 60, 24 * 60 * 60, 25 * 60 * 60 + 0.5])
+	def test_should_detect_skip_on_probe(self):
+		self.assertFalse(self.wait(length=600, probe_interval=60, stop_at=100))
+		self.assertEqual(self.probes, [60, 120])
+
+class FakeMocServer:
+	def __init__(self, socket_path, state, filename, events=b''):
+		self.state, self.filename, self.events = state, filename, events
+		self.commands = []
+		self.connection = None
+		self.disconnected = threading.Event()
+		self.stopped = False
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(socket_path)
+		self.server.listen(1)
+		self.server.settimeout(0.05)
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.start()
+	def serve(self):
+		while not self.stopped:
+			try:
+				connection, address = self.server.accept()
+			except socket.timeout:
+				continue
+			with connection:
+				self.connection = connection
+				while True:
+					data = connection.recv(4)
+					if not data:
+						break
+					command = struct.unpack('=i', data)[0]
+					self.commands.append(command)
+					if command == MOC.MOC_CMD_GET_STATE:
+						connection.sendall(self.events + struct.pack('=ii', MOC.MOC_EV_DATA, self.state))
+					elif command == MOC.MOC_CMD_GET_SNAME:
+						filename = self.filename.encode('utf-8')
+						connection.sendall(struct.pack('=ii', MOC.MOC_EV_DATA, len(filename)) + filename)
+					elif command == MOC.MOC_CMD_DISCONNECT:
+						break
+				self.disconnected.set()
+	def get_commands(self):
+		# Client does not wait for the server to read its last command.
+		self.disconnected.wait(5)
+		return self.commands
+	def send_event(self, event):
+		deadline = time.monotonic() + 5
+		while not self.connection and time.monotonic() < deadline:
+			time.sleep(0.01)
+		self.connection.sendall(struct.pack('=i', event))
+	def close(self):
+		self.stopped = True
+		self.thread.join()
+		self.server.close()
+
+class TestMocClient(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		patcher = mock.patch.object(MOC, 'get_moc_data_dir', return_value=self.tmpdir.name)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.info = MOC.TrackInfo(filename='/music/Кино/01 Группа крови.mp3', length=240)
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def start_server(self, state, filename, events=b''):
+		server = FakeMocServer(os.path.join(self.tmpdir.name, 'socket2'), state, filename, events)
+		self.addCleanup(server.close)
+		return server
+
+	def test_should_query_moc_server(self):
+		status_msg = 'Loading...'.encode()
+		events = struct.pack('=i', 0x01) + struct.pack('=ii', MOC.MOC_EV_STATUS_MSG, len(status_msg)) + status_msg
+		server = self.start_server(MOC.MOC_STATE_PLAY, self.info.filename, events)
+		with mock.patch('subprocess.Popen') as popen:
+			self.assertTrue(MOC.still_playing(self.info))
+		self.assertFalse(popen.called)
+		self.assertEqual(server.get_commands(), [MOC.MOC_CMD_GET_STATE, MOC.MOC_CMD_GET_SNAME, MOC.MOC_CMD_DISCONNECT])
+
+	def test_should_detect_stopped_or_changed_song(self):
+		server = self.start_server(MOC.MOC_STATE_STOP, self.info.filename)
+		self.assertFalse(MOC.still_playing(self.info))
+		server.state, server.filename = MOC.MOC_STATE_PAUSE, '/music/other.mp3'
+		with mock.patch.object(MOC, 'log'):
+			self.assertFalse(MOC.still_playing(self.info))
+
+	def test_should_probe_on_state_change_event(self):
+		server = self.start_server(MOC.MOC_STATE_PLAY, self.info.filename)
+		results = []
+		thread = threading.Thread(target=lambda: results.append(MOC.wait_until_song_is_half_played(self.info, probe_interval=60)))
+		thread.start()
+		server.state = MOC.MOC_STATE_STOP
+		server.send_event(MOC.MOC_EV_STATE)
+		thread.join(5)
+		self.assertEqual(results, [False])
+		self.assertEqual(server.get_commands(), [MOC.MOC_CMD_GET_STATE, MOC.MOC_CMD_DISCONNECT])
+
+	def test_should_react_to_server_exit(self):
+		server = self.start_server(MOC.MOC_STATE_PLAY, self.info.filename)
+		with MOC.MocClient(os.path.join(self.tmpdir.name, 'socket2')) as moc:
+			server.send_event(0x02) # Current time, not a state change.
+			server.send_event(MOC.MOC_EV_EXIT)
+			start = time.monotonic()
+			self.assertTrue(MOC.wait_for_moc_state_change(moc, MOC.CancelEvent(), 5))
+			self.assertLess(time.monotonic() - start, 1)
+
+	def test_should_cancel_waiting_on_socket_immediately(self):
+		self.start_server(MOC.MOC_STATE_PLAY, self.info.filename)
+		cancelled = MOC.CancelEvent()
+		results = []
+		thread = threading.Thread(target=lambda: results.append(MOC.wait_until_song_is_half_played(self.info, cancelled, probe_interval=60)))
+		start = time.monotonic()
+		thread.start()
+		time.sleep(0.1)
+		with mock.patch.object(MOC, 'log'):
+			cancelled.set()
+			thread.join(5)
+		self.assertEqual(results, [False])
+		self.assertLess(time.monotonic() - start, 1)
+
+	def test_should_fall_back_to_mocp_without_socket(self):
+		with mock.patch.object(MOC, 'still_playing_with_mocp', return_value=True) as still_playing_with_mocp:
+			self.assertTrue(MOC.still_playing(self.info))
+		still_playing_with_mocp.assert_called_once_with(self.info)
+
+class TestID3Reader(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def make_file(self, data):
+		filename = os.path.join(self.tmpdir.name, 'track.mp3')
+		with open(filename, 'wb') as f:
+			f.write(data)
+		return filename
+
+	def test_should_read_id3v23_latin1_frames_as_raw_bytes(self):
+		tag = make_id3v2_tag([
+			make_id3v2_frame(b'TPE1', 'Кино'.encode('cp1251')),
+			make_id3v2_frame(b'TALB', b'Album'),
+			make_id3v2_frame(b'TYER', b'1988'),
+			make_id3v2_frame(b'TRCK', b'3/10'),
+			make_id3v2_frame(b'TIT2', b'Title'),
+			])
+		taginfo = MS.get_taginfo_for_file(self.make_file(tag + AUDIO_FRAME))
+		self.assertEqual(taginfo.artist, 'Кино'.encode('cp1251'))
+		self.assertEqual(taginfo.album, b'Album')
+		self.assertEqual(taginfo.year, '1988')
+		self.assertEqual(taginfo.number, b'3')
+		self.assertEqual(taginfo.title, b'Title')
+
+	def test_should_decode_unicode_frames(self):
+		tag = make_id3v2_tag([
+			make_id3v2_frame(b'TPE1', 'Кино', encoding=1, version=4),
+			make_id3v2_frame(b'TIT2', 'Звезда', encoding=3, version=4),
+			make_id3v2_frame(b'TDRC', '1989-01-01', encoding=3, version=4),
+			], version=4)
+		taginfo = MS.get_taginfo_for_file(self.make_file(tag + AUDIO_FRAME))
+		self.assertEqual(taginfo.artist, 'Кино')
+		self.assertEqual(taginfo.title, 'Звезда')
+		self.assertEqual(taginfo.year, '1989-01-01')
+		self.assertEqual(taginfo.album, '')
+
+	def test_should_fall_back_to_id3v1(self):
+		tag = make_id3v2_tag([make_id3v2_frame(b'TIT2', b'Title')])
+		v1 = make_id3v1_tag(title=b'Other', artist=b'Artist', album=b'Album', year=b'2001', number=7)
+		taginfo = MS.get_taginfo_for_file(self.make_file(tag + AUDIO_FRAME + v1))
+		self.assertEqual(taginfo.title, b'Title')
+		self.assertEqual(taginfo.artist, b'Artist')
+		self.assertEqual(taginfo.album, b'Album')
+		self.assertEqual(taginfo.year, '2001')
+		self.assertEqual(taginfo.number, 7)
+
+	def test_should_return_empty_tags_for_untagged_file(self):
+		taginfo = MS.get_taginfo_for_file(self.make_file(AUDIO_FRAME))
+		self.assertEqual(taginfo.artist, '')
+		self.assertEqual(taginfo.year, '')
+
+class TestReadAllTags(unittest.TestCase):
+	def test_should_keep_order_and_collect_errors(self):
+		def read_taginfo(filename):
+			if filename == 'broken.mp3':
+				raise IOError('cannot read')
+			taginfo = MS.TagInfo()
+			taginfo.title = filename
+			return taginfo
+		filenames = ['{0:0>2}.mp3'.format(index) for index in range(20)] + ['broken.mp3']
+		tags, errors = MS.read_all_tags(filenames, read_taginfo, jobs=4)
+		self.assertEqual(list(tags.keys()), filenames[:-1])
+		self.assertEqual([tags[filename].title for filename in tags], filenames[:-1])
+		self.assertEqual([filename for filename, e in errors], ['broken.mp3'])
+
+class TestTagCache(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.tmpdir.name, 'track.mp3')
+		with open(self.filename, 'wb') as f:
+			f.write(AUDIO_FRAME)
+		self.cache = MS.TagCache(os.path.join(self.tmpdir.name, 'cache', 'cache.sqlite'))
+	def tearDown(self):
+		self.cache.db.close()
+		self.tmpdir.cleanup()
+	def make_taginfo(self):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.title, taginfo.year, taginfo.number = b'Artist', 'Title', '2001', b'3'
+		return taginfo
+
+	def test_should_keep_value_types(self):
+		self.cache.put(self.filename, 'reader', self.make_taginfo())
+		taginfo = self.cache.get(self.filename, 'reader')
+		self.assertEqual(taginfo.artist, b'Artist')
+		self.assertEqual(taginfo.title, 'Title')
+		self.assertEqual(taginfo.album, '')
+		self.assertEqual(taginfo.number, b'3')
+		self.assertIsNone(self.cache.get(self.filename, 'other_reader'))
+
+	def test_should_invalidate_changed_file(self):
+		self.cache.put(self.filename, 'reader', self.make_taginfo())
+		with open(self.filename, 'ab') as f:
+			f.write(AUDIO_FRAME)
+		self.assertIsNone(self.cache.get(self.filename, 'reader'))
+
+	def test_should_evict_old_and_excessive_entries(self):
+		self.cache.put(self.filename, 'reader', self.make_taginfo())
+		self.cache.evict(max_size=0)
+		self.assertIsNone(self.cache.get(self.filename, 'reader'))
+		self.cache.put(self.filename, 'reader', self.make_taginfo())
+		self.cache.now += 100
+		self.cache.evict(max_age=10)
+		self.assertIsNone(self.cache.get(self.filename, 'reader'))
+
+	def test_should_evict_only_entries_beyond_size_limit(self):
+		filenames = []
+		for index in range(100):
+			filenames.append(os.path.join(self.tmpdir.name, '{0:0>3}.mp3'.format(index)))
+			with open(filenames[-1], 'wb') as f:
+				f.write(AUDIO_FRAME)
+			self.cache.put(filenames[-1], 'reader', self.make_taginfo())
+		entry_size = self.cache.db.execute('SELECT entry_size FROM tags').fetchone()[0]
+		self.cache.evict(max_size=entry_size * 50)
+		self.assertEqual(self.cache.db.execute('SELECT COUNT(*) FROM tags').fetchone()[0], 50)
+		self.assertIsNotNone(self.cache.get(filenames[-1], 'reader'))
+		self.assertIsNone(self.cache.get(filenames[0], 'reader'))
+
+	def test_should_skip_reading_cached_files(self):
+		calls = []
+		def read_taginfo(filename):
+			calls.append(filename)
+			return self.make_taginfo()
+		tags, errors = MS.read_all_tags([self.filename], read_taginfo, cache=self.cache)
+		tags, errors = MS.read_all_tags([self.filename], read_taginfo, cache=self.cache)
+		self.assertEqual(calls, [self.filename])
+		self.assertEqual(tags[self.filename].artist, b'Artist')
+
+	def test_should_report_vanished_file(self):
+		missing = os.path.join(self.tmpdir.name, 'missing.mp3')
+		tags, errors = MS.read_all_tags([missing, self.filename], lambda filename: self.make_taginfo(), cache=self.cache)
+		self.assertEqual(list(tags), [self.filename])
+		self.assertEqual([filename for filename, e in errors], [missing])
+
+class TestLibraryIndex(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.tmpdir.name, 'lib')
+		for path in ['Rock/The Beatles/1969-Abbey Road', 'Rock/Queen', 'Metal/Motorhead', 'Metal/Queen']:
+			os.makedirs(os.path.join(self.root, path))
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_find_artist_case_insensitive(self):
+		library = MS.LibraryIndex(self.root, 3).scan()
+		self.assertEqual(MS.get_artist_subdir(self.root, 'the beatles', library), ('Rock', 'The Beatles'))
+		self.assertEqual(MS.get_artist_subdir(self.root, 'Unknown', library), ('', 'Unknown'))
+		self.assertIn(MS.get_artist_subdir(self.root, 'QUEEN', library)[1], 'Queen')
+
+	def test_should_find_artist_by_normalized_name(self):
+		library = MS.LibraryIndex(self.root, 3).scan()
+		self.assertEqual(MS.get_artist_subdir(self.root, 'Beatles, The', library), ('Rock', 'The Beatles'))
+		self.assertEqual(MS.get_artist_subdir(self.root, 'Motörhead', library), ('Metal', 'Motorhead'))
+		self.assertEqual(MS.get_artist_subdir(self.root, 'Motörhead', None), ('Metal', 'Motorhead'))
+		self.assertEqual(MS.get_artist_key('  The   Beatles '), MS.get_artist_key('beatles'))
+		self.assertEqual(MS.get_artist_key('A-ha'), 'a ha')
+		self.assertNotEqual(MS.get_artist_key('Los Lobos'), MS.get_artist_key('Lobos'))
+		self.addCleanup(MS.set_articles, MS.ARTICLES)
+		MS.set_articles(['the', 'los'])
+		self.assertEqual(MS.get_artist_key('Los Lobos'), MS.get_artist_key('Lobos'))
+
+	def test_should_suggest_similar_artists(self):
+		library = MS.LibraryIndex(self.root, 3).scan()
+		self.assertEqual([value for score, value in library.suggest_artists('Beatle')], [('Rock', 'The Beatles')])
+		self.assertEqual(library.suggest_artists('Manowar'), [])
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Motorhed', 'Album', '1980', 1, 'Title'
+		with mock.patch('builtins.input', return_value='0') as input_mock, mock.patch('builtins.print'):
+			self.assertEqual(MS.get_new_filename(taginfo, self.root, True, library), os.path.join(self.root, 'Metal', 'Motorhead', '1980-Album', '01-Title.mp3'))
+			self.assertEqual(MS.get_new_filename(taginfo, self.root, True, library), os.path.join(self.root, 'Metal', 'Motorhead', '1980-Album', '01-Title.mp3'))
+		self.assertEqual(input_mock.call_count, 1)
+		taginfo.artist = 'Beatle'
+		subdir = library.listdir(self.root)[0]
+		with mock.patch('builtins.input', return_value='0') as input_mock, mock.patch('builtins.print'), mock.patch.object(MS, 'default_subdir', None):
+			self.assertEqual(MS.get_new_filename(taginfo, self.root, True, library, ask=False), os.path.join(self.root, subdir, 'Beatle', '1980-Album', '01-Title.mp3'))
+		self.assertEqual(input_mock.call_args_list, [mock.call('Which subdir?')])
+
+	def test_should_resolve_existing_path_part(self):
+		library = MS.LibraryIndex(self.root, 3).scan()
+		path = os.path.join(self.root, 'rock', 'the beatles', '1969-abbey road', 'new', '01-Track.mp3')
+		expected = MS.get_exists_path_part(path)
+		self.assertEqual(MS.get_exists_path_part(path, library), expected)
+		self.assertEqual(expected, (os.path.join(self.root, 'Rock', 'The Beatles', '1969-Abbey Road'), os.path.join('new', '01-Track.mp3')))
+
+	def test_should_reuse_unchanged_dirs(self):
+		library = MS.LibraryIndex(self.root, 3).scan()
+		known_dirs = dict(library.dirs)
+		known_dirs[os.path.join(self.root, 'Rock')] = (known_dirs[os.path.join(self.root, 'Rock')][0], ['Cached'], ['Cached'])
+		os.makedirs(os.path.join(self.root, 'Metal', 'Manowar'))
+		library = MS.LibraryIndex(self.root, 3).scan(known_dirs)
+		self.assertEqual(library.listdir(os.path.join(self.root, 'Rock')), ['Cached'])
+		self.assertIn('Manowar', library.listdir(os.path.join(self.root, 'Metal')))
+
+class TestCopyWithNewTags(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.src = os.path.join(self.tmpdir.name, 'src.mp3')
+		self.dst = os.path.join(self.tmpdir.name, 'dst.mp3')
+		self.payload = AUDIO_FRAME * 3
+		with open(self.src, 'wb') as f:
+			f.write(make_id3v2_tag([make_id3v2_frame(b'TIT2', b'Old title')]))
+			f.write(self.payload)
+			f.write(make_id3v1_tag(title=b'Old title'))
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_replace_tags_and_keep_payload(self):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Кино', 'Album', '1988', 3, 'Title'
+		copied = MS.copy_with_new_tags(self.src, self.dst, taginfo)
+		self.assertEqual(copied, len(self.payload))
+		with open(self.dst, 'rb') as f:
+			data = f.read()
+		self.assertTrue(data.endswith(self.payload))
+		self.assertEqual(len(data) - len(self.payload), len(MS.make_id3v2_tag(taginfo)))
+		new_taginfo = MS.get_taginfo_for_file(self.dst)
+		self.assertEqual(new_taginfo.artist, 'Кино')
+		self.assertEqual(new_taginfo.album, b'Album')
+		self.assertEqual(new_taginfo.title, b'Title')
+		self.assertEqual(new_taginfo.year, '1988')
+		self.assertEqual(new_taginfo.number, b'03')
+
+	def test_should_write_non_ascii_text_unambiguously(self):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Café Tacvba', 'Re', '1994', 1, 'Title'
+		MS.copy_with_new_tags(self.src, self.dst, taginfo)
+		new_taginfo = MS.get_taginfo_for_file(self.dst)
+		self.assertEqual(new_taginfo.artist, 'Café Tacvba')
+		self.assertEqual(new_taginfo.album, b'Re')
+
+	def test_should_fail_on_short_copy(self):
+		with mock.patch('mediasort.copy_file_range', return_value=len(self.payload) - 1):
+			self.assertRaises(IOError, MS.copy_with_new_tags, self.src, self.dst, MS.TagInfo())
+
+	def test_should_find_audio_payload(self):
+		with open(self.src, 'rb') as f:
+			start, end = MS.get_audio_payload_range(f)
+			f.seek(start)
+			self.assertEqual(f.read(end - start), self.payload)
+
+	def test_should_reserve_padding(self):
+		taginfo = MS.TagInfo()
+		with open(self.dst, 'wb') as f:
+			f.write(MS.make_id3v2_tag(taginfo, padding=100))
+		with open(self.dst, 'rb') as f:
+			version, frames, tag_size = MS.read_id3v2_tag(f)
+		self.assertEqual(tag_size, 110)
+		self.assertEqual(frames, [])
+
+class TestImportModes(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.src = os.path.join(self.tmpdir.name, 'src.mp3')
+		self.dst = os.path.join(self.tmpdir.name, 'dst.mp3')
+		with open(self.src, 'wb') as f:
+			f.write(AUDIO_FRAME)
+		self.taginfo = MS.TagInfo()
+		self.taginfo.artist, self.taginfo.album, self.taginfo.year, self.taginfo.number, self.taginfo.title = 'Artist', 'Album', '2001', 1, 'Title'
+		MS.retag_in_place(self.src, self.taginfo)
+		with open(self.src, 'rb') as f:
+			self.src_data = f.read()
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def make_taginfo(self, title):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Artist', 'Album', '2001', 1, title
+		return taginfo
+
+	def test_should_update_tags_within_padding(self):
+		inode, size = os.stat(self.src).st_ino, os.stat(self.src).st_size
+		self.assertTrue(MS.update_tags_in_place(self.src, self.make_taginfo('New title')))
+		self.assertEqual((os.stat(self.src).st_ino, os.stat(self.src).st_size), (inode, size))
+		self.assertEqual(MS.get_taginfo_for_file(self.src).title, b'New title')
+		self.assertFalse(MS.update_tags_in_place(self.src, self.make_taginfo('X' * 4096)))
+
+	def test_should_hardlink_only_files_with_same_tags(self):
+		self.assertTrue(MS.has_same_tags(self.src, self.taginfo))
+		self.assertEqual(MS.import_file(self.src, self.dst, self.taginfo, 'hardlink'), 'hardlink')
+		self.assertTrue(os.path.samefile(self.src, self.dst))
+		os.remove(self.dst)
+		self.assertNotEqual(MS.import_file(self.src, self.dst, self.make_taginfo('New title'), 'hardlink'), 'hardlink')
+		self.assertFalse(os.path.samefile(self.src, self.dst))
+		self.assertEqual(MS.get_taginfo_for_file(self.dst).title, b'New title')
+		with open(self.src, 'rb') as f:
+			self.assertEqual(f.read(), self.src_data)
+
+	def test_should_copy_when_hardlink_is_not_possible(self):
+		with mock.patch('os.link', side_effect=OSError(errno.EMLINK, 'Too many links')):
+			self.assertIn(MS.place_file(self.src, self.dst, 'hardlink'), ('reflink', 'copy'))
+		self.assertFalse(os.path.samefile(self.src, self.dst))
+		self.assertEqual(os.listdir(os.path.dirname(self.dst)).count(os.path.basename(self.dst) + '.mediasort-tmp'), 0)
+
+	def test_should_never_change_reflink_source(self):
+		MS.import_file(self.src, self.dst, self.make_taginfo('New title'), 'reflink')
+		self.assertEqual(MS.get_taginfo_for_file(self.dst).title, b'New title')
+		with open(self.src, 'rb') as f:
+			self.assertEqual(f.read(), self.src_data)
+
+	def test_should_move_file(self):
+		self.assertEqual(MS.import_file(self.src, self.dst, self.make_taginfo('New title'), 'move'), 'move')
+		self.assertFalse(os.path.exists(self.src))
+		self.assertEqual(MS.get_taginfo_for_file(self.dst).title, b'New title')
+
+class TestImportExecutor(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.tasks = []
+		for index in range(8):
+			filename = os.path.join(self.tmpdir.name, '{0}.mp3'.format(index))
+			with open(filename, 'wb') as f:
+				f.write(AUDIO_FRAME)
+			self.tasks.append((filename, filename + '.new', None))
+		self.lock = threading.Lock()
+		self.running, self.max_running, self.imported = 0, 0, []
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def import_func(self, filename, new_filename, taginfo):
+		with self.lock:
+			self.running += 1
+			self.max_running = max(self.max_running, self.running)
+		time.sleep(0.01)
+		with self.lock:
+			self.running -= 1
+			self.imported.append(filename)
+		if filename.endswith('3.mp3'):
+			raise IOError('cannot write')
+
+	def test_should_import_all_files_and_collect_errors(self):
+		with mock.patch('mediasort.is_rotational_device', return_value=False):
+			errors = MS.ImportExecutor(self.import_func, jobs=4).run(self.tasks)
+		self.assertEqual(sorted(self.imported), sorted(task[0] for task in self.tasks))
+		self.assertEqual([filename for filename, e in errors], [self.tasks[3][0]])
+		self.assertGreater(self.max_running, 1)
+
+	def test_should_limit_jobs_on_rotational_device(self):
+		with mock.patch('mediasort.is_rotational_device', return_value=True):
+			MS.ImportExecutor(self.import_func, jobs=4).run(self.tasks)
+		self.assertEqual(self.max_running, 1)
+
+	def test_should_report_vanished_file(self):
+		os.remove(self.tasks[5][0])
+		with mock.patch('mediasort.is_rotational_device', return_value=False):
+			errors = MS.ImportExecutor(self.import_func, jobs=4).run(self.tasks)
+		self.assertEqual(len(self.imported), 7)
+		self.assertEqual(sorted(filename for filename, e in errors), [self.tasks[3][0], self.tasks[5][0]])
+
+class TestBatchMode(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.inbox = os.path.join(self.tmpdir.name, 'inbox')
+		self.root = os.path.join(self.tmpdir.name, 'lib')
+		os.makedirs(self.root)
+		for artist, year, album in [('First', b'2001', 'One'), ('Second', b'2002', 'Two')]:
+			album_dir = os.path.join(self.inbox, 'downloads', '{0} - {1}'.format(artist, album))
+			os.makedirs(album_dir)
+			for number in range(1, 4):
+				with open(os.path.join(album_dir, '{0:0>2} - Track.mp3'.format(number)), 'wb') as f:
+					f.write(make_id3v2_tag([
+						make_id3v2_frame(b'TPE1', artist.encode()),
+						make_id3v2_frame(b'TYER', year),
+						]) + AUDIO_FRAME)
+			with open(os.path.join(album_dir, 'cover.jpg'), 'wb') as f:
+				f.write(b'')
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_find_album_dirs(self):
+		albums = list(MS.walk_albums(self.inbox, batch=True))
+		self.assertEqual([len(mp3) for mp3, other in albums], [3, 3])
+		self.assertEqual([len(other) for mp3, other in albums], [1, 1])
+
+	def test_should_match_extensions_ignoring_case(self):
+		album_dir = os.path.join(self.inbox, 'downloads', 'First - One')
+		os.rename(os.path.join(album_dir, '01 - Track.mp3'), os.path.join(album_dir, '01 - Track.MP3'))
+		with open(os.path.join(album_dir, '04 - Track.Flac'), 'wb') as f:
+			f.write(b'fLaC')
+		albums = list(MS.walk_albums(self.inbox, ['mp3'], batch=True))
+		self.assertEqual([len(mp3) for mp3, other in albums], [3, 3])
+		albums = list(MS.walk_albums(self.inbox, ['mp3', 'flac'], batch=True))
+		self.assertEqual([len(mp3) for mp3, other in albums], [4, 3])
+
+	def test_should_stream_files_to_reader(self):
+		read_started = threading.Event()
+		walk_order = []
+		def iter_filenames():
+			for mp3, other in MS.walk_albums(self.inbox, batch=True):
+				yield from mp3
+				# Reading of the first album starts before the rest is walked.
+				walk_order.append(read_started.wait(timeout=5))
+		def read_taginfo(filename):
+			read_started.set()
+			return MS.TagInfo()
+		tags, errors = MS.read_all_tags(iter_filenames(), read_taginfo, jobs=2)
+		self.assertEqual(walk_order, [True, True])
+		self.assertEqual(len(tags), 6)
+
+	def test_should_place_other_formats_without_retagging(self):
+		album_dir = os.path.join(self.inbox, 'downloads', 'First - One')
+		filename = os.path.join(album_dir, '04 - Track.flac')
+		with open(filename, 'wb') as f:
+			f.write(b'fLaC' + b'\x00' * 64)
+		args = MS.make_arg_parser().parse_args([self.inbox, '--root_dir', self.root, '--batch', '--no_cache', '--formats', 'mp3,flac'])
+		plan, other_filenames, max_paths, paths_to_make = MS.get_all_data(self.inbox, args)
+		filename, new_filename, taginfo = [task for task in plan if task[0] == filename][0]
+		self.assertEqual(new_filename, os.path.join(self.root, 'First', '2001-One', '04-Track.flac'))
+		os.makedirs(os.path.dirname(new_filename))
+		self.assertEqual(MS.import_file(filename, new_filename, taginfo), 'copy')
+		with open(new_filename, 'rb') as f:
+			self.assertEqual(f.read(), b'fLaC' + b'\x00' * 64)
+
+	def test_should_repair_tags_per_album(self):
+		args = MS.make_arg_parser().parse_args([self.inbox, '--root_dir', self.root, '--batch', '--no_cache'])
+		plan, other_filenames, max_paths, paths_to_make = MS.get_all_data(self.inbox, args)
+		self.assertEqual(len(plan), 6)
+		self.assertEqual(len(other_filenames), 2)
+		self.assertEqual([(taginfo.artist, taginfo.year) for filename, new_filename, taginfo in plan], [('First', '2001')] * 3 + [('Second', '2002')] * 3)
+		self.assertEqual(plan.get_destination(0), os.path.join(self.root, 'First', '2001-One', '01-Track.mp3'))
+		self.assertEqual(paths_to_make, {os.path.join('First', '2001-One'), os.path.join('Second', '2002-Two')})
+
+	def test_should_parse_album_dirs_of_absolute_batch_root(self):
+		for album_dir in ['Artist - 2005 - Album', os.path.join('Other Artist', '2006 - Second', 'CD1')]:
+			os.makedirs(os.path.join(self.inbox, album_dir))
+			with open(os.path.join(self.inbox, album_dir, '01 - Song.mp3'), 'wb') as f:
+				f.write(AUDIO_FRAME)
+		os.makedirs(os.path.join(self.root, 'Rock'))
+		args = MS.make_arg_parser().parse_args([self.inbox, '--root_dir', self.root, '--batch', '--no_cache', '--use_subdirs', '1'])
+		with mock.patch.object(MS, 'default_subdir', 'Rock'):
+			plan, other_filenames, max_paths, paths_to_make = MS.get_all_data(os.path.abspath(self.inbox), args)
+		destinations = set(new_filename for filename, new_filename, taginfo in plan if 'Song' in filename)
+		self.assertEqual(destinations, {os.path.join(self.root, 'Rock', 'Artist', '2005-Album', '01-Song.mp3'), os.path.join(self.root, 'Rock', 'Other Artist', '2006-Second', '01-Song.mp3')})
+
+	def test_should_read_tags_album_by_album(self):
+		args = MS.make_arg_parser().parse_args([self.inbox, '--root_dir', self.root, '--batch', '--no_cache'])
+		albums = list(MS.read_albums(self.inbox, args, True))
+		self.assertEqual([len(filenames) for filenames, other_filenames, tags, errors in albums], [3, 3])
+		for filenames, other_filenames, tags, errors in albums:
+			self.assertEqual(sorted(tags), filenames)
+
+	def test_should_drop_paths_of_skipped_files(self):
+		args = MS.make_arg_parser().parse_args([self.inbox, '--root_dir', self.root, '--batch', '--no_cache'])
+		plan, other_filenames, max_paths, paths_to_make = MS.get_all_data(self.inbox, args)
+		plan = plan.without(set(filename for filename in plan.sources() if 'First' in filename))
+		max_paths, paths_to_make = MS.get_used_paths(plan, max_paths, paths_to_make)
+		self.assertEqual(max_paths, {self.root})
+		self.assertEqual(paths_to_make, {os.path.join('Second', '2002-Two')})
+
+	def test_should_store_plan_directories_once(self):
+		args = MS.make_arg_parser().parse_args([self.inbox, '--root_dir', self.root, '--batch', '--no_cache'])
+		plan, other_filenames, max_paths, paths_to_make = MS.get_all_data(self.inbox, args)
+		self.assertEqual(len(plan.dirs), 4)
+		self.assertEqual(plan.destination_dirs(), [os.path.join(self.root, 'First', '2001-One'), os.path.join(self.root, 'Second', '2002-Two')])
+		self.assertIs(plan.tags[0].artist, plan.tags[1].artist)
+		with mock.patch('builtins.print') as print_mock:
+			MS.print_all_data(plan, other_filenames, max_paths, paths_to_make)
+		lines = [call.args[0] for call in print_mock.call_args_list if call.args]
+		self.assertIn('\t{0} -> {1}'.format(os.path.join(self.inbox, 'downloads'), self.root), lines)
+		self.assertIn('\t\t{0} -> {1}'.format(os.path.join('First - One', '01 - Track.mp3'), os.path.join('First', '2001-One', '01-Track.mp3')), lines)
+
+class TestRetagInPlace(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.tmpdir.name, 'lib')
+		album_dir = os.path.join(self.root, 'Кино', '1988-Группа крови')
+		os.makedirs(album_dir)
+		self.filenames = []
+		for number, title in [(1, 'Группа крови'), (2, 'Закрой за мной дверь')]:
+			filename = os.path.join(album_dir, '{0:0>2}-{1}.mp3'.format(number, title))
+			with open(filename, 'wb') as f:
+				f.write(make_id3v2_tag([
+					make_id3v2_frame(b'TPE1', 'Кино'.encode('cp1251')),
+					make_id3v2_frame(b'TALB', 'Группа крови'.encode('cp1251')),
+					make_id3v2_frame(b'TYER', b'1988'),
+					make_id3v2_frame(b'TRCK', '{0}/2'.format(number).encode()),
+					make_id3v2_frame(b'TIT2', title.encode('cp1251')),
+					make_id3v2_frame(b'APIC', b'\x00image/jpeg\x00\x03\x00cover'),
+					], padding=512) + AUDIO_FRAME)
+			self.filenames.append(filename)
+		self.args = MS.make_arg_parser().parse_args(['--retag_in_place', self.root, '--no_cache', '--jobs', '2'])
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_write_only_changed_files(self):
+		sizes = [os.path.getsize(filename) for filename in self.filenames]
+		with mock.patch('builtins.input', return_value='y'), mock.patch('builtins.print'):
+			self.assertEqual(MS.retag_library(self.root, self.args), [])
+		self.assertEqual(MS.get_taginfo_for_file(self.filenames[0]).artist, 'Кино')
+		# Tags are updated within existing padding, other frames are kept.
+		self.assertEqual([os.path.getsize(filename) for filename in self.filenames], sizes)
+		with open(self.filenames[0], 'rb') as f:
+			version, frames, tag_size = MS.read_id3v2_tag(f)
+		self.assertIn((b'APIC', 0, b'\x00\x00image/jpeg\x00\x03\x00cover'), frames)
+		mtimes = [os.stat(filename).st_mtime_ns for filename in self.filenames]
+		with mock.patch('builtins.input') as input_mock, mock.patch('builtins.print'), mock.patch.object(MS, 'retag_in_place') as retag_mock:
+			self.assertEqual(MS.retag_library(self.root, self.args), [])
+		self.assertFalse(input_mock.called)
+		self.assertFalse(retag_mock.called)
+		self.assertEqual([os.stat(filename).st_mtime_ns for filename in self.filenames], mtimes)
+
+	def test_should_not_reencode_short_latin1_album(self):
+		album_dir = os.path.join(self.root, 'Café Tacvba', '1994-Re')
+		os.makedirs(album_dir)
+		filename = os.path.join(album_dir, '01-La Ingrata.mp3')
+		with open(filename, 'wb') as f:
+			f.write(make_id3v2_tag([
+				make_id3v2_frame(b'TPE1', 'Café Tacvba'.encode('latin-1')),
+				make_id3v2_frame(b'TALB', b'Re'),
+				make_id3v2_frame(b'TYER', b'1994'),
+				make_id3v2_frame(b'TRCK', b'01'),
+				make_id3v2_frame(b'TIT2', b'La Ingrata'),
+				], padding=512) + AUDIO_FRAME)
+		with mock.patch('builtins.input', return_value='y'), mock.patch('builtins.print'), mock.patch.object(MS, 'encoding_verdicts', {}):
+			MS.retag_library(album_dir, self.args)
+		with open(filename, 'rb') as f:
+			version, frames, tag_size = MS.read_id3v2_tag(f)
+		self.assertIn((b'TPE1', 0, b'\x00' + 'Café Tacvba'.encode('latin-1')), frames)
+
+	def test_should_ignore_other_frames_when_comparing(self):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Кино', 'Группа крови', '1988', '01', 'Группа крови'
+		MS.update_tags_in_place(self.filenames[0], taginfo)
+		self.assertTrue(MS.has_same_tag_values(self.filenames[0], taginfo))
+		with open(self.filenames[0], 'ab') as f:
+			f.write(make_id3v1_tag(b'Other'))
+		self.assertTrue(MS.has_same_tag_values(self.filenames[0], taginfo))
+		taginfo.title = 'Other'
+		self.assertFalse(MS.has_same_tag_values(self.filenames[0], taginfo))
+
+	def test_should_compare_frames_of_other_versions_by_field(self):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Artist', 'Album', '1988', '01', 'Title'
+		for version, frame_ids in [(4, [b'TPE1', b'TALB', b'TDRC', b'TRCK', b'TIT2']), (2, [b'TP1', b'TAL', b'TYE', b'TRK', b'TT2'])]:
+			if version == 2:
+				frames = [frame_id + (len(value) + 1).to_bytes(3, 'big') + b'\x00' + value for frame_id, value in zip(frame_ids, [b'Artist', b'Album', b'1988', b'01', b'Title'])]
+			else:
+				frames = [make_id3v2_frame(frame_id, value, version=version) for frame_id, value in zip(frame_ids, [b'Artist', b'Album', b'1988', b'01', b'Title'])]
+			with open(self.filenames[0], 'wb') as f:
+				f.write(make_id3v2_tag(frames, version=version) + AUDIO_FRAME)
+			self.assertTrue(MS.has_same_tag_values(self.filenames[0], taginfo))
+
+	def test_should_keep_other_frames_and_id3v1_when_tag_grows(self):
+		with open(self.filenames[0], 'wb') as f:
+			f.write(make_id3v2_tag([make_id3v2_frame(b'TDRC', b'1988', version=4), make_id3v2_frame(b'COMM', b'eng\x00comment', version=4)], version=4, padding=0) + AUDIO_FRAME + make_id3v1_tag(b'Old'))
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Artist', 'Album', '2001', '01', 'Title'
+		MS.retag_in_place(self.filenames[0], taginfo, keep_frames=True)
+		with open(self.filenames[0], 'rb') as f:
+			version, frames, tag_size = MS.read_id3v2_tag(f)
+			self.assertEqual(f.read()[-128:], make_id3v1_tag(b'Old'))
+		self.assertEqual(version, 4)
+		self.assertEqual(sorted(frame_id for frame_id, frame_flags, body in frames), [b'COMM', b'TALB', b'TDRC', b'TIT2', b'TPE1', b'TRCK'])
+		self.assertTrue(MS.has_same_tag_values(self.filenames[0], taginfo))
+
+class TestFilenamePatterns(unittest.TestCase):
+	def test_should_parse_tags_from_filesystem(self):
+		paths = [
+				('/music/inbox/Artist - 2005 - Album Name/01 - Song.mp3', 'Artist ', 'Album Name', '2005', '01', 'Song'),
+				('/music/inbox/Artist [1999] Album/02.Title.mp3', 'Artist ', 'Album', '1999', '02', 'Title'),
+				('inbox/Artist - Album (2003)/3_Title.mp3', 'Artist ', 'Album', '2003', '3', 'Title'),
+				('Discography/2001 - Album/04 Title.mp3', 'Discography', 'Album', '2001', '04', 'Title'),
+				('Artist - Discography/[1995] - Album/5Title.mp3', 'Artist', 'Album', '1995', '5', 'Title'),
+				('/music/Artist - Album/Title.mp3', 'Artist ', 'Album', 0, 6, 'Title'),
+				('/music/Artist/2007 - Album/CD 2/07 - Title.mp3', 'Artist', 'Album', '2007', '07', 'Title'),
+				]
+		fs_tags = MS.get_tags_from_filesystem([path[0] for path in paths], MS.FilenamePatterns())
+		for path, artist, album, year, number, title in paths:
+			taginfo = fs_tags[path]
+			self.assertEqual((taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title), (artist, album, year, number, title))
+
+	def test_should_parse_each_dirname_once(self):
+		patterns = MS.FilenamePatterns()
+		with mock.patch.object(patterns, '_parse', wraps=patterns._parse) as parse:
+			MS.get_tags_from_filesystem(['/music/Artist - 2005 - Album/{0:0>2} - Song.mp3'.format(number) for number in range(10)], patterns)
+		self.assertEqual(parse.call_count, 1 + 10)
+
+	def test_should_prefer_user_patterns(self):
+		patterns = MS.FilenamePatterns([r'(?P<album>.+) \[(?P<year>[0-9]{4})\] \{ReleaseGroup\}'] + MS.DIR_PATTERNS)
+		fs_tags = MS.get_tags_from_filesystem(['Album [2010] {ReleaseGroup}/01 - Song.mp3'], patterns)
+		taginfo = fs_tags['Album [2010] {ReleaseGroup}/01 - Song.mp3']
+		self.assertEqual((taginfo.album, taginfo.year), ('Album', '2010'))
+
+	def test_should_reject_unknown_fields(self):
+		with self.assertRaises(ValueError):
+			MS.FilenamePatterns([r'(?P<genre>.+)'])
+
+# Results of repair_tags before normalization rules were compiled.
+# (dirname, filename, artist, album, year, number, title, separator, expected (artist, album, year, number, title))
+GOLDEN_REPAIR_CASES = [
+		('Artist - 2005 - Album', '01 - Song.mp3', 'metallica', 'master of puppets (Deluxe Edition)', '1986-03-03', '1', 'battery', ' ', ('Metallica', 'Master Of Puppets', '1986', 1, 'Battery')),
+		('Artist - 2005 - Album', '02 - Song.mp3', 'The.Beatles', 'abbey road (320k) [DemonUploader]', '1969', '2', '02 - come together', ' ', ('The Beatles', 'Abbey Road', '1969', 2, '02 - Come Together')),
+		('Artist - 2005 - Album', '03 - Song.mp3', 'Kino - дискография', 'gruppa krovi (limited edition)', '', '3', 'Kino - zvezda po imeni solnce', ' ', ('Kino', 'Gruppa Krovi', '2005', 3, 'Zvezda Po Imeni Solnce')),
+		('Artist - 2005 - Album', '04 - Song.mp3', 'Queen[Discography]', 'a night at the opera (Remastered)', '1975', 'x', "don't stop me now", ' ', ('Queen', 'A Night At The Opera', '1975', '04', "Don't Stop Me Now")),
+		('Artist - 2005 - Album', '05_song.mp3', 'Nightwish-Collection.2000-2008.MP3.320kbps', 'Once - CD 1', '2004', '5', '5_nemo_song', ' ', ('Nightwish', 'Once', '2004', 105, 'Nemo Song')),
+		('Artist - 2005 - Album', '06 song.mp3', 'Nightwish', 'Once - CD 2', '2004', '6', '  many    spaces   here ', ' ', ('Nightwish', 'Once', '2004', 206, 'Many Spaces Here')),
+		('Artist - 2005 - Album', '07 song.mp3', '', '', '', '', '', ' ', ('Artist', 'Album', '2005', 7, 'Song')),
+		('Some_Artist - 2001 - Some_Album', '08_Some_Title.mp3', 'some_artist', 'some_album', '2001', '8', 'some_title', '_', ('Some Artist', 'Some Album', '2001', 8, 'Some Title')),
+		('Band.Name - 1999 - Album.Name', '09.Track.Name.mp3', 'band.name', 'album.name', 'year 1999', '9', 'track.name', '.', ('Band Name', 'Album Name', None, 9, 'Track Name')),
+		('Artist - 2005 - Album/CD 2', '10 - Song.mp3', 'iron maiden', 'Album/CD 2', '1982', '10', 'iron maiden - run to the hills', ' ', ('Iron Maiden', 'Album', '1982', 10, 'Run To The Hills')),
+		('Artist - 2005 - Album', '11 - Song.mp3', 'AC/DC', 'HIGHWAY TO HELL', '1979', '11', "IT'S A LONG WAY (live)", ' ', ('Ac/Dc', 'Highway To Hell', '1979', 11, "It's A Long Way (Live)")),
+		('Artist - 2005 - Album', '12 - Song.mp3', 'sépultura', 'ROOTS bloody ROOTS', '1996', '12/14', 'ratamahatta', ' ', ('Sépultura', 'Roots Bloody Roots', '1996', '12', 'Ratamahatta')),
+		('Artist - 2005 - Album', '13 - Song.mp3', 'Кино', 'группа крови', '1988', '13', 'звезда по имени солнце', ' ', ('Кино', 'Группа Крови', '1988', 13, 'Звезда По Имени Солнце')),
+		('Artist - 2005 - Album', '14 - Song.mp3', 'x', 'a\tb', ' 2010 ', '14', '14.intro', ' ', ('X', 'A\tB', '2010', 14, '.Intro')),
+		]
+
+class TestRepairTags(unittest.TestCase):
+	def repair(self, dirname, filename, artist, album, year, number, title, separator, force_fs_tags=False):
+		taginfo = MS.TagInfo()
+		taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = artist, album, year, number, title
+		args = MS.make_arg_parser().parse_args(['.', '--root_dir', '.', '--separator', separator] + (['--force_fs_tags'] if force_fs_tags else []))
+		with mock.patch('builtins.print'):
+			MS.repair_tags({os.path.join('/inbox', dirname, filename): taginfo}, args)
+		return (taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title)
+
+	def test_should_match_golden_results(self):
+		for case in GOLDEN_REPAIR_CASES:
+			self.assertEqual(self.repair(*case[:-1]), case[-1])
+
+	def test_should_merge_consecutive_strip_rules(self):
+		normalizer = MS.TagNormalizer({'album' : [['strip', 'a'], ['strip', 'b'], ['replace', 'c', 'd'], ['strip', 'e']]})
+		self.assertEqual(len(normalizer.get_pipeline('album', ' ')), 3)
+		self.assertEqual(normalizer.normalize('album', 'abcdef'), 'ddf')
+		with self.assertRaises(ValueError):
+			MS.TagNormalizer({'album' : [['unknown']]}).get_pipeline('album', ' ')
+
+	def test_should_override_rules_from_config(self):
+		try:
+			MS.set_config({'normalization_rules' : {'album' : [['sub', r' \(Bonus.*\)', '']]}})
+			self.assertEqual(self.repair('Artist - 2005 - Album', '01 - Song.mp3', 'artist', 'album (Bonus Tracks) (Deluxe Edition)', '2001', '1', 'song', ' ')[1], 'Album')
+		finally:
+			MS.set_config({})
+
+class TestEncodingDetection(unittest.TestCase):
+	def make_tags(self, dirname, values):
+		tags = {}
+		for index, value in enumerate(values):
+			taginfo = MS.TagInfo()
+			taginfo.artist, taginfo.title = values[0], value
+			tags[os.path.join(dirname, '{0}.mp3'.format(index))] = taginfo
+		return tags
+
+	def test_should_not_call_chardet_for_ascii_and_utf8(self):
+		with mock.patch('chardet.UniversalDetector') as detector:
+			self.assertEqual(MS.detect_encoding([b'Artist', b'Title']), 'ascii')
+			self.assertEqual(MS.detect_encoding([b'Artist', 'Звезда'.encode('utf-8')]), 'utf-8')
+			self.assertIsNone(MS.detect_encoding([]))
+		detector.assert_not_called()
+
+	def test_should_detect_cp1251_album(self):
+		values = [value.encode('cp1251') for value in ['Кино', 'Группа крови', 'Закрой за собой дверь', 'Мама, мы все сошли с ума', 'Война', 'Спокойная ночь']]
+		tags = self.make_tags('/inbox/cp1251', values)
+		tags.update(self.make_tags('/inbox/latin', [b'Artist', b'Title']))
+		encodings = MS.guess_encodings(tags)
+		self.assertEqual(encodings['/inbox/cp1251/0.mp3'].lower(), 'windows-1251')
+		self.assertEqual(encodings['/inbox/latin/0.mp3'], 'ascii')
+
+	def test_should_cache_verdict_per_directory(self):
+		tags = self.make_tags('/inbox/album', ['Война'.encode('cp1251'), 'Спокойная ночь'.encode('cp1251')])
+		MS.guess_encodings(tags)
+		with mock.patch('mediasort.detect_encoding') as detect_encoding:
+			MS.guess_encodings(tags)
+		detect_encoding.assert_not_called()
+
+class TestAudioHashIndex(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.root = os.path.join(self.tmpdir.name, 'root')
+		os.makedirs(os.path.join(self.root, 'Artist', '2001-Album'))
+		self.filename = os.path.join(self.root, 'Artist', '2001-Album', '01-Track.mp3')
+		with open(self.filename, 'wb') as f:
+			f.write(make_id3v2_tag([make_id3v2_frame(b'TIT2', b'Track')]) + AUDIO_FRAME)
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_find_retagged_duplicates(self):
+		incoming = os.path.join(self.tmpdir.name, 'incoming.mp3')
+		with open(incoming, 'wb') as f:
+			f.write(make_id3v2_tag([make_id3v2_frame(b'TIT2', b'Track (Remastered)')]) + AUDIO_FRAME + make_id3v1_tag(b'Track'))
+		index = MS.AudioHashIndex(self.root).update()
+		self.assertEqual(index.find(MS.get_audio_hash(incoming)), [self.filename])
+		with open(incoming, 'wb') as f:
+			f.write(AUDIO_FRAME[:-1] + b'\x01')
+		self.assertEqual(index.find(MS.get_audio_hash(incoming)), [])
+
+	def test_should_rehash_only_changed_files(self):
+		cache = MS.TagCache(os.path.join(self.tmpdir.name, 'cache.sqlite'))
+		index = MS.AudioHashIndex(self.root).update()
+		cache.put_audio_hashes(self.root, index.files)
+		other_filename = os.path.join(self.root, 'Artist', '2001-Album', '02-Track.mp3')
+		with open(other_filename, 'wb') as f:
+			f.write(AUDIO_FRAME * 2)
+		with unittest.mock.patch.object(MS, 'get_audio_hash', wraps=MS.get_audio_hash) as get_audio_hash:
+			index = MS.AudioHashIndex(self.root).update(cache.get_audio_hashes(self.root))
+		self.assertEqual(get_audio_hash.call_args_list, [unittest.mock.call(other_filename)])
+		self.assertEqual(len(index.files), 2)
+		cache.close()
+
+	def test_should_not_match_file_with_itself(self):
+		inbox = os.path.join(self.root, 'inbox')
+		os.makedirs(inbox)
+		incoming = os.path.join(inbox, 'incoming.mp3')
+		with open(incoming, 'wb') as f:
+			f.write(AUDIO_FRAME)
+		os.link(incoming, os.path.join(self.root, 'Artist', '2001-Album', '02-Imported.mp3'))
+		args = MS.make_arg_parser().parse_args([inbox, '--root_dir', self.root, '--no_cache', '--on_duplicate', 'skip'])
+		with mock.patch('builtins.print'):
+			self.assertEqual(MS.find_duplicates([incoming], args, [inbox]), {incoming : [self.filename]})
+
+	def test_should_skip_vanished_files(self):
+		inbox = os.path.join(self.tmpdir.name, 'inbox')
+		os.makedirs(inbox)
+		incoming = [os.path.join(inbox, '{0}.mp3'.format(index)) for index in range(2)]
+		for filename in incoming:
+			with open(filename, 'wb') as f:
+				f.write(AUDIO_FRAME)
+		args = MS.make_arg_parser().parse_args([inbox, '--root_dir', self.root, '--no_cache', '--on_duplicate', 'skip'])
+		original_get_audio_hash = MS.get_audio_hash
+		def get_audio_hash(filename):
+			if filename == incoming[0]:
+				raise FileNotFoundError(errno.ENOENT, 'No such file or directory', filename)
+			digest = original_get_audio_hash(filename)
+			if filename == incoming[1]:
+				os.remove(self.filename) # Library file vanishes after it was indexed.
+			return digest
+		with mock.patch.object(MS, 'get_audio_hash', get_audio_hash), mock.patch('builtins.print') as print_mock:
+			self.assertEqual(MS.find_duplicates(incoming, args, [inbox]), {})
+		print_mock.assert_any_call('Cannot check for duplicates:')
+
+class TestWatch(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.inbox = os.path.join(self.tmpdir.name, 'inbox')
+		os.makedirs(os.path.join(self.inbox, 'old'))
+	def tearDown(self):
+		self.tmpdir.cleanup()
+	def make_album(self):
+		album_dir = os.path.join(self.inbox, 'new', 'CD1')
+		os.makedirs(album_dir)
+		with open(os.path.join(album_dir, '01.mp3'), 'wb') as f:
+			f.write(AUDIO_FRAME)
+		return album_dir
+
+	def test_should_report_changes_with_inotify(self):
+		try:
+			watcher = MS.InotifyWatcher(self.inbox)
+		except (OSError, AttributeError):
+			self.skipTest('inotify is not available')
+		try:
+			album_dir = self.make_album()
+			changed = watcher.read(timeout=5) | watcher.read(timeout=0.2)
+			# Files created before the watch of their new directory is added are reported by the directory.
+			self.assertTrue(album_dir in changed or os.path.join(album_dir, '01.mp3') in changed)
+			self.assertEqual(set(MS.get_inbox_album_dir(self.inbox, path) for path in changed), {os.path.join(self.inbox, 'new')})
+			self.assertEqual(watcher.read(timeout=0), set())
+		finally:
+			watcher.close()
+
+	def test_should_report_changes_by_polling(self):
+		watcher = MS.PollingWatcher(self.inbox, interval=0)
+		album_dir = self.make_album()
+		self.assertEqual(watcher.read(), {album_dir})
+		self.assertEqual(watcher.read(), set())
+		os.remove(os.path.join(album_dir, '01.mp3'))
+		self.assertEqual(watcher.read(), set())
+
+	def test_should_import_existing_albums_and_survive_failures(self):
+		root = os.path.join(self.tmpdir.name, 'root')
+		os.makedirs(root)
+		self.make_album()
+		args = MS.make_arg_parser().parse_args(['--watch', self.inbox, '--root_dir', root, '--no_cache'])
+		class Watcher:
+			calls = 0
+			def __init__(self, inbox, exclude_dirs=()):
+				pass
+			def read(self, timeout=None):
+				Watcher.calls += 1
+				if Watcher.calls == 1:
+					return set()
+				if Watcher.calls == 2: # Failed album is not retried until changed.
+					return {os.path.join(self.inbox, 'new', 'CD1'), os.path.join(self.inbox, 'old')}
+				raise KeyboardInterrupt
+			def close(self):
+				pass
+		Watcher.inbox = self.inbox
+		imported = []
+		def import_directory(album_dir, args, library, ask):
+			imported.append(album_dir)
+			MS.encoding_verdicts['key'] = 'cp1251'
+			if album_dir.endswith('old'):
+				raise IndexError('list index out of range')
+			return []
+		with mock.patch.object(MS, 'InotifyWatcher', Watcher), mock.patch.object(MS, 'import_directory', import_directory), mock.patch('builtins.print'):
+			args.QUIET_TIME = 0
+			self.assertRaises(KeyboardInterrupt, MS.watch_inbox, self.inbox, args)
+		self.assertEqual(imported, [os.path.join(self.inbox, 'new'), os.path.join(self.inbox, 'old'), os.path.join(self.inbox, 'new')])
+		self.assertEqual(MS.encoding_verdicts, {})
+
+	def test_should_not_import_existing_albums_again_after_restart(self):
+		root = os.path.join(self.tmpdir.name, 'root')
+		os.makedirs(root)
+		album_dir = self.make_album()
+		args = MS.make_arg_parser().parse_args(['--watch', self.inbox, '--root_dir', root])
+		args.QUIET_TIME = 0
+		class Watcher:
+			def __init__(self, inbox, exclude_dirs=()):
+				self.calls = 0
+			def read(self, timeout=None):
+				self.calls += 1
+				if self.calls > 1:
+					raise KeyboardInterrupt
+				return set()
+			def close(self):
+				pass
+		imported = []
+		def import_directory(album_dir, args, library, ask):
+			imported.append(os.path.basename(album_dir))
+			return []
+		def watch():
+			del imported[:]
+			with mock.patch.object(MS, 'InotifyWatcher', Watcher), mock.patch.object(MS, 'import_directory', import_directory), mock.patch.object(MS, 'get_cache_dir', return_value=os.path.join(self.tmpdir.name, 'cache')), mock.patch('builtins.print'):
+				self.assertRaises(KeyboardInterrupt, MS.watch_inbox, self.inbox, args)
+			return imported
+		self.assertEqual(watch(), ['new', 'old'])
+		self.assertEqual(watch(), [])
+		with open(os.path.join(album_dir, '02.mp3'), 'wb') as f:
+			f.write(AUDIO_FRAME)
+		os.utime(os.path.join(album_dir, '02.mp3'), ns=(0, MS.get_tree_mtime(self.inbox) + 10**9))
+		self.assertEqual(watch(), ['new'])
+
+	def test_should_import_only_into_library(self):
+		root = os.path.join(self.tmpdir.name, 'root')
+		os.makedirs(root)
+		for album_dir, artist in [('Artist - 2005 - Album', b''), ('2006 - Escape', b'..')]:
+			os.makedirs(os.path.join(self.inbox, album_dir))
+			with open(os.path.join(self.inbox, album_dir, '01 - Song.mp3'), 'wb') as f:
+				f.write((make_id3v2_tag([make_id3v2_frame(b'TPE1', artist)]) if artist else b'') + AUDIO_FRAME)
+		args = MS.make_arg_parser().parse_args(['--watch', self.inbox, '--root_dir', root, '--no_cache', '--journal', os.path.join(self.tmpdir.name, 'journal')])
+		with mock.patch('builtins.print'):
+			for album_dir in ['Artist - 2005 - Album', '2006 - Escape']:
+				self.assertEqual(MS.import_directory(os.path.join(self.inbox, album_dir), args, ask=False), [])
+		self.assertTrue(os.path.exists(os.path.join(root, 'Artist', '2005-Album', '01-Song.mp3')))
+		self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, '2006-Escape')))
+
+	def test_should_refresh_library_after_import(self):
+		root = os.path.join(self.tmpdir.name, 'root')
+		os.makedirs(os.path.join(root, 'Rock', 'Old Artist'))
+		library = MS.LibraryIndex(root, 3).scan()
+		os.makedirs(os.path.join(root, 'Rock', 'New Artist', '2001-Album'))
+		library.refresh(os.path.join(root, 'Rock', 'New Artist', '2001-Album'))
+		self.assertEqual(library.find_artist('new artist'), ('Rock', 'New Artist'))
+		self.assertEqual(library.listdir(os.path.join(root, 'Rock', 'New Artist')), ['2001-Album'])
+
+class TestStats(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.stats = MS.Stats()
+		patcher = unittest.mock.patch.object(MS, 'stats', self.stats)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_accumulate_phases(self):
+		for _ in range(2):
+			with self.stats.phase('walk'):
+				time.sleep(0.01)
+		data = self.stats.as_dict()
+		self.assertEqual(data['phases']['walk']['calls'], 2)
+		self.assertGreaterEqual(data['phases']['walk']['wall'], 0.02)
+
+	def test_should_count_phases_and_operations_of_run(self):
+		inbox, root = os.path.join(self.tmpdir.name, 'inbox'), os.path.join(self.tmpdir.name, 'root')
+		os.makedirs(os.path.join(inbox, 'Artist - 2001 - Album'))
+		os.makedirs(root)
+		filename = os.path.join(inbox, 'Artist - 2001 - Album', '01 - Track.mp3')
+		with open(filename, 'wb') as f:
+			f.write(make_id3v2_tag([make_id3v2_frame(b'TPE1', b'Artist')]) + AUDIO_FRAME)
+		args = MS.make_arg_parser().parse_args([inbox, '--root_dir', root, '--no_cache', '--jobs', '1'])
+		plan, other_filenames, max_paths, paths_to_make = MS.get_all_data(inbox, args)
+		os.makedirs(plan.destination_dirs()[0])
+		MS.run_import(plan, args)
+		data = self.stats.as_dict()
+		self.assertEqual(set(data['phases']), {'walk', 'tag read', 'library scan', 'reencode', 'repair', 'destination resolve', 'import'})
+		self.assertEqual(data['counters']['tags_read'], 1)
+		self.assertEqual(data['counters']['scandir'], 3)
+		self.assertEqual(data['counters']['bytes_copied'], len(AUDIO_FRAME))
+
+class TestImportJournal(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.journal_filename = os.path.join(self.tmpdir.name, 'journals', 'import.journal')
+		self.tasks = []
+		for index in range(1, 5):
+			filename = os.path.join(self.tmpdir.name, '{0}.mp3'.format(index))
+			with open(filename, 'wb') as f:
+				f.write(AUDIO_FRAME)
+			taginfo = MS.TagInfo()
+			taginfo.artist, taginfo.album, taginfo.year, taginfo.number, taginfo.title = 'Artist', 'Album', '2001', index, 'Title {0}'.format(index)
+			self.tasks.append((filename, os.path.join(self.tmpdir.name, 'lib', '{0:0>2}.mp3'.format(index)), taginfo))
+		self.args = MS.make_arg_parser().parse_args(['--resume', self.journal_filename, '--jobs', '2'])
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_should_resume_unfinished_imports(self):
+		journal = MS.ImportJournal.create(self.journal_filename, self.tasks, 'copy')
+		os.makedirs(os.path.join(self.tmpdir.name, 'lib'))
+		for filename, new_filename, taginfo in self.tasks[:3]:
+			MS.import_file(filename, new_filename, taginfo)
+			journal.record_done(filename, new_filename)
+		journal.close()
+		with open(self.tasks[1][1], 'ab') as f:
+			f.write(b'garbage')
+
+		imported = []
+		original_import_file = MS.import_file
+		def import_file(filename, new_filename, taginfo, mode):
+			imported.append(filename)
+			return original_import_file(filename, new_filename, taginfo, mode)
+		with mock.patch('mediasort.import_file', import_file), mock.patch('builtins.print'):
+			MS.resume_import(self.args)
+		self.assertEqual(sorted(imported), [self.tasks[1][0], self.tasks[3][0]])
+		for source, destination, taginfo in self.tasks:
+			self.assertTrue(MS.has_same_tags(destination, taginfo))
+		self.assertFalse(os.path.exists(self.journal_filename))
+		self.assertEqual(MS.get_taginfo_for_file(self.tasks[3][1]).title, b'Title 4')
+
+	def test_should_detect_moved_files_without_completion_record(self):
+		journal = MS.ImportJournal.create(self.journal_filename, self.tasks, 'move')
+		journal.close()
+		os.makedirs(os.path.join(self.tmpdir.name, 'lib'))
+		filename, new_filename, taginfo = self.tasks[0]
+		MS.import_file(filename, new_filename, taginfo, 'move')
+		self.assertTrue(MS.is_import_done(filename, new_filename, taginfo, None))
+		self.assertFalse(MS.is_import_done(*self.tasks[1], None))
+
+	def test_should_retag_file_moved_before_crash(self):
+		journal = MS.ImportJournal.create(self.journal_filename, self.tasks[:1], 'move')
+		journal.close()
+		os.makedirs(os.path.join(self.tmpdir.name, 'lib'))
+		filename, new_filename, taginfo = self.tasks[0]
+		os.rename(filename, new_filename)
+		with mock.patch('builtins.print'):
+			self.assertEqual(MS.resume_import(self.args), [])
+		self.assertEqual(MS.get_taginfo_for_file(new_filename).title, b'Title 1')
+		self.assertFalse(os.path.exists(self.journal_filename))
+
+	def test_should_not_trust_copy_without_completion_record(self):
+		journal = MS.ImportJournal.create(self.journal_filename, self.tasks[:1], 'copy')
+		journal.close()
+		os.makedirs(os.path.join(self.tmpdir.name, 'lib'))
+		filename, new_filename, taginfo = self.tasks[0]
+		with open(new_filename, 'wb') as f:
+			f.write(MS.make_id3v2_tag(taginfo) + AUDIO_FRAME[:10]) # Crashed while copying.
+		os.remove(filename)
+		self.assertFalse(MS.is_import_done(filename, new_filename, taginfo, None, 'copy'))
+		with mock.patch('builtins.print'):
+			errors = MS.resume_import(self.args)
+		self.assertEqual([filename for filename, e in errors], [filename])
+		self.assertTrue(os.path.exists(self.journal_filename))
+
 if __name__ == '__main__':
 	unittest.main()